@@ -1,9 +1,13 @@
 from django.contrib import admin
-from .models import House, Room, Device, Scene, SceneAction
+from .models import House, Room, Device, Scene, SceneAction, SceneRun, SceneTrigger, DeviceGroup, DeviceStateEvent
 
 # Register your models here.
 admin.site.register(House)
 admin.site.register(Room)
 admin.site.register(Device)
 admin.site.register(Scene)
-admin.site.register(SceneAction)
\ No newline at end of file
+admin.site.register(SceneAction)
+admin.site.register(SceneRun)
+admin.site.register(SceneTrigger)
+admin.site.register(DeviceGroup)
+admin.site.register(DeviceStateEvent)
\ No newline at end of file
@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class AutomacaoConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'automacao'
+
+    def ready(self):
+        # Conecta os receptores que invalidam os caches da app
+        from . import signals  # noqa: F401
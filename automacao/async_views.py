@@ -0,0 +1,235 @@
+'''
+Versões assíncronas (ASGI) dos endpoints mais chamados pelos gateways, em /api/async/.
+
+São views do Django (o DRF não tem views assíncronas) que usam o ORM assíncrono
+(aget, aupdate, afirst, async for) e devolvem o mesmo corpo das rotas do DRF:
+- GET  devices/<id>/             detalhe do dispositivo
+- POST devices/<id>/set_state/   liga/desliga (aceita If-Match e Idempotency-Key)
+- GET  devices/?room=<id>        dispositivos do cômodo, paginados por ?after=<id>
+- POST scenes/<id>/execute/      executa a cena (plano em cache, sem sair do loop no acerto;
+                                 aceita Idempotency-Key)
+- GET  houses/<id>/snapshot/     retrato colunar da casa (aceita ?since=)
+
+Roteamento, validação, serialização e acertos de cache rodam no event loop. O ORM
+assíncrono do Django ainda executa cada consulta em uma thread (sync_to_async), e
+as transações (execução de cenas) e os efeitos das escritas (eventos, histórico,
+caches e gatilhos) são chamados assim também. Os shards e réplicas valem como nas
+rotas do DRF.
+'''
+import json
+from contextlib import ExitStack
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db.models import F
+from django.http import JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from rest_framework.permissions import SAFE_METHODS
+
+from .engine import queue_scene_run, run_scene_now
+from .idempotency import aidempotent, get_singleflight
+from .models import Device, House, Room, Scene
+from .plans import aget_scene_plan
+from .replicas import allow_replica_reads, get_replicas, is_pinned, pin_response
+from .serializers import DeviceSerializer
+from .services import STATE_WRITE_ATTEMPTS, VersionConflict, device_states_written
+from .sharding import HouseMoving, check_writable, current_db, is_sharded, locate_house, shard_for_house, use_shard
+from .snapshots import ahouse_snapshot
+from .views import parse_if_match
+from .writebehind import get_state_buffer
+
+# Tamanho padrão e máximo das páginas de devices/?room=
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+NOT_FOUND = {'detail': 'Não encontrado.'}
+
+
+def not_found():
+    return JsonResponse(NOT_FOUND, status=404)
+
+
+async def _routing(request, model, pk):
+    '''Contextos de banco da requisição: réplicas para leituras e o shard da casa do objeto.'''
+    stack = ExitStack()
+    if request.method in SAFE_METHODS and get_replicas() and not is_pinned(request):
+        stack.enter_context(allow_replica_reads())
+    if is_sharded() and pk is not None:
+        house_id = await sync_to_async(locate_house)(model, pk)
+        if house_id is not None:
+            if request.method not in SAFE_METHODS:
+                await sync_to_async(check_writable)(house_id)
+            stack.enter_context(use_shard(await sync_to_async(shard_for_house)(house_id)))
+    return stack
+
+
+def routed(model, param=None):
+    '''
+    Escolhe o banco pelo objeto da URL (ou pelo parâmetro 'param' da query string)
+    e renova a marca de leitura no primário depois de uma escrita.
+    '''
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            pk = kwargs.get('pk') if param is None else request.GET.get(param)
+            if pk is not None and not str(pk).isdigit():
+                return not_found()
+            try:
+                stack = await _routing(request, model, pk)
+            except HouseMoving as e:
+                response = JsonResponse(
+                    {'error': f'A casa {e.house_id} está sendo movida de banco. Tente novamente em instantes.'},
+                    status=503
+                )
+                response['Retry-After'] = '5'
+                return response
+
+            with stack:
+                response = await view(request, *args, **kwargs)
+            if request.method not in SAFE_METHODS and response.status_code < 400 and get_replicas():
+                pin_response(response)
+            return response
+        return wrapper
+    return decorator
+
+
+@require_GET
+@routed(Device)
+async def device_detail(request, pk):
+    try:
+        device = await Device.objects.select_related('room__house').aget(pk=pk)
+    except Device.DoesNotExist:
+        return not_found()
+    return JsonResponse(DeviceSerializer(device).data)
+
+
+@require_GET
+@routed(Room, param='room')
+async def device_list(request):
+    room_id = request.GET.get('room')
+    if not room_id:
+        return JsonResponse({'room': 'Informe o cômodo (?room=<id>).'}, status=400)
+    try:
+        after = int(request.GET.get('after', 0))
+        page_size = min(int(request.GET.get('page_size', PAGE_SIZE)), MAX_PAGE_SIZE)
+    except ValueError:
+        return JsonResponse({'error': '"after" e "page_size" devem ser números inteiros.'}, status=400)
+
+    devices = (
+        Device.objects.select_related('room__house')
+        .filter(room_id=room_id, id__gt=after)
+        .order_by('id')[:max(page_size, 1) + 1]
+    )
+    results = [DeviceSerializer(device).data async for device in devices]
+
+    next_url = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_url = request.build_absolute_uri(f'{request.path}?room={room_id}&page_size={page_size}&after={results[-1]["id"]}')
+    return JsonResponse({'next': next_url, 'results': results})
+
+
+@csrf_exempt
+@require_POST
+@aidempotent
+@routed(Device)
+async def device_set_state(request, pk):
+    try:
+        activated = json.loads(request.body or b'{}').get('activated')
+    except (ValueError, AttributeError):
+        activated = None
+    if activated is None or not isinstance(activated, bool):
+        return JsonResponse({'error': 'O campo "activated" é obrigatório. Ele deve ser um boolean.'}, status=400)
+
+    try:
+        expected = parse_if_match(request.headers.get('If-Match'))
+    except ValueError as e:
+        return JsonResponse({'If-Match': [str(e)]}, status=400)
+
+    # Comandos idênticos simultâneos viram uma escrita só, como na rota do DRF
+    (data, status), _ = await get_singleflight().ado(
+        ('set_state', current_db(), int(pk), activated, expected),
+        lambda: _write_state(int(pk), activated, expected),
+    )
+    return JsonResponse(data, status=status)
+
+
+async def _write_state(pk, activated, expected):
+    '''
+    Mesmo UPDATE condicional de services.save_device_fields (ou o buffer de
+    automacao.writebehind, quando ligado); retorna (corpo, status).
+    '''
+    versions = Device.objects.filter(pk=pk).values_list('version', flat=True)
+    buffer = get_state_buffer()
+    if buffer is not None:
+        current = await Device.objects.filter(pk=pk).values_list('version', 'room_id', 'room__house_id').afirst()
+        if current is None:
+            return NOT_FOUND, 404
+        current_version, room_id, house_id = current
+        try:
+            version = buffer.set(pk, activated, current_version, expected, room_id, house_id)
+        except VersionConflict as e:
+            return {'error': 'O dispositivo foi alterado por outra requisição.', 'version': e.current}, 412
+        return {'status': 'device toggled', 'new_state': activated, 'version': version}, 200
+
+    version = expected if expected is not None else await versions.afirst()
+    for attempt in range(STATE_WRITE_ATTEMPTS):
+        if version is None:
+            return NOT_FOUND, 404
+        # Como em save_device_fields: primeiro só se o estado muda, para saber se houve transição
+        target = Device.objects.filter(pk=pk, version=version)
+        changed = await target.exclude(activated=activated).aupdate(activated=activated, version=F('version') + 1)
+        if changed or await target.aupdate(activated=activated, version=F('version') + 1):
+            break
+        current = await versions.afirst()
+        if current is None:
+            return NOT_FOUND, 404
+        if expected is not None or attempt == STATE_WRITE_ATTEMPTS - 1:
+            return {'error': 'O dispositivo foi alterado por outra requisição.', 'version': current}, 412
+        version = current
+
+    await sync_to_async(device_states_written)({pk: activated}, {pk} if changed else set())
+    return {'status': 'device toggled', 'new_state': activated, 'version': version + 1}, 200
+
+
+@csrf_exempt
+@require_POST
+@aidempotent
+@routed(Scene)
+async def scene_execute(request, pk):
+    plan = await aget_scene_plan(int(pk))
+    if plan is None:
+        return not_found()
+
+    if not plan.activated:
+        return JsonResponse({'status': f'A cena "{plan.name}" está desativada e não pode ser executada.'}, status=403)
+    if not plan.steps:
+        return JsonResponse({'status': 'A cena não possui ações para executar.'}, status=400)
+
+    if not any(interval for _, _, interval in plan.steps):
+        run = await sync_to_async(run_scene_now)(plan.scene_id, plan.steps)
+        return JsonResponse({'status': f'Cena "{plan.name}" executada com sucesso.', 'run_id': run.id})
+
+    run = await sync_to_async(queue_scene_run)(plan)
+    return JsonResponse({'status': f'Cena "{plan.name}" enviada para execução.', 'run_id': run.id}, status=202)
+
+
+@require_GET
+@routed(House)
+async def house_snapshot(request, pk):
+    since = request.GET.get('since')
+    if since is not None:
+        if not since.isdigit():
+            return JsonResponse({'since': ['Informe um número inteiro maior ou igual a 0.']}, status=400)
+        version = await House.objects.filter(pk=pk).values_list('version', flat=True).afirst()
+        if version is None:
+            return not_found()
+        if version == int(since):
+            return JsonResponse({'house': int(pk), 'version': version, 'changed': False})
+
+    snapshot = await ahouse_snapshot(pk)
+    if snapshot is None:
+        return not_found()
+    return JsonResponse(snapshot)
@@ -0,0 +1,281 @@
+'''
+Gerador de dados sintéticos e medição de desempenho dos endpoints da API.
+
+Usado pelo comando benchmark_api: cria casas, cômodos, dispositivos e cenas na
+escala pedida, mede cada endpoint pelo cliente de testes do Django (latência em
+percentis, vazão e número de consultas) e remove os dados ao final.
+
+Com concorrência, compara também as rotas do DRF (WSGI, uma thread por requisição
+simultânea) com as assíncronas de /api/async/ (ASGI, um único event loop).
+'''
+import asyncio
+import math
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.db import connection, connections, transaction
+from django.test import AsyncClient, Client
+
+from .models import House, Room, Device, Scene, SceneAction
+
+# Dono das casas criadas pelo benchmark, usado para removê-las depois
+BENCHMARK_OWNER = 'benchmark'
+
+DEVICES_PER_HOUSE = 1000
+ROOMS_PER_HOUSE = 20
+SCENES_PER_HOUSE = 10
+ACTIONS_PER_SCENE = 20
+BATCH_SIZE = 1000
+
+
+def seed(devices, label='bench'):
+    '''
+    Cria casas com DEVICES_PER_HOUSE dispositivos cada, até somar 'devices'.
+    Retorna a lista de casas criadas.
+    '''
+    house_count = max(1, math.ceil(devices / DEVICES_PER_HOUSE))
+    per_room = max(1, math.ceil(min(devices, DEVICES_PER_HOUSE) / ROOMS_PER_HOUSE))
+
+    with transaction.atomic():
+        houses = House.objects.bulk_create(
+            House(name=f'{label} {h}', address=f'Rua {h}', owner=BENCHMARK_OWNER)
+            for h in range(house_count)
+        )
+        rooms = Room.objects.bulk_create(
+            (Room(name=f'Comodo {r}', house=house) for house in houses for r in range(ROOMS_PER_HOUSE)),
+            batch_size=BATCH_SIZE,
+        )
+
+        remaining = devices
+        device_objs = []
+        for room in rooms:
+            count = min(per_room, remaining)
+            device_objs += [Device(name=f'Dispositivo {d}', room=room, activated=bool(d % 2)) for d in range(count)]
+            remaining -= count
+        created = Device.objects.bulk_create(device_objs, batch_size=BATCH_SIZE)
+
+        devices_by_house = {}
+        rooms_by_id = {room.id: room for room in rooms}
+        for device in created:
+            devices_by_house.setdefault(rooms_by_id[device.room_id].house_id, []).append(device)
+
+        scenes = Scene.objects.bulk_create(
+            Scene(name=f'Cena {s}', house=house)
+            for house in houses if house.id in devices_by_house
+            for s in range(SCENES_PER_HOUSE)
+        )
+        actions = []
+        for scene in scenes:
+            house_devices = devices_by_house[scene.house_id]
+            actions += [
+                SceneAction(scene=scene, device=house_devices[a % len(house_devices)], order=a + 1, newState=bool(a % 2))
+                for a in range(ACTIONS_PER_SCENE)
+            ]
+        SceneAction.objects.bulk_create(actions, batch_size=BATCH_SIZE)
+
+    return houses
+
+
+def cleanup():
+    '''Remove todas as casas criadas pelo benchmark (e tudo abaixo delas).'''
+    House.objects.filter(owner=BENCHMARK_OWNER).delete()
+
+
+class QueryCounter:
+    '''Conta as consultas executadas na conexão padrão sem guardar o SQL.'''
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def measure(request, iterations, warmup=5):
+    '''
+    Executa 'request' (uma função que faz a requisição e devolve a resposta)
+    várias vezes e retorna latência em ms, vazão e consultas por requisição.
+    '''
+    for _ in range(warmup):
+        request()
+
+    latencies = []
+    counter = QueryCounter()
+    statuses = set()
+    started = time.perf_counter()
+    with connection.execute_wrapper(counter):
+        for _ in range(iterations):
+            t0 = time.perf_counter()
+            response = request()
+            latencies.append((time.perf_counter() - t0) * 1000)
+            statuses.add(response.status_code)
+    elapsed = time.perf_counter() - started
+
+    return {
+        'iterations': iterations,
+        'statuses': sorted(statuses),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p90_ms': round(percentile(latencies, 90), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'max_ms': round(max(latencies), 3),
+        'throughput_rps': round(iterations / elapsed, 1) if elapsed else None,
+        'queries_per_request': round(counter.count / iterations, 2),
+    }
+
+
+def endpoint_requests(client, house):
+    '''Monta as requisições medidas para uma casa semeada: {nome: função}.'''
+    room = house.rooms.order_by('id').first()
+    device = Device.objects.filter(room=room).order_by('id').first()
+    scene = house.scenes.order_by('id').first()
+    scene_devices = list(Device.objects.filter(room__house=house).order_by('id').values_list('id', flat=True)[:ACTIONS_PER_SCENE])
+    new_actions = [
+        {'device_id': device_id, 'order': order + 1, 'newState': bool(order % 2), 'interval': 0}
+        for order, device_id in enumerate(scene_devices)
+    ]
+    toggle = {'value': False}
+
+    def set_state():
+        toggle['value'] = not toggle['value']
+        return client.post(f'/api/devices/{device.id}/set_state/', {'activated': toggle['value']}, content_type='application/json')
+
+    return {
+        'list_rooms': lambda: client.get(f'/api/rooms/?house={house.id}'),
+        'list_devices': lambda: client.get(f'/api/devices/?room={room.id}'),
+        'list_scenes': lambda: client.get(f'/api/scenes/?house={house.id}'),
+        'house_snapshot': lambda: client.get(f'/api/houses/{house.id}/snapshot/'),
+        'retrieve_device': lambda: client.get(f'/api/devices/{device.id}/'),
+        'retrieve_room': lambda: client.get(f'/api/rooms/{room.id}/'),
+        'set_state': set_state,
+        'execute': lambda: client.post(f'/api/scenes/{scene.id}/execute/'),
+        'set_scene_actions': lambda: client.post(f'/api/scenes/{scene.id}/set_scene_actions/', new_actions, content_type='application/json'),
+    }
+
+
+def async_endpoint_requests(client, house):
+    '''As mesmas requisições de endpoint_requests pelas rotas assíncronas: {nome: função assíncrona}.'''
+    room = house.rooms.order_by('id').first()
+    device = Device.objects.filter(room=room).order_by('id').first()
+    scene = house.scenes.order_by('id').first()
+    toggle = {'value': False}
+
+    async def set_state():
+        toggle['value'] = not toggle['value']
+        return await client.post(f'/api/async/devices/{device.id}/set_state/', {'activated': toggle['value']}, content_type='application/json')
+
+    return {
+        'list_devices': lambda: client.get(f'/api/async/devices/?room={room.id}'),
+        'house_snapshot': lambda: client.get(f'/api/async/houses/{house.id}/snapshot/'),
+        'retrieve_device': lambda: client.get(f'/api/async/devices/{device.id}/'),
+        'set_state': set_state,
+        'execute': lambda: client.post(f'/api/async/scenes/{scene.id}/execute/'),
+    }
+
+
+def _concurrent_result(latencies, statuses, elapsed):
+    return {
+        'iterations': len(latencies),
+        'statuses': sorted(set(statuses)),
+        'errors': sum(1 for status in statuses if status >= 400),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'mean_ms': round(statistics.fmean(latencies), 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+    }
+
+
+def measure_threads(request, iterations, concurrency):
+    '''Executa 'request' (síncrona) 'iterations' vezes com 'concurrency' threads, como um servidor WSGI.'''
+    def timed(_):
+        try:
+            t0 = time.perf_counter()
+            status = request().status_code
+            return (time.perf_counter() - t0) * 1000, status
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        started = time.perf_counter()
+        results = list(executor.map(timed, range(iterations)))
+        elapsed = time.perf_counter() - started
+    return _concurrent_result([ms for ms, _ in results], [status for _, status in results], elapsed)
+
+
+def measure_async(request, iterations, concurrency):
+    '''Executa 'request' (assíncrona) 'iterations' vezes com até 'concurrency' em andamento no mesmo loop.'''
+    async def run():
+        limit = asyncio.Semaphore(concurrency)
+
+        async def timed():
+            async with limit:
+                t0 = time.perf_counter()
+                status = (await request()).status_code
+                return (time.perf_counter() - t0) * 1000, status
+
+        started = time.perf_counter()
+        results = await asyncio.gather(*(timed() for _ in range(iterations)))
+        return results, time.perf_counter() - started
+
+    results, elapsed = asyncio.run(run())
+    return _concurrent_result([ms for ms, _ in results], [status for _, status in results], elapsed)
+
+
+def compare_async(house, iterations, concurrency, only=None, log=print):
+    '''Mede os endpoints com versão assíncrona pelas duas rotas, com a mesma concorrência.'''
+    # Um Client (e requisições) por thread: o Client do Django guarda cookies entre requisições.
+    # Falhas (ex.: banco travado sob escrita concorrente) contam como erros em vez de interromper
+    local = threading.local()
+
+    def per_thread(name):
+        if not hasattr(local, 'requests'):
+            local.requests = endpoint_requests(Client(raise_request_exception=False), house)
+        return local.requests[name]()
+
+    async_requests = async_endpoint_requests(AsyncClient(raise_request_exception=False), house)
+    results = {}
+    for name, request in async_requests.items():
+        if only and name not in only:
+            continue
+        results[name] = {
+            'wsgi': measure_threads(lambda name=name: per_thread(name), iterations, concurrency),
+            'asgi': measure_async(request, iterations, concurrency),
+        }
+        log(f'  {name} x{concurrency}: WSGI p99={results[name]["wsgi"]["p99_ms"]}ms {results[name]["wsgi"]["throughput_rps"]} req/s | '
+            f'ASGI p99={results[name]["asgi"]["p99_ms"]}ms {results[name]["asgi"]["throughput_rps"]} req/s')
+    return results
+
+
+def run_scale(client, devices, iterations, only=None, log=print, concurrency=0):
+    '''Semeia uma escala, mede os endpoints e retorna o resultado da escala.'''
+    t0 = time.perf_counter()
+    houses = seed(devices, label=f'bench-{devices}')
+    seed_seconds = time.perf_counter() - t0
+    log(f'{devices} dispositivos semeados em {seed_seconds:.1f}s ({len(houses)} casas)')
+
+    results = {}
+    try:
+        for name, request in endpoint_requests(client, houses[0]).items():
+            if only and name not in only:
+                continue
+            results[name] = measure(request, iterations)
+            log(f'  {name}: p50={results[name]["p50_ms"]}ms p99={results[name]["p99_ms"]}ms '
+                f'{results[name]["throughput_rps"]} req/s {results[name]["queries_per_request"]} consultas')
+        if concurrency:
+            comparison = compare_async(houses[0], iterations, concurrency, only=only, log=log)
+    finally:
+        cleanup()
+
+    result = {'devices': devices, 'houses': len(houses), 'seed_seconds': round(seed_seconds, 2), 'endpoints': results}
+    if concurrency:
+        result['async_comparison'] = {'concurrency': concurrency, 'endpoints': comparison}
+    return result
@@ -0,0 +1,108 @@
+'''
+Caches usados pela app: um LRU em memória do processo e um adaptador para os
+caches compartilhados do Django (settings.CACHES), com a mesma interface.
+'''
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+# Valor usado nas configurações para escolher o LRU em memória
+LOCAL_BACKEND = 'local'
+
+_missing = object()
+
+
+class LRUCache:
+    '''Cache em memória com descarte do item menos usado recentemente (e, com 'ttl', após 'ttl' segundos).'''
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # chave -> (expira_em ou None, valor)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _missing)
+            if entry is not _missing and entry[0] is not None and entry[0] <= time.monotonic():
+                del self._data[key]
+                entry = _missing
+            if entry is _missing:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        return {'backend': LOCAL_BACKEND, 'size': len(self._data), 'maxsize': self.maxsize, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+class SharedCache:
+    '''Adaptador para um alias de settings.CACHES (ex.: Redis ou Memcached), compartilhado entre processos.'''
+
+    def __init__(self, alias, prefix, ttl=None):
+        self.alias = alias
+        self.prefix = prefix
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def _cache(self):
+        return caches[self.alias]
+
+    def _key(self, key):
+        return f'{self.prefix}:{key}'
+
+    def get(self, key, default=None):
+        value = self._cache.get(self._key(key), _missing)
+        if value is _missing:
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        # Sem 'ttl' não expira: as entradas são removidas por invalidação explícita
+        self._cache.set(self._key(key), value, timeout=self.ttl or None)
+
+    def delete(self, key):
+        self._cache.delete(self._key(key))
+
+    def stats(self):
+        return {'backend': self.alias, 'ttl': self.ttl, 'hits': self.hits, 'misses': self.misses}
+
+
+def build_cache(backend, maxsize, prefix, ttl=None):
+    '''
+    Cria o cache configurado: 'local' para o LRU em memória do processo ou o nome
+    de um alias de settings.CACHES para um backend compartilhado. Com 'ttl' (s) as
+    entradas expiram mesmo sem invalidação.
+    '''
+    if not backend or backend == LOCAL_BACKEND:
+        return LRUCache(maxsize, ttl=ttl)
+    return SharedCache(backend, prefix, ttl=ttl)
@@ -0,0 +1,84 @@
+'''
+Expressões cron de cinco campos usadas pelos gatilhos agendados (SceneTrigger).
+
+    minuto hora dia-do-mês mês dia-da-semana
+
+Cada campo aceita '*', números, listas (1,15), intervalos (1-5) e passos (*/10, 8-18/2).
+Dia da semana vai de 0 (domingo) a 6; 7 também é domingo. Como no cron, quando
+dia do mês e dia da semana são restritos, basta um dos dois coincidir.
+Os horários são interpretados no fuso de settings.TIME_ZONE.
+'''
+from datetime import datetime, timedelta
+
+from django.utils import timezone
+
+# (mínimo, máximo) de cada campo
+FIELD_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+
+# Limite da busca pelo próximo disparo (ex.: "30 de fevereiro" nunca acontece)
+MAX_SEARCH_DAYS = 366 * 5
+
+
+def _parse_field(text, low, high):
+    values = set()
+    try:
+        for part in text.split(','):
+            expression, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if expression == '*':
+                start, end = low, high
+            elif '-' in expression:
+                start, end = (int(value) for value in expression.split('-', 1))
+            else:
+                start = int(expression)
+                end = high if step != 1 else start
+            if step < 1 or start < low or end > high or start > end:
+                raise ValueError(text)
+            values.update(range(start, end + 1, step))
+    except ValueError:
+        raise ValueError(f'Campo "{text}" inválido: use "*", números de {low} a {high}, listas, intervalos e passos.') from None
+    return values
+
+
+class CronSchedule:
+    def __init__(self, expression):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError('A expressão cron deve ter 5 campos: minuto hora dia mês dia-da-semana.')
+        parsed = [_parse_field(field, low, high) for field, (low, high) in zip(fields, FIELD_RANGES)]
+
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = parsed
+        self.weekdays = {day % 7 for day in weekdays}
+        self.days_restricted = fields[2] != '*'
+        self.weekdays_restricted = fields[4] != '*'
+
+    def _day_matches(self, moment):
+        # isoweekday: segunda = 1 ... domingo = 7 -> domingo = 0
+        day_match = moment.day in self.days
+        weekday_match = moment.isoweekday() % 7 in self.weekdays
+        if self.days_restricted and self.weekdays_restricted:
+            return day_match or weekday_match
+        return day_match and weekday_match
+
+    def next_after(self, moment):
+        '''
+        Retorna o primeiro horário (aware) estritamente posterior a 'moment' que
+        satisfaz a expressão, ou None se não houver nenhum nos próximos anos.
+        '''
+        local = timezone.localtime(moment).replace(tzinfo=None, second=0, microsecond=0) + timedelta(minutes=1)
+        limit = local + timedelta(days=MAX_SEARCH_DAYS)
+
+        while local < limit:
+            if local.month not in self.months:
+                # Pula para o primeiro dia do mês seguinte
+                local = datetime(local.year + local.month // 12, local.month % 12 + 1, 1)
+            elif not self._day_matches(local):
+                local = datetime(local.year, local.month, local.day) + timedelta(days=1)
+            elif local.hour not in self.hours:
+                local = local.replace(minute=0) + timedelta(hours=1)
+            elif local.minute not in self.minutes:
+                local += timedelta(minutes=1)
+            else:
+                return timezone.make_aware(local)
+        return None
@@ -0,0 +1,294 @@
+'''
+Motor de execução de cenas em segundo plano.
+
+Uma requisição apenas cria um SceneRun e o entrega ao motor, que responde na hora.
+O motor mantém um único event loop asyncio em uma thread própria: cada execução é
+uma corrotina que dorme o 'interval' de cada ação com asyncio.sleep, então milhares
+de execuções esperando não ocupam nenhuma thread. Só o acesso ao banco roda em um
+pool pequeno de threads (SCENE_ENGINE_WORKERS).
+
+As execuções vivem na memória do processo. Para que uma execução interrompida por
+um reinício não fique 'queued'/'running' para sempre, o motor confirma as suas a
+cada SCENE_RUN_HEARTBEAT_SECONDS (SceneRun.heartbeat_at) e encerra como 'failed' as
+pendentes sem confirmação há SCENE_RUN_STALE_SECONDS (reap_stale_runs, também
+disponível no comando reap_scene_runs).
+
+submit() devolve um RunProgress, com o qual quem está no mesmo processo (ex.: os
+testes) espera os lotes e o fim da execução sem consultar o banco.
+'''
+import asyncio
+import logging
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import SceneRun
+from .plans import get_scene_plan
+from .services import apply_device_states, fold_scene_steps
+from .sharding import current_db, current_shard, fan_out, get_shards, use_shard
+
+logger = logging.getLogger(__name__)
+
+STALE_ERROR = 'Execução interrompida: o processo do motor de cenas parou antes de concluí-la.'
+
+
+class RunProgress:
+    '''Andamento de uma execução no motor deste processo, atualizado após cada commit.'''
+
+    def __init__(self):
+        self.steps_done = 0
+        self.finished = False
+        self._changed = threading.Condition()
+
+    def update(self, steps_done=None, finished=False):
+        with self._changed:
+            if steps_done is not None:
+                self.steps_done = steps_done
+            self.finished = self.finished or finished
+            self._changed.notify_all()
+
+    def wait(self, steps_done=None, timeout=None):
+        '''
+        Espera a execução aplicar 'steps_done' ações ou, sem 'steps_done', terminar
+        (concluída, cancelada, falha ou interrompida). Retorna False se o tempo acabar.
+        '''
+        def reached():
+            return self.finished or (steps_done is not None and self.steps_done >= steps_done)
+
+        with self._changed:
+            return self._changed.wait_for(reached, timeout)
+
+
+class SceneEngine:
+    def __init__(self, max_workers=4, heartbeat=30, stale_after=120):
+        self.max_workers = max_workers
+        self.heartbeat = heartbeat
+        self.stale_after = stale_after
+        self._loop = None
+        self._executor = None
+        self._thread = None
+        self._tasks = {}  # run_id -> (asyncio.Task, shard) (acessado apenas dentro do loop)
+        # run_id -> RunProgress, enquanto a execução roda ou alguém guarda o objeto
+        self._progress = weakref.WeakValueDictionary()
+        self._lock = threading.Lock()
+
+    def start(self):
+        '''Inicia o loop e o pool de threads na primeira execução enviada.'''
+        with self._lock:
+            if self._loop is not None:
+                return
+            self._executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='scene-engine')
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name='scene-engine-loop', daemon=True)
+            self._thread.start()
+            asyncio.run_coroutine_threadsafe(self._watchdog(), self._loop)
+
+    def stop(self):
+        '''Interrompe as execuções deste processo e encerra o loop (elas ficam para reap_stale_runs).'''
+        with self._lock:
+            if self._loop is None:
+                return
+            loop, self._loop = self._loop, None
+
+        async def shutdown():
+            tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(shutdown(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        self._thread.join()
+        loop.close()
+        self._executor.shutdown()
+
+    def submit(self, run_id, scene_id, shard=None):
+        '''Agenda a execução de um SceneRun já gravado no banco (no shard informado) e retorna seu RunProgress.'''
+        self.start()
+        progress = RunProgress()
+        with self._lock:
+            self._progress[run_id] = progress
+        self._loop.call_soon_threadsafe(self._spawn, run_id, scene_id, shard, progress)
+        return progress
+
+    def progress(self, run_id):
+        '''RunProgress de uma execução enviada a este motor (None se ela já terminou e ninguém o guardou).'''
+        with self._lock:
+            return self._progress.get(run_id)
+
+    def cancel(self, run_id):
+        '''Interrompe a execução se ela estiver rodando neste processo.'''
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel, run_id)
+
+    def _spawn(self, run_id, scene_id, shard, progress):
+        task = self._loop.create_task(self._run(run_id, scene_id, shard, progress))
+        self._tasks[run_id] = (task, shard)
+        task.add_done_callback(lambda _: self._tasks.pop(run_id, None))
+
+    def _cancel(self, run_id):
+        entry = self._tasks.get(run_id)
+        if entry is not None:
+            entry[0].cancel()
+
+    async def _db(self, shard, func, *args):
+        # Toda consulta roda no pool, nunca dentro do loop
+        return await self._loop.run_in_executor(self._executor, _in_db_thread, shard, func, *args)
+
+    async def _run(self, run_id, scene_id, shard, progress):
+        try:
+            steps = await self._db(shard, _start_run, run_id, scene_id)
+            if steps is None:
+                return  # cancelada antes de começar
+
+            # Cada lote (ações entre dois intervalos) vira um único UPDATE
+            steps_done = 0
+            for interval, states, count in fold_scene_steps(steps):
+                if interval:
+                    await asyncio.sleep(interval)
+                steps_done += count
+                # O lote só é aplicado se a execução ainda estiver rodando: o
+                # cancelamento pode ter vindo de outro processo
+                if not await self._db(shard, _apply_batch, run_id, steps_done, states):
+                    return
+                progress.update(steps_done)
+
+            await self._db(shard, _finish_run, run_id, SceneRun.COMPLETED, None)
+        except asyncio.CancelledError:
+            # O status 'cancelled' já foi gravado por quem pediu o cancelamento
+            pass
+        except Exception as e:
+            logger.exception('Falha ao executar o SceneRun %s', run_id)
+            await self._db(shard, _finish_run, run_id, SceneRun.FAILED, str(e))
+        finally:
+            progress.update(finished=True)
+
+    async def _watchdog(self):
+        '''Confirma as execuções deste processo e encerra as órfãs, a cada 'heartbeat' segundos.'''
+        while True:
+            live = {}
+            for run_id, (_, shard) in self._tasks.items():
+                live.setdefault(shard, []).append(run_id)
+            try:
+                for shard, run_ids in live.items():
+                    await self._db(shard, _heartbeat, run_ids)
+                reaped = await self._db(None, reap_stale_runs, self.stale_after)
+                if reaped:
+                    logger.warning('%s execuções de cena interrompidas marcadas como falhas', reaped)
+            except Exception:
+                logger.exception('Falha ao confirmar as execuções de cena')
+            await asyncio.sleep(self.heartbeat)
+
+
+def _in_db_thread(shard, func, *args):
+    close_old_connections()
+    try:
+        with use_shard(shard):
+            return func(*args)
+    finally:
+        close_old_connections()
+
+
+def _start_run(run_id, scene_id):
+    now = timezone.now()
+    started = SceneRun.objects.filter(pk=run_id, status=SceneRun.QUEUED).update(
+        status=SceneRun.RUNNING, started_at=now, heartbeat_at=now
+    )
+    if not started:
+        return None
+
+    plan = get_scene_plan(scene_id)
+    return plan.steps if plan is not None else ()
+
+
+def _apply_batch(run_id, steps_done, states):
+    '''Aplica um lote se a execução ainda estiver rodando; retorna False se ela foi cancelada ou encerrada.'''
+    with transaction.atomic(using=current_db()):
+        # O UPDATE do SceneRun vem antes e trava a linha: um cancelamento simultâneo
+        # espera o lote terminar ou impede que ele seja aplicado
+        running = SceneRun.objects.filter(pk=run_id, status=SceneRun.RUNNING).update(
+            steps_done=steps_done, heartbeat_at=timezone.now()
+        )
+        if running:
+            apply_device_states(states, existing=states)
+    return bool(running)
+
+
+def _heartbeat(run_ids):
+    SceneRun.objects.filter(pk__in=run_ids, status__in=SceneRun.PENDING_STATUSES).update(heartbeat_at=timezone.now())
+
+
+def _finish_run(run_id, status, error):
+    SceneRun.objects.filter(pk=run_id, status=SceneRun.RUNNING).update(
+        status=status, error=error, finished_at=timezone.now()
+    )
+
+
+def reap_stale_runs(stale_after):
+    '''
+    Marca como 'failed' as execuções pendentes que nenhum motor confirmou nos últimos
+    'stale_after' segundos (as na fila que nunca começaram contam a partir de created_at),
+    em todos os shards. Retorna a quantidade encerrada.
+    '''
+    def reap(alias):
+        now = timezone.now()
+        cutoff = now - timedelta(seconds=stale_after)
+        return SceneRun.objects.filter(status__in=SceneRun.PENDING_STATUSES).filter(
+            Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True, created_at__lt=cutoff)
+        ).update(status=SceneRun.FAILED, error=STALE_ERROR, finished_at=now)
+
+    return sum(fan_out(reap, get_shards()))
+
+
+def run_scene_now(scene_id, steps):
+    '''
+    Executa uma cena sem intervalos dentro da própria requisição.
+
+    As ações são reduzidas ao estado final de cada dispositivo e gravadas com um
+    único UPDATE, então o custo não depende da quantidade de ações.
+    '''
+    started_at = timezone.now()
+    with transaction.atomic(using=current_db()):
+        for _, states, _ in fold_scene_steps(steps):
+            apply_device_states(states, existing=states)
+        return SceneRun.objects.create(
+            scene_id=scene_id,
+            status=SceneRun.COMPLETED,
+            steps_done=len(steps),
+            steps_total=len(steps),
+            started_at=started_at,
+            finished_at=timezone.now(),
+        )
+
+
+def queue_scene_run(plan, trigger_id=None):
+    '''Cria o SceneRun de um plano e o entrega ao motor deste processo após o commit.'''
+    run = SceneRun.objects.create(scene_id=plan.scene_id, steps_total=len(plan.steps), trigger_id=trigger_id)
+
+    # O motor só recebe a execução depois do commit, para enxergar o SceneRun gravado
+    shard = current_shard()
+    transaction.on_commit(lambda: get_engine().submit(run.id, plan.scene_id, shard), using=current_db())
+    return run
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    '''Retorna o motor do processo atual, criando-o na primeira chamada.'''
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = SceneEngine(
+                max_workers=getattr(settings, 'SCENE_ENGINE_WORKERS', 4),
+                heartbeat=getattr(settings, 'SCENE_RUN_HEARTBEAT_SECONDS', 30),
+                stale_after=getattr(settings, 'SCENE_RUN_STALE_SECONDS', 120),
+            )
+        return _engine
@@ -0,0 +1,152 @@
+'''
+Publicação em tempo real das mudanças de estado dos dispositivos.
+
+Cada mudança de Device.activated vira um evento compacto
+{"device": id, "room": id, "house": id, "activated": bool} entregue aos clientes
+inscritos na casa ou no cômodo (ver a view device_events). A distribuição é feita
+em memória, sem consultas por cliente; o backend é trocado por DEVICE_EVENTS_BACKEND.
+'''
+import asyncio
+import threading
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+from .cache import LRUCache
+from .models import Device
+
+
+class Subscription:
+    '''Fila de eventos de um cliente, consumida dentro do event loop dele.'''
+
+    def __init__(self, loop, house_id=None, room_id=None, maxsize=1000):
+        self.loop = loop
+        self.house_id = house_id
+        self.room_id = room_id
+        self.queue = asyncio.Queue(maxsize)
+
+    def put(self, event):
+        # Roda dentro do loop do cliente; um cliente lento perde os eventos mais antigos
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    async def get(self):
+        return await self.queue.get()
+
+
+class InMemoryBroker:
+    '''Pub/sub em memória do processo, indexado por casa e por cômodo.'''
+
+    def __init__(self):
+        self._by_house = {}
+        self._by_room = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, house_id=None, room_id=None):
+        subscription = Subscription(asyncio.get_running_loop(), house_id=house_id, room_id=room_id)
+        index, key = self._index_for(subscription)
+        with self._lock:
+            index.setdefault(key, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        index, key = self._index_for(subscription)
+        with self._lock:
+            subscribers = index.get(key)
+            if subscribers is not None:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del index[key]
+
+    def has_subscribers(self):
+        return bool(self._by_house or self._by_room)
+
+    def publish(self, events):
+        for event in events:
+            with self._lock:
+                targets = list(self._by_house.get(event['house'], ())) + list(self._by_room.get(event['room'], ()))
+            for subscription in targets:
+                try:
+                    subscription.loop.call_soon_threadsafe(subscription.put, event)
+                except RuntimeError:
+                    # O loop do cliente já foi encerrado
+                    self.unsubscribe(subscription)
+
+    def _index_for(self, subscription):
+        if subscription.room_id is not None:
+            return self._by_room, subscription.room_id
+        return self._by_house, subscription.house_id
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+# device_id -> (room_id, house_id), para montar eventos sem consultar o banco a cada mudança
+_locations = LRUCache(maxsize=100_000)
+
+
+def get_broker():
+    global _broker
+    with _broker_lock:
+        if _broker is None:
+            backend = getattr(settings, 'DEVICE_EVENTS_BACKEND', 'automacao.events.InMemoryBroker')
+            _broker = import_string(backend)()
+        return _broker
+
+
+def forget_device_location(device_id):
+    _locations.delete(device_id)
+
+
+def forget_device_locations():
+    _locations.clear()
+
+
+def device_locations(device_ids):
+    '''Retorna {device_id: (room_id, house_id)}, consultando o banco só para os que não estão no cache.'''
+    locations = {}
+    missing = []
+    for device_id in device_ids:
+        location = _locations.get(device_id)
+        if location is None:
+            missing.append(device_id)
+        else:
+            locations[device_id] = location
+
+    if missing:
+        for device_id, room_id, house_id in Device.objects.filter(id__in=missing).values_list('id', 'room_id', 'room__house_id'):
+            locations[device_id] = (room_id, house_id)
+            _locations.set(device_id, (room_id, house_id))
+    return locations
+
+
+def publish_device_states(states, locations=None):
+    '''
+    Publica {device_id: activated} para os inscritos.
+    O cômodo e a casa de cada dispositivo só são buscados se houver alguém ouvindo
+    (ou se 'locations', de device_locations, já vier pronto).
+    '''
+    broker = get_broker()
+    if not states or not broker.has_subscribers():
+        return
+
+    if locations is None:
+        locations = device_locations(states)
+
+    broker.publish([
+        {'device': device_id, 'room': locations[device_id][0], 'house': locations[device_id][1], 'activated': activated}
+        for device_id, activated in states.items()
+        if device_id in locations
+    ])
+
+
+def publish_device(device):
+    '''Publica o estado atual de uma instância de Device (ex.: salva pelo admin ou por set_state).'''
+    broker = get_broker()
+    if not broker.has_subscribers():
+        return
+
+    location = (device.room_id, device.room.house_id)
+    _locations.set(device.pk, location)
+    broker.publish([{'device': device.pk, 'room': location[0], 'house': location[1], 'activated': device.activated}])
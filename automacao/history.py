@@ -0,0 +1,186 @@
+'''
+Histórico de estado dos dispositivos (DeviceStateEvent).
+
+As mudanças são acumuladas em memória e gravadas com bulk_create por uma thread
+em segundo plano, a cada DEVICE_HISTORY_BATCH_SIZE eventos ou DEVICE_HISTORY_FLUSH_MS
+milissegundos, então registrar um evento não acrescenta consultas à requisição.
+Os eventos ficam separados por shard e cada lote é gravado no shard do dispositivo.
+O tempo ligado por dispositivo é calculado inteiramente no banco (on_time_queryset).
+'''
+import atexit
+import logging
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import DateTimeField, DurationField, ExpressionWrapper, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest, Least
+from django.utils import timezone
+
+from .models import DeviceStateEvent
+from .sharding import current_db, fan_out, get_shards
+
+logger = logging.getLogger(__name__)
+
+
+class StateHistoryWriter:
+    '''
+    Buffer dos eventos de estado. Com flush_interval_ms <= 0 não há thread: cada
+    record() grava na hora, na transação atual (útil nos testes e em scripts). Depois
+    de stop() os registros também passam a ser gravados na hora.
+    '''
+
+    def __init__(self, batch_size=500, flush_interval_ms=1000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000
+        self._buffers = {}  # shard -> [DeviceStateEvent]
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def record(self, states, changed_at=None):
+        '''Enfileira {device_id: activated} para gravação em lote.'''
+        changed_at = changed_at or timezone.now()
+        events = [
+            DeviceStateEvent(device_id=device_id, activated=activated, changed_at=changed_at)
+            for device_id, activated in states.items()
+        ]
+        if self.flush_interval <= 0 or self._stopping.is_set():
+            DeviceStateEvent.objects.using(current_db()).bulk_create(events, batch_size=self.batch_size)
+            return
+
+        with self._lock:
+            self._buffers.setdefault(current_db(), []).extend(events)
+            self._pending += len(events)
+            full = self._pending >= self.batch_size
+            if self._thread is None:
+                self._start()
+        if full:
+            self._wakeup.set()
+
+    def flush(self):
+        '''Grava tudo o que está no buffer. Retorna a quantidade de eventos gravados.'''
+        with self._lock:
+            buffers, self._buffers, self._pending = self._buffers, {}, 0
+        for alias, events in buffers.items():
+            DeviceStateEvent.objects.using(alias).bulk_create(events, batch_size=self.batch_size)
+        return sum(len(events) for events in buffers.values())
+
+    def stop(self):
+        '''Encerra a thread e grava o que restou no buffer (também na saída do processo).'''
+        self._stopping.set()
+        self._wakeup.set()
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            atexit.unregister(self.stop)
+            thread.join(timeout=max(self.flush_interval, 1) * 5)
+        return self.flush()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._loop, name='device-history-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _loop(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Falha ao gravar o histórico de estado dos dispositivos')
+            finally:
+                # Com o pool de conexões, devolve a conexão enquanto a thread dorme
+                close_old_connections()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_history_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = StateHistoryWriter(
+                batch_size=getattr(settings, 'DEVICE_HISTORY_BATCH_SIZE', 500),
+                flush_interval_ms=getattr(settings, 'DEVICE_HISTORY_FLUSH_MS', 1000),
+            )
+        return _writer
+
+
+def stop_history_writer():
+    '''Para o writer atual; o próximo registro cria outro com as configurações vigentes.'''
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+
+def record_device_states(states):
+    get_history_writer().record(states)
+
+
+def on_time_queryset(start, end, events=None):
+    '''
+    Eventos "ligado" que cruzam o intervalo [start, end), anotados com 'on_time':
+    a parte de cada período ligado que cai dentro do intervalo.
+
+    O fim de cada período é a mudança seguinte do mesmo dispositivo (subconsulta
+    pelo índice device/changed_at); o último período fica aberto até 'end'.
+    Agregue com Sum('on_time') para obter o total, por dispositivo ou geral.
+    '''
+    if events is None:
+        events = DeviceStateEvent.objects.all()
+
+    next_change = DeviceStateEvent.objects.filter(
+        device_id=OuterRef('device_id'),
+        changed_at__gt=OuterRef('changed_at'),
+    ).order_by('changed_at').values('changed_at')[:1]
+
+    start_value = Value(start, output_field=DateTimeField())
+    end_value = Value(end, output_field=DateTimeField())
+
+    return (
+        events
+        .filter(changed_at__lt=end)
+        .annotate(next_change=Subquery(next_change, output_field=DateTimeField()))
+        .filter(Q(next_change__isnull=True) | Q(next_change__gt=start), activated=True)
+        .annotate(
+            period_start=Greatest('changed_at', start_value),
+            period_end=Least(Coalesce('next_change', end_value), end_value),
+        )
+        .annotate(on_time=ExpressionWrapper(F('period_end') - F('period_start'), output_field=DurationField()))
+    )
+
+
+def device_on_time(start, end, events=None):
+    '''Retorna {device_id: segundos ligado} no intervalo, agregado no banco.'''
+    totals = (
+        on_time_queryset(start, end, events)
+        .order_by()
+        .values('device_id')
+        .annotate(total=Sum('on_time'))
+        .values_list('device_id', 'total')
+    )
+    return {device_id: (total or timedelta()).total_seconds() for device_id, total in totals}
+
+
+def prune_device_history(older_than_days):
+    '''
+    Remove eventos mais antigos que o período de retenção, em todos os shards.
+    Retorna a quantidade removida.
+    '''
+    cutoff = timezone.now() - timedelta(days=older_than_days)
+
+    def prune(alias):
+        # Sem sinais nem dependentes, o Django faz um único DELETE ... WHERE changed_at < cutoff
+        deleted, _ = DeviceStateEvent.objects.filter(changed_at__lt=cutoff).delete()
+        return deleted
+
+    return sum(fan_out(prune, get_shards()))
@@ -0,0 +1,249 @@
+'''
+Comandos repetidos pelos gateways: chaves de idempotência e coalescência.
+
+- Idempotency-Key: a primeira resposta (status < 500) de um POST com o cabeçalho fica
+  guardada por IDEMPOTENCY_TTL segundos sob "método:caminho:chave". Uma repetição
+  recebe a mesma resposta (com Idempotent-Replayed: true) sem tocar no banco; a mesma
+  chave com outro corpo recebe 422. O armazenamento é o LRU em memória ou um alias
+  de CACHES (IDEMPOTENCY_CACHE), como nos outros caches da app.
+- Repetições que chegam enquanto a primeira ainda está rodando esperam por ela
+  (SingleFlight) em vez de executar de novo. O mesmo vale, com ou sem chave, para
+  comandos set_state idênticos (mesmo dispositivo, estado e If-Match) simultâneos:
+  uma escrita só, com o resultado dividido entre as requisições.
+
+A espera vale dentro de um processo; entre processos, uma repetição simultânea à
+primeira (antes de a resposta ser guardada) ainda executa.
+'''
+import asyncio
+import hashlib
+import json
+import threading
+import time
+from collections import Counter, namedtuple
+from functools import partial, wraps
+
+from django.conf import settings
+from django.http import JsonResponse
+from rest_framework.response import Response
+
+from .cache import build_cache
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADER = 'Idempotent-Replayed'
+MAX_KEY_LENGTH = 255
+
+StoredResponse = namedtuple('StoredResponse', ['fingerprint', 'status', 'data', 'stored_at'])
+
+
+def fingerprint(body):
+    '''Resumo do corpo (bytes, ou os dados já interpretados pelo DRF) usado para comparar as repetições.'''
+    if not isinstance(body, bytes):
+        body = json.dumps(body, sort_keys=True, default=str).encode()
+    return hashlib.sha256(body).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(self, backend, ttl=86400):
+        self.backend = backend
+        self.ttl = ttl
+        self.stats_counter = Counter()
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is not None and time.time() - entry.stored_at > self.ttl:
+            self.backend.delete(key)
+            entry = None
+        return entry
+
+    def save(self, key, digest, status, data):
+        '''Guarda a resposta se ela for definitiva (status < 500) e a retorna como StoredResponse.'''
+        entry = StoredResponse(digest, status, data, time.time())
+        if status < 500:
+            self.backend.set(key, entry)
+        return entry
+
+    def replay(self, entry, digest, response_class):
+        '''Resposta de uma repetição, montada com response_class (Response ou JsonResponse).'''
+        if entry.fingerprint != digest:
+            self.stats_counter['mismatches'] += 1
+            return response_class(
+                {'error': f'A chave {IDEMPOTENCY_HEADER} já foi usada com outro corpo.'},
+                status=422
+            )
+        self.stats_counter['replays'] += 1
+        response = response_class(entry.data, status=entry.status)
+        response[REPLAYED_HEADER] = 'true'
+        return response
+
+    def stats(self):
+        return {
+            'ttl': self.ttl,
+            'replays': self.stats_counter['replays'],
+            'mismatches': self.stats_counter['mismatches'],
+            'backend': self.backend.stats(),
+        }
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''
+    Executa uma só vez as chamadas simultâneas com a mesma chave: a primeira roda,
+    as outras esperam e recebem o mesmo resultado (ou a mesma exceção).
+    do() serve a threads; ado() a corrotinas do mesmo event loop.
+    '''
+
+    def __init__(self):
+        self.executed = 0
+        self.coalesced = 0
+        self._calls = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        '''Retorna (resultado, compartilhado); compartilhado é True para quem esperou.'''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def ado(self, key, fn):
+        '''
+        Versão assíncrona de do(): fn é uma função que retorna uma corrotina. Ela roda
+        em uma tarefa própria, esperada por todos com shield: cancelar quem a iniciou
+        (ex.: o cliente desconectou) não cancela a escrita nem quem espera por ela.
+        '''
+        task = self._futures.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = self._futures[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(partial(self._forget, key))
+            self.executed += 1
+        return await asyncio.shield(task), shared
+
+    def _forget(self, key, task):
+        if self._futures.get(key) is task:
+            del self._futures[key]
+        if not task.cancelled():
+            # Marca a exceção como lida mesmo sem ninguém esperando
+            task.exception()
+
+    def stats(self):
+        return {'executed': self.executed, 'coalesced': self.coalesced}
+
+
+_store = None
+_flight = SingleFlight()
+
+
+def get_idempotency_store():
+    global _store
+    if _store is None:
+        _store = IdempotencyStore(
+            build_cache(
+                getattr(settings, 'IDEMPOTENCY_CACHE', 'local'),
+                getattr(settings, 'IDEMPOTENCY_CACHE_SIZE', 10000),
+                prefix='automacao:idempotency',
+            ),
+            ttl=getattr(settings, 'IDEMPOTENCY_TTL', 86400),
+        )
+    return _store
+
+
+def get_singleflight():
+    return _flight
+
+
+def _request_key(request):
+    '''(chave no armazenamento, erro): chave None sem o cabeçalho.'''
+    key = request.headers.get(IDEMPOTENCY_HEADER)
+    if key is None:
+        return None, None
+    if not key.strip() or len(key) > MAX_KEY_LENGTH:
+        return None, {IDEMPOTENCY_HEADER: [f'Informe uma chave de 1 a {MAX_KEY_LENGTH} caracteres.']}
+    return f'{request.method}:{request.path}:{key}', None
+
+
+def idempotent(action):
+    '''Aplica Idempotency-Key a uma action de viewset do DRF (colocar abaixo de @action).'''
+    @wraps(action)
+    def wrapper(view, request, *args, **kwargs):
+        key, error = _request_key(request)
+        if error is not None:
+            return Response(error, status=400)
+        if key is None:
+            return action(view, request, *args, **kwargs)
+
+        store = get_idempotency_store()
+        digest = fingerprint(request.data)
+        own = []
+
+        def run():
+            entry = store.get(key)
+            if entry is None:
+                response = action(view, request, *args, **kwargs)
+                own.append(response)
+                entry = store.save(key, digest, response.status_code, response.data)
+            return entry
+
+        entry, _ = get_singleflight().do(('idempotency', key), run)
+        if own:
+            return own[0]
+        return store.replay(entry, digest, Response)
+    return wrapper
+
+
+def aidempotent(view):
+    '''Versão de idempotent() para as views assíncronas do Django (JsonResponse).'''
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        key, error = _request_key(request)
+        if error is not None:
+            return JsonResponse(error, status=400)
+        if key is None:
+            return await view(request, *args, **kwargs)
+
+        store = get_idempotency_store()
+        digest = fingerprint(request.body)
+        own = []
+
+        async def run():
+            entry = store.get(key)
+            if entry is None:
+                response = await view(request, *args, **kwargs)
+                own.append(response)
+                entry = store.save(key, digest, response.status_code, json.loads(response.content))
+            return entry
+
+        entry, _ = await get_singleflight().ado(('idempotency', key), run)
+        if own:
+            return own[0]
+        return store.replay(entry, digest, JsonResponse)
+    return wrapper
@@ -0,0 +1,61 @@
+import json
+import platform
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.utils import timezone
+
+from automacao.benchmark import cleanup, run_scale
+
+
+class Command(BaseCommand):
+    help = (
+        'Semeia dados sintéticos em várias escalas e mede latência (percentis), vazão e '
+        'consultas por requisição dos principais endpoints da API.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--scales',
+            default='1000,10000,100000',
+            help='Quantidades de dispositivos separadas por vírgula. Padrão: 1000,10000,100000.',
+        )
+        parser.add_argument('--iterations', type=int, default=100, help='Requisições medidas por endpoint.')
+        parser.add_argument('--endpoints', default='', help='Mede apenas estes endpoints (separados por vírgula).')
+        parser.add_argument(
+            '--async-concurrency',
+            type=int,
+            default=0,
+            help='Compara as rotas do DRF (WSGI) com as de /api/async/ (ASGI) com estas requisições simultâneas. 0 desliga.',
+        )
+        parser.add_argument('--output', default='bench_output.json', help='Arquivo JSON com os resultados.')
+
+    def handle(self, *args, **options):
+        scales = [int(scale) for scale in options['scales'].split(',') if scale.strip()]
+        only = {name.strip() for name in options['endpoints'].split(',') if name.strip()}
+
+        # Remove sobras de uma execução interrompida
+        cleanup()
+
+        client = Client()
+        results = []
+        with override_settings(ALLOWED_HOSTS=['testserver']):
+            for devices in scales:
+                results.append(run_scale(
+                    client, devices, options['iterations'], only=only, log=self.stdout.write,
+                    concurrency=options['async_concurrency'],
+                ))
+
+        report = {
+            'created_at': timezone.now().isoformat(),
+            'database': connection.vendor,
+            'python': platform.python_version(),
+            'iterations': options['iterations'],
+            'scales': results,
+        }
+        with open(options['output'], 'w') as output:
+            json.dump(report, output, indent=2)
+
+        self.stdout.write(self.style.SUCCESS(f'Resultados gravados em {options["output"]}'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from automacao.models import House
+from automacao.sharding import shard_for_house
+from automacao.transfer import export_house
+
+
+class Command(BaseCommand):
+    help = 'Exporta uma casa inteira (cômodos, dispositivos, cenas, ações e gatilhos) em NDJSON.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('house_id', type=int, help='Id da casa.')
+        parser.add_argument('--output', default='-', help='Arquivo de saída. Padrão: - (saída padrão).')
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=2000,
+            help='Linhas lidas do banco por vez. Padrão: 2000.',
+        )
+
+    def handle(self, *args, **options):
+        house_id = options['house_id']
+        using = shard_for_house(house_id)
+        if not House.objects.using(using).filter(pk=house_id).exists():
+            raise CommandError(f'A casa {house_id} não existe.')
+
+        lines = export_house(house_id, using=using, chunk_size=options['chunk_size'])
+        if options['output'] == '-':
+            for line in lines:
+                self.stdout.write(line, ending='')
+            return
+
+        with open(options['output'], 'w', encoding='utf-8') as output:
+            output.writelines(lines)
+        self.stderr.write(self.style.SUCCESS(f'Casa {house_id} exportada para {options["output"]}'))
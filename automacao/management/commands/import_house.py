@@ -0,0 +1,58 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from automacao.models import House
+from automacao.sharding import HouseMoving, check_writable, place_new_house, shard_for_house, use_shard
+from automacao.transfer import InvalidImport, import_house
+
+
+class Command(BaseCommand):
+    help = (
+        'Cria uma casa (ou acrescenta a uma existente, com --house) a partir de um arquivo NDJSON '
+        'gerado por export_house. Nada é gravado se alguma linha for inválida.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='Arquivo NDJSON, ou - para a entrada padrão.')
+        parser.add_argument('--house', type=int, help='Id da casa que recebe os objetos.')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Linhas por INSERT. Padrão: 1000.',
+        )
+
+    def handle(self, *args, **options):
+        house_id = options['house']
+        if house_id is None:
+            shard = place_new_house()
+        else:
+            shard = shard_for_house(house_id)
+            try:
+                check_writable(house_id)
+            except HouseMoving:
+                raise CommandError(f'A casa {house_id} está sendo movida de banco. Tente novamente em instantes.')
+
+        with use_shard(shard):
+            house = None
+            if house_id is not None:
+                house = House.objects.filter(pk=house_id).first()
+                if house is None:
+                    raise CommandError(f'A casa {house_id} não existe.')
+
+            lines = sys.stdin if options['file'] == '-' else open(options['file'], encoding='utf-8')
+            try:
+                summary = import_house(lines, house=house, batch_size=options['batch_size'])
+            except InvalidImport as e:
+                for error in e.errors:
+                    self.stderr.write(f'Linha {error["line"]}: {error["error"]}' if error['line'] else error['error'])
+                raise CommandError(str(e))
+            finally:
+                if lines is not sys.stdin:
+                    lines.close()
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Casa {summary["house"]}: {summary["rooms"]} cômodos, {summary["devices"]} dispositivos, '
+            f'{summary["scenes"]} cenas, {summary["actions"]} ações e {summary["triggers"]} gatilhos importados.'
+        ))
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from automacao.sharding import move_house
+
+
+class Command(BaseCommand):
+    help = 'Move uma casa e tudo abaixo dela para outro shard (escritas na casa recebem 503 durante a cópia).'
+
+    def add_arguments(self, parser):
+        parser.add_argument('house_id', type=int, help='Id da casa.')
+        parser.add_argument('target', help='Alias do shard de destino (ver DB_SHARDS).')
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Linhas copiadas por INSERT. Padrão: 1000.',
+        )
+
+    def handle(self, *args, **options):
+        try:
+            move_house(options['house_id'], options['target'], batch_size=options['batch_size'], log=self.stdout.write)
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Casa {options["house_id"]} movida para {options["target"]}.'))
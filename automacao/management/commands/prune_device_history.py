@@ -0,0 +1,21 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from automacao.history import prune_device_history
+from automacao.sharding import get_shards
+
+
+class Command(BaseCommand):
+    help = 'Remove do histórico de estado (em todos os shards) os eventos mais antigos que o período de retenção.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=settings.DEVICE_HISTORY_RETENTION_DAYS,
+            help='Idade máxima (em dias) dos eventos mantidos. Padrão: DEVICE_HISTORY_RETENTION_DAYS.',
+        )
+
+    def handle(self, *args, **options):
+        deleted = prune_device_history(options['days'])
+        self.stdout.write(self.style.SUCCESS(f'{deleted} eventos removidos em {len(get_shards())} shard(s).'))
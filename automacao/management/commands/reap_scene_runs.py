@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from automacao.engine import reap_stale_runs
+
+
+class Command(BaseCommand):
+    help = 'Marca como falhas as execuções de cena pendentes cujo processo parou (ex.: após um reinício).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stale-seconds',
+            type=int,
+            default=settings.SCENE_RUN_STALE_SECONDS,
+            help='Tempo (s) sem confirmação do motor para uma execução ser considerada órfã. Padrão: SCENE_RUN_STALE_SECONDS.',
+        )
+
+    def handle(self, *args, **options):
+        reaped = reap_stale_runs(options['stale_seconds'])
+        self.stdout.write(self.style.SUCCESS(f'{reaped} execuções encerradas.'))
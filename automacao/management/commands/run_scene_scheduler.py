@@ -0,0 +1,23 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from automacao.triggers import TriggerScheduler
+
+
+class Command(BaseCommand):
+    help = 'Executa o agendador dos gatilhos de cena (deve haver um único processo rodando).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--reload-seconds',
+            type=int,
+            default=settings.SCENE_TRIGGER_RELOAD_SECONDS,
+            help='Intervalo (s) para verificar gatilhos novos ou alterados. Padrão: SCENE_TRIGGER_RELOAD_SECONDS.',
+        )
+
+    def handle(self, *args, **options):
+        scheduler = TriggerScheduler(reload_interval=options['reload_seconds'])
+        try:
+            scheduler.run_forever(log=self.stdout.write)
+        except KeyboardInterrupt:
+            self.stdout.write('Agendador encerrado.')
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0002_scene_house'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SceneRun',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('queued', 'Na fila'), ('running', 'Executando'), ('completed', 'Concluída'), ('cancelled', 'Cancelada'), ('failed', 'Falhou')], default='queued', max_length=20)),
+                ('steps_done', models.PositiveIntegerField(default=0)),
+                ('steps_total', models.PositiveIntegerField(default=0)),
+                ('error', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('started_at', models.DateTimeField(blank=True, null=True)),
+                ('finished_at', models.DateTimeField(blank=True, null=True)),
+                ('heartbeat_at', models.DateTimeField(blank=True, null=True)),
+                ('scene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='runs', to='automacao.scene')),
+            ],
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:21
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def rename_duplicates(model, parent, max_length):
+    '''
+    Renomeia os nomes repetidos (sem diferenciar maiúsculas) dentro do mesmo pai:
+    o mais antigo fica como está e os seguintes recebem " (2)", " (3)"...
+    '''
+    taken = {}
+    duplicates = []
+    for obj in model.objects.order_by(parent, 'id').only('id', parent, 'name'):
+        names = taken.setdefault(getattr(obj, parent), set())
+        if obj.name.lower() in names:
+            duplicates.append(obj)
+        else:
+            names.add(obj.name.lower())
+
+    for obj in duplicates:
+        names = taken[getattr(obj, parent)]
+        suffix = 2
+        while True:
+            tail = f' ({suffix})'
+            name = obj.name[:max_length - len(tail)] + tail
+            if name.lower() not in names:
+                break
+            suffix += 1
+        names.add(name.lower())
+        model.objects.filter(pk=obj.pk).update(name=name)
+
+
+def fix_duplicates(apps, schema_editor):
+    '''Antes das restrições: nomes repetidos e ordens repetidas já gravados impediriam a migração.'''
+    rename_duplicates(apps.get_model('automacao', 'Room'), 'house_id', 100)
+    rename_duplicates(apps.get_model('automacao', 'Device'), 'room_id', 100)
+    rename_duplicates(apps.get_model('automacao', 'Scene'), 'house_id', 100)
+
+    # Cenas com ordens repetidas têm as ações renumeradas de 1 a n, mantendo a sequência (ordem, id)
+    SceneAction = apps.get_model('automacao', 'SceneAction')
+    scenes = (
+        SceneAction.objects.values('scene_id', 'order').annotate(count=models.Count('id'))
+        .filter(count__gt=1).values_list('scene_id', flat=True).distinct()
+    )
+    for scene_id in set(scenes):
+        actions = list(SceneAction.objects.filter(scene_id=scene_id).order_by('order', 'id'))
+        for position, action in enumerate(actions, start=1):
+            action.order = position
+        SceneAction.objects.bulk_update(actions, ['order'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0003_scenerun'),
+    ]
+
+    operations = [
+        migrations.RunPython(fix_duplicates, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='house',
+            index=models.Index(fields=['owner'], name='house_owner_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='device',
+            constraint=models.UniqueConstraint(models.F('room'), django.db.models.functions.text.Lower('name'), name='unique_device_name_per_room'),
+        ),
+        migrations.AddConstraint(
+            model_name='room',
+            constraint=models.UniqueConstraint(models.F('house'), django.db.models.functions.text.Lower('name'), name='unique_room_name_per_house'),
+        ),
+        migrations.AddConstraint(
+            model_name='scene',
+            constraint=models.UniqueConstraint(models.F('house'), django.db.models.functions.text.Lower('name'), name='unique_scene_name_per_house'),
+        ),
+        migrations.AddConstraint(
+            model_name='sceneaction',
+            constraint=models.UniqueConstraint(fields=('scene', 'order'), name='unique_action_order_per_scene'),
+        ),
+    ]
@@ -0,0 +1,26 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:21
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0004_unique_names_and_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceStateEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('activated', models.BooleanField()),
+                ('changed_at', models.DateTimeField()),
+                ('device', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='state_events', to='automacao.device')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['device', 'changed_at'], name='state_event_device_time_idx'), models.Index(fields=['changed_at'], name='state_event_time_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0005_devicestateevent'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='house',
+            name='version',
+            field=models.PositiveBigIntegerField(default=0, editable=False),
+        ),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:32
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0006_house_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SceneTrigger',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('schedule', 'Agenda'), ('device_state', 'Estado de dispositivo')], max_length=20)),
+                ('cron', models.CharField(blank=True, default='', max_length=100)),
+                ('state', models.BooleanField(blank=True, null=True)),
+                ('enabled', models.BooleanField(default=True)),
+                ('last_fired_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('device', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='triggers', to='automacao.device')),
+                ('scene', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='triggers', to='automacao.scene')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='scenerun',
+            name='trigger',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='runs', to='automacao.scenetrigger'),
+        ),
+        migrations.AddConstraint(
+            model_name='scenetrigger',
+            constraint=models.CheckConstraint(condition=models.Q(models.Q(('kind', 'schedule'), models.Q(('cron', ''), _negated=True)), models.Q(('device__isnull', False), ('kind', 'device_state'), ('state__isnull', False)), _connector='OR'), name='scene_trigger_kind_fields'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0008_device_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HouseShard',
+            fields=[
+                ('house_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=100)),
+                ('status', models.CharField(choices=[('active', 'Ativa'), ('moving', 'Em migração')], default='active', max_length=20)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['shard'], name='house_shard_idx')],
+            },
+        ),
+    ]
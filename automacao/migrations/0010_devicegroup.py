@@ -0,0 +1,30 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:01
+
+import django.db.models.deletion
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('automacao', '0009_houseshard'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeviceGroup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('kind', models.CharField(choices=[('static', 'Estático'), ('dynamic', 'Dinâmico')], default='static', max_length=20)),
+                ('name_pattern', models.CharField(blank=True, default='', max_length=100)),
+                ('devices', models.ManyToManyField(blank=True, related_name='groups', to='automacao.device')),
+                ('house', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='device_groups', to='automacao.house')),
+                ('room', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='device_groups', to='automacao.room')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(models.F('house'), django.db.models.functions.text.Lower('name'), name='unique_group_name_per_house')],
+            },
+        ),
+    ]
@@ -0,0 +1,303 @@
+import hashlib
+from contextlib import ExitStack
+
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.utils.http import parse_etags
+from rest_framework import status
+from rest_framework.permissions import SAFE_METHODS
+from rest_framework.response import Response
+
+from .models import House
+from .replicas import allow_replica_reads, get_replicas, is_pinned, pin_response
+from .responses import get_response_cache
+from .sharding import (
+    HouseMoving, check_writable, current_shard, is_sharded, locate_house, place_new_house, shard_for_house, use_shard,
+)
+from .writebehind import get_state_buffer
+
+
+class SparseFieldsetMixin:
+    '''
+    Permite ao cliente escolher os campos das respostas de leitura.
+
+    - ?fields=id,name devolve apenas esses campos (os aninhados, como 'devices' e
+      'actions', ficam de fora e não são nem consultados)
+    - ?expand=devices inclui de volta um campo aninhado junto com 'fields'
+
+    Sem 'fields' a resposta continua completa.
+    '''
+
+    def get_requested_fields(self):
+        request = getattr(self, 'request', None)
+        if request is None or request.method != 'GET':
+            return None
+
+        fields = request.query_params.get('fields')
+        if not fields:
+            return None
+
+        requested = {name.strip() for name in fields.split(',') if name.strip()}
+        requested |= {name.strip() for name in request.query_params.get('expand', '').split(',') if name.strip()}
+        return requested
+
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields()
+        if fields is not None:
+            kwargs.setdefault('fields', fields)
+        return super().get_serializer(*args, **kwargs)
+
+
+class QueryPlanMixin:
+    '''
+    Aplica o plano de consulta declarado pela viewset.
+
+    Cada viewset declara o que o seu serializer vai percorrer:
+    - select_related_fields: chaves estrangeiras carregadas com JOIN
+    - prefetch_fields: relações reversas carregadas em uma consulta extra (Prefetch),
+      indexadas pelo campo do serializer que as usa
+    - annotate_fields: contagens calculadas no banco (Count) e lidas pelo serializer
+
+    Assim o número de consultas de uma listagem não depende da quantidade de linhas.
+    Com SparseFieldsetMixin, prefetches e anotações de campos não pedidos são pulados.
+    '''
+    select_related_fields = ()
+    prefetch_fields = {}
+    annotate_fields = {}
+
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        requested = None
+        if hasattr(self, 'get_requested_fields'):
+            requested = self.get_requested_fields()
+
+        prefetches = [
+            prefetch for field, prefetch in self.prefetch_fields.items()
+            if requested is None or field in requested
+        ]
+        annotations = {
+            field: annotation for field, annotation in self.annotate_fields.items()
+            if requested is None or field in requested
+        }
+
+        if self.select_related_fields:
+            queryset = queryset.select_related(*self.select_related_fields)
+        if prefetches:
+            queryset = queryset.prefetch_related(*prefetches)
+        if annotations:
+            queryset = queryset.annotate(**annotations)
+
+        return queryset
+
+
+class ConditionalGetMixin:
+    '''
+    Responde leituras com ETag derivado do contador de versão da casa (House.version).
+
+    Com If-None-Match igual ao ETag atual a resposta é 304, depois de uma única
+    consulta da versão e antes de qualquer consulta às tabelas ou serialização.
+    No modo write-behind o ETag inclui também as escritas da casa ainda só em
+    memória (DeviceStateBuffer.generation), que não incrementaram a versão.
+    Cada viewset declara como chegar à casa:
+    - etag_house_path: caminho de House até o model da viewset (detalhe)
+    - etag_list_filters: parâmetro da listagem -> caminho de House até o objeto filtrado
+    Listagens sem um desses filtros não recebem ETag.
+    '''
+    etag_house_path = None
+    etag_list_filters = {}
+
+    def list(self, request, *args, **kwargs):
+        for param, path in self.etag_list_filters.items():
+            value = request.query_params.get(param)
+            if value:
+                houses = House.objects.filter(**{path: value})
+                return self._conditional(request, houses, super().list, request, *args, **kwargs)
+        return super().list(request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        lookup = kwargs[self.lookup_url_kwarg or self.lookup_field]
+        houses = House.objects.filter(**{self.etag_house_path: lookup})
+        return self._conditional(request, houses, super().retrieve, request, *args, **kwargs)
+
+    def _conditional(self, request, houses, respond, *args, **kwargs):
+        try:
+            version = houses.values_list('pk', 'version').first()
+        except (ValueError, DjangoValidationError):
+            version = None  # parâmetro inválido: a própria view responde com o erro
+
+        if version is None:
+            return respond(*args, **kwargs)
+
+        raw = f'{request.get_full_path()}|{version[0]}|{version[1]}'
+        buffer = get_state_buffer()
+        if buffer is not None:
+            raw += f'|{buffer.generation(version[0])}'
+        etag = '"%s"' % hashlib.md5(raw.encode(), usedforsecurity=False).hexdigest()
+
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = respond(*args, **kwargs)
+        if response.status_code in (status.HTTP_200_OK, status.HTTP_304_NOT_MODIFIED):
+            response['ETag'] = etag
+        return response
+
+
+class ResponseCacheMixin:
+    '''
+    Guarda as respostas de leitura da viewset no cache de respostas (automacao.responses).
+
+    Cacheia o detalhe e a listagem filtrada por casa (?house=); a chave inclui o
+    caminho completo, então ?fields=, ?expand= e o cursor têm entradas próprias.
+    Um acerto devolve os dados e o ETag guardados sem consultar o banco (também
+    para If-None-Match). O detalhe só entra no cache depois que a casa do objeto
+    é conhecida, a partir da primeira leitura dele. As respostas guardadas são
+    montadas no primário, nunca em uma réplica atrasada.
+    Com o cache local a chave inclui House.version, lida antes do cache (uma
+    consulta); uma casa que não existe não passa pelo cache.
+    Deve vir antes de ConditionalGetMixin nas bases da viewset.
+    '''
+    response_cache_kind = None
+
+    def list(self, request, *args, **kwargs):
+        try:
+            house_id = int(request.query_params['house'])
+        except (KeyError, ValueError):
+            return super().list(request, *args, **kwargs)
+
+        cache = get_response_cache()
+        found, version = self._house_version(cache, house_id)
+        if not found:
+            return super().list(request, *args, **kwargs)
+        key = cache.list_key(self.response_cache_kind, house_id, request.get_full_path(), version)
+        return self._cached(request, cache, key, house_id, super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        try:
+            pk = int(kwargs[self.lookup_url_kwarg or self.lookup_field])
+        except ValueError:
+            return super().retrieve(request, *args, **kwargs)
+
+        cache = get_response_cache()
+        house_id = cache.house_of(self.response_cache_kind, pk)
+        if house_id is None:
+            response = super().retrieve(request, *args, **kwargs)
+            if response.status_code == status.HTTP_200_OK:
+                cache.remember_house(self.response_cache_kind, pk, self.response_cache_house_id)
+            return response
+
+        found, version = self._house_version(cache, house_id)
+        if not found:
+            return super().retrieve(request, *args, **kwargs)
+        key = cache.detail_key(self.response_cache_kind, pk, house_id, request.get_full_path(), version)
+        return self._cached(request, cache, key, house_id, super().retrieve, request, *args, **kwargs)
+
+    def get_object(self):
+        obj = super().get_object()
+        self.response_cache_house_id = obj.house_id
+        return obj
+
+    def _house_version(self, cache, house_id):
+        '''(encontrada, versão) da casa; a versão só é consultada se o cache precisar dela.'''
+        if not cache.keyed_on_version:
+            return True, None
+        version = House.objects.filter(pk=house_id).values_list('version', flat=True).first()
+        return version is not None, version
+
+    def _cached(self, request, cache, key, house_id, respond, *args, **kwargs):
+        entry = cache.get(self.response_cache_kind, key)
+        if entry is not None:
+            data, etag = entry
+            if etag and etag in parse_etags(request.headers.get('If-None-Match', '')):
+                response = Response(status=status.HTTP_304_NOT_MODIFIED)
+            else:
+                response = Response(data)
+            if etag:
+                response['ETag'] = etag
+            return response
+
+        with allow_replica_reads(False):
+            response = respond(*args, **kwargs)
+        if response.status_code == status.HTTP_200_OK:
+            actual_house_id = getattr(self, 'response_cache_house_id', house_id)
+            if actual_house_id == house_id:
+                cache.set(key, response.data, response.get('ETag'))
+            else:
+                # O objeto mudou de casa: a chave foi montada com as gerações da casa antiga
+                cache.remember_house(self.response_cache_kind, int(kwargs[self.lookup_url_kwarg or self.lookup_field]), actual_house_id)
+        return response
+
+
+class ShardRoutingMixin:
+    '''
+    Escolhe o banco da requisição antes de qualquer consulta.
+
+    Leituras (GET/HEAD/OPTIONS) vão para as réplicas (automacao.replicas), a não ser
+    que o cliente tenha escrito há menos de REPLICA_PIN_SECONDS; escritas bem-sucedidas
+    renovam essa marca. O shard (automacao.sharding) vem:
+    - detalhe: pelo id do objeto
+    - listagens e criações: pelo primeiro parâmetro de shard_parent_fields presente
+      na query string ou no corpo (nome -> model do objeto apontado)
+    - criação de casa: o shard com menos casas
+    Listagens sem nenhum desses parâmetros consultam todos os shards em paralelo e
+    juntam as páginas (IdCursorPagination.paginate_sharded).
+    Escritas em uma casa que está sendo movida de shard recebem 503.
+    Sem shards extras nem réplicas configurados nada disso roda. Deve ser a primeira base da viewset.
+    '''
+    shard_parent_fields = {}
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self._routing = ExitStack()
+        if request.method in SAFE_METHODS and get_replicas() and not is_pinned(request):
+            self._routing.enter_context(allow_replica_reads())
+        if not is_sharded():
+            return
+
+        house_id = self.get_shard_house(request, kwargs)
+        if house_id is not None:
+            shard = shard_for_house(house_id)
+            if request.method not in SAFE_METHODS:
+                check_writable(house_id)
+        elif request.method == 'POST' and self.queryset.model is House and 'pk' not in kwargs:
+            shard = place_new_house()
+        else:
+            return
+        self._routing.enter_context(use_shard(shard))
+
+    def get_shard_house(self, request, kwargs):
+        '''Id da casa que a requisição acessa, ou None se não for possível saber.'''
+        lookup = kwargs.get(self.lookup_url_kwarg or self.lookup_field)
+        if lookup is not None:
+            return locate_house(self.queryset.model, lookup) if str(lookup).isdigit() else None
+
+        data = request.data if isinstance(request.data, dict) else {}
+        for field, model in self.shard_parent_fields.items():
+            value = request.query_params.get(field, data.get(field))
+            if value is not None and str(value).isdigit():
+                return locate_house(model, value)
+        return None
+
+    def paginate_queryset(self, queryset):
+        if self.paginator is not None and current_shard() is None and is_sharded():
+            return self.paginator.paginate_sharded(queryset, self.request, view=self)
+        return super().paginate_queryset(queryset)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, HouseMoving):
+            response = Response(
+                {'error': f'A casa {exc.house_id} está sendo movida de banco. Tente novamente em instantes.'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE
+            )
+            response['Retry-After'] = '5'
+            return response
+        return super().handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        routing = getattr(self, '_routing', None)
+        if routing is not None:
+            self._routing = None
+            routing.close()
+        if request.method not in SAFE_METHODS and response.status_code < 400 and get_replicas():
+            pin_response(response)
+        return super().finalize_response(request, response, *args, **kwargs)
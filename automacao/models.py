@@ -1,9 +1,19 @@
+import re
+
 from django.db import models
+from django.db.models import F
+from django.db.models.functions import Lower
 
 class House(models.Model):
     name = models.CharField(max_length=255)
     address = models.CharField(max_length=255)
     owner = models.CharField(max_length=100)
+    # Incrementado a cada escrita na casa ou abaixo dela (automacao.versions); usado nos ETags
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+
+    class Meta:
+        # Sustenta o filtro ?owner= da HouseViewSet
+        indexes = [models.Index(fields=['owner'], name='house_owner_idx')]
 
     def __str__(self):
         return self.name
@@ -12,6 +22,12 @@ class Room(models.Model):
     name = models.CharField(max_length=100)
     house = models.ForeignKey(House, on_delete=models.CASCADE, related_name='rooms')
 
+    class Meta:
+        # Nome único por casa, sem diferenciar maiúsculas (validado pelo banco)
+        constraints = [
+            models.UniqueConstraint(F('house'), Lower('name'), name='unique_room_name_per_house'),
+        ]
+
     def __str__(self):
         return f"{self.name} - {self.house.name}"
     
@@ -20,6 +36,14 @@ class Device(models.Model):
     room = models.ForeignKey(Room, on_delete=models.CASCADE, related_name='devices')
     description = models.TextField(blank=True, null=True)
     activated = models.BooleanField(default=False)
+    # Incrementado a cada escrita no dispositivo; as escritas condicionais (If-Match) comparam com ele
+    version = models.PositiveBigIntegerField(default=0, editable=False)
+
+    class Meta:
+        # Nome único por cômodo, sem diferenciar maiúsculas (validado pelo banco)
+        constraints = [
+            models.UniqueConstraint(F('room'), Lower('name'), name='unique_device_name_per_room'),
+        ]
 
     def __str__(self):
         return f"{self.name} in {self.room.name}"
@@ -29,6 +53,12 @@ class Scene(models.Model):
     activated = models.BooleanField(default=True)
     house = models.ForeignKey(House, on_delete=models.CASCADE, related_name='scenes')
 
+    class Meta:
+        # Nome único por casa, sem diferenciar maiúsculas (validado pelo banco)
+        constraints = [
+            models.UniqueConstraint(F('house'), Lower('name'), name='unique_scene_name_per_house'),
+        ]
+
     def __str__(self):
         return self.name
 
@@ -42,9 +72,182 @@ class SceneAction(models.Model):
     # Garante que as ações sejam ordenadas pelo campo 'order'
     class Meta:
         ordering = ['order']
+        # Uma posição por cena; o índice (scene, order) também atende o filtro ?scene=
+        constraints = [
+            models.UniqueConstraint(fields=['scene', 'order'], name='unique_action_order_per_scene'),
+        ]
 
     def __str__(self):
         return f"Action {self.order} - Set to {self.newState} after {self.interval}s"
-    
-    
 
+
+class SceneRun(models.Model):
+    '''Execução de uma cena feita em segundo plano pelo motor de cenas (automacao.engine)'''
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    COMPLETED = 'completed'
+    CANCELLED = 'cancelled'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (QUEUED, 'Na fila'),
+        (RUNNING, 'Executando'),
+        (COMPLETED, 'Concluída'),
+        (CANCELLED, 'Cancelada'),
+        (FAILED, 'Falhou'),
+    ]
+    # Estados em que a execução ainda pode ser cancelada
+    PENDING_STATUSES = [QUEUED, RUNNING]
+
+    scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name='runs')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=QUEUED)
+    steps_done = models.PositiveIntegerField(default=0)
+    steps_total = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(blank=True, null=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    # Última confirmação do motor de que a execução segue viva (ver automacao.engine.reap_stale_runs)
+    heartbeat_at = models.DateTimeField(blank=True, null=True)
+    # Gatilho que iniciou a execução (vazio para execuções pela API)
+    trigger = models.ForeignKey('SceneTrigger', on_delete=models.SET_NULL, blank=True, null=True, related_name='runs')
+
+    def __str__(self):
+        return f"Run {self.id} of {self.scene_id} - {self.status}"
+
+
+class SceneTrigger(models.Model):
+    '''
+    Disparo automático de uma cena (automacao.triggers):
+    - schedule: em uma agenda cron (ex.: "30 7 * * 1-5")
+    - device_state: quando 'device' muda para 'state'
+    '''
+    SCHEDULE = 'schedule'
+    DEVICE_STATE = 'device_state'
+    KIND_CHOICES = [
+        (SCHEDULE, 'Agenda'),
+        (DEVICE_STATE, 'Estado de dispositivo'),
+    ]
+
+    scene = models.ForeignKey(Scene, on_delete=models.CASCADE, related_name='triggers')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    cron = models.CharField(max_length=100, blank=True, default='')
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, blank=True, null=True, related_name='triggers')
+    state = models.BooleanField(blank=True, null=True)
+    enabled = models.BooleanField(default=True)
+    last_fired_at = models.DateTimeField(blank=True, null=True)
+    # Usado pelo agendador para perceber gatilhos novos ou alterados
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                condition=(
+                    models.Q(kind='schedule') & ~models.Q(cron='')
+                ) | (
+                    models.Q(kind='device_state', device__isnull=False, state__isnull=False)
+                ),
+                name='scene_trigger_kind_fields',
+            ),
+        ]
+
+    def __str__(self):
+        if self.kind == self.SCHEDULE:
+            return f"{self.scene_id} at '{self.cron}'"
+        return f"{self.scene_id} when {self.device_id} -> {self.state}"
+
+
+
+class DeviceGroup(models.Model):
+    '''
+    Grupo de dispositivos de uma casa, alvo de comandos em lote (ex.: "luzes do 2º andar"):
+    - static: os dispositivos escolhidos em 'devices'
+    - dynamic: os dispositivos da casa que atendem aos filtros preenchidos: 'room' e
+      'name_pattern' (curingas * e ?, sem diferenciar maiúsculas); sem filtros, a casa toda
+    A pertinência é resolvida no banco (members), nunca carregando os dispositivos.
+    '''
+    STATIC = 'static'
+    DYNAMIC = 'dynamic'
+    KIND_CHOICES = [
+        (STATIC, 'Estático'),
+        (DYNAMIC, 'Dinâmico'),
+    ]
+
+    name = models.CharField(max_length=100)
+    house = models.ForeignKey(House, on_delete=models.CASCADE, related_name='device_groups')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES, default=STATIC)
+    devices = models.ManyToManyField(Device, blank=True, related_name='groups')
+    room = models.ForeignKey(Room, on_delete=models.CASCADE, blank=True, null=True, related_name='device_groups')
+    name_pattern = models.CharField(max_length=100, blank=True, default='')
+
+    class Meta:
+        # Nome único por casa, sem diferenciar maiúsculas (validado pelo banco)
+        constraints = [
+            models.UniqueConstraint(F('house'), Lower('name'), name='unique_group_name_per_house'),
+        ]
+
+    def __str__(self):
+        return f"{self.name} ({self.kind}) - {self.house_id}"
+
+    @staticmethod
+    def pattern_regex(pattern):
+        '''Expressão regular equivalente ao padrão com curingas (* e ?), para o lookup iregex.'''
+        return '^' + ''.join('.*' if char == '*' else '.' if char == '?' else re.escape(char) for char in pattern) + '$'
+
+    def members(self):
+        '''Queryset dos dispositivos do grupo, para ser usado como subconsulta.'''
+        if self.kind == self.STATIC:
+            return Device.objects.filter(groups=self)
+        devices = Device.objects.filter(room__house_id=self.house_id)
+        if self.room_id is not None:
+            devices = devices.filter(room_id=self.room_id)
+        if self.name_pattern:
+            devices = devices.filter(name__iregex=self.pattern_regex(self.name_pattern))
+        return devices
+
+
+class DeviceStateEvent(models.Model):
+    '''
+    Histórico append-only das mudanças de estado dos dispositivos.
+    Gravado em lote pelo automacao.history e podado por idade (prune_device_history).
+    '''
+    # Sem chave estrangeira no banco: os eventos chegam em lote e não podem falhar
+    # por um dispositivo removido nesse meio tempo
+    device = models.ForeignKey(Device, on_delete=models.CASCADE, related_name='state_events', db_constraint=False)
+    activated = models.BooleanField()
+    changed_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['device', 'changed_at'], name='state_event_device_time_idx'),
+            models.Index(fields=['changed_at'], name='state_event_time_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.device_id} -> {self.activated} at {self.changed_at}"
+
+
+class HouseShard(models.Model):
+    '''
+    Diretório de casas: em qual shard (alias de DATABASES) ficam cada casa e tudo abaixo dela.
+    Fica sempre no banco 'default' (ver automacao.sharding).
+    '''
+    ACTIVE = 'active'
+    MOVING = 'moving'
+    STATUS_CHOICES = [
+        (ACTIVE, 'Ativa'),
+        (MOVING, 'Em migração'),
+    ]
+
+    # Sem chave estrangeira: a casa pode estar em outro banco
+    house_id = models.BigIntegerField(primary_key=True)
+    shard = models.CharField(max_length=100)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=ACTIVE)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard'], name='house_shard_idx'),
+        ]
+
+    def __str__(self):
+        return f"House {self.house_id} on {self.shard} ({self.status})"
@@ -0,0 +1,54 @@
+from rest_framework.pagination import CursorPagination
+
+from .sharding import fan_out
+
+
+class IdCursorPagination(CursorPagination):
+    '''
+    Paginação por cursor (keyset) na chave primária.
+    Diferente do OFFSET, o custo de cada página não cresce com a profundidade.
+    O tamanho padrão vem de REST_FRAMEWORK['PAGE_SIZE'] e pode ser ajustado com ?page_size=.
+    '''
+    ordering = 'id'
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+
+    def paginate_sharded(self, queryset, request, view=None):
+        '''
+        Pagina a mesma consulta em todos os shards, em paralelo, e junta as páginas.
+        Cada shard devolve até page_size linhas a partir do cursor; como os ids são
+        únicos entre shards (automacao.sharding), a página final são as primeiras
+        page_size linhas na ordem do id e o cursor continua valendo para todos.
+        '''
+        def paginate(alias):
+            # fan_out já escolheu o shard; o roteador decide entre o primário e uma réplica
+            paginator = type(self)()
+            paginator.paginate_queryset(queryset.all(), request, view)
+            return paginator
+
+        paginators = fan_out(paginate)
+        # Cursor, tamanho e base_url são iguais em todos; parte do estado do primeiro
+        vars(self).update(vars(paginators[0]))
+        # As posições só são definidas pelos shards que têm página seguinte/anterior
+        for name in ('next_position', 'previous_position'):
+            setattr(self, name, next((getattr(p, name) for p in paginators if hasattr(p, name)), None))
+
+        rows = sorted(
+            (row for paginator in paginators for row in paginator.page),
+            key=lambda row: row.pk, reverse=self.ordering[0].startswith('-'),
+        )
+        overflow = len(rows) > self.page_size
+        if self.cursor and self.cursor.reverse:
+            # Cursor "anterior": as páginas vêm das linhas logo antes da posição
+            self.page = rows[-self.page_size:]
+            self.has_previous = overflow or any(paginator.has_previous for paginator in paginators)
+        else:
+            self.page = rows[:self.page_size]
+            self.has_next = overflow or any(paginator.has_next for paginator in paginators)
+        self.display_page_controls = self.has_previous or self.has_next
+        return self.page
+
+
+class RecentFirstCursorPagination(IdCursorPagination):
+    '''Mesma paginação, com os registros mais recentes primeiro.'''
+    ordering = '-id'
@@ -0,0 +1,75 @@
+'''
+Plano compilado de uma cena: tudo o que a execução precisa, sem consultar o banco.
+
+Cenas mudam pouco e executam o tempo todo (sensores de presença, agendamentos),
+então o plano fica em cache por id da cena e é invalidado pelos sinais em
+automacao.signals e pelas escritas em lote de set_scene_actions.
+
+A invalidação só alcança o cache do processo que fez a escrita. Com o LRU local
+('local') e vários processos, os outros continuam com o plano antigo até ele expirar
+(SCENE_PLAN_CACHE_TTL); com um alias compartilhado de CACHES a mudança vale para
+todos na hora.
+'''
+from collections import namedtuple
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+from .cache import build_cache
+from .models import Scene, SceneAction
+
+# steps: tupla ordenada de (device_id, newState, interval)
+ScenePlan = namedtuple('ScenePlan', ['scene_id', 'house_id', 'name', 'activated', 'steps'])
+
+_cache = None
+
+
+def get_plan_cache():
+    global _cache
+    if _cache is None:
+        _cache = build_cache(
+            getattr(settings, 'SCENE_PLAN_CACHE', 'local'),
+            getattr(settings, 'SCENE_PLAN_CACHE_SIZE', 1024),
+            prefix='automacao:scene-plan',
+            ttl=getattr(settings, 'SCENE_PLAN_CACHE_TTL', 30),
+        )
+    return _cache
+
+
+def compile_scene_plan(scene_id):
+    '''Monta o plano da cena a partir do banco. Retorna None se a cena não existir.'''
+    scene = Scene.objects.filter(pk=scene_id).values('id', 'house_id', 'name', 'activated').first()
+    if scene is None:
+        return None
+
+    steps = tuple(
+        SceneAction.objects.filter(scene_id=scene_id)
+        .order_by('order')
+        .values_list('device_id', 'newState', 'interval')
+    )
+    return ScenePlan(scene['id'], scene['house_id'], scene['name'], scene['activated'], steps)
+
+
+def get_scene_plan(scene_id):
+    '''Retorna o plano da cena, compilando e guardando no cache quando necessário.'''
+    cache = get_plan_cache()
+    plan = cache.get(scene_id)
+    if plan is None:
+        plan = compile_scene_plan(scene_id)
+        if plan is not None:
+            cache.set(scene_id, plan)
+    return plan
+
+
+async def aget_scene_plan(scene_id):
+    '''Versão assíncrona de get_scene_plan: um acerto no cache não sai do event loop.'''
+    plan = get_plan_cache().get(scene_id)
+    if plan is None:
+        plan = await sync_to_async(get_scene_plan)(scene_id)
+    return plan
+
+
+def invalidate_scene_plan(*scene_ids):
+    cache = get_plan_cache()
+    for scene_id in scene_ids:
+        cache.delete(scene_id)
@@ -0,0 +1,47 @@
+'''
+Estatísticas das conexões de cada banco configurado (shards e réplicas).
+
+Com o pool do psycopg (OPTIONS['pool'] em settings.DATABASES) os números vêm do
+próprio pool deste processo:
+- in_use / idle / size: conexões emprestadas, livres e abertas
+- waiting: requisições esperando uma conexão agora
+- checkouts / checkout_wait_ms: empréstimos desde o início e o tempo médio de espera
+  por um deles, que cresce quando POOL_MAX_SIZE é pequeno para a carga
+- timeouts / errors: esperas que passaram de POOL_TIMEOUT e conexões perdidas
+Sem pool, só a configuração de conexões persistentes (CONN_MAX_AGE).
+'''
+from django.db import connections
+
+
+def database_pool_stats():
+    stats = {}
+    for alias in connections:
+        connection = connections[alias]
+        pool = getattr(connection, 'pool', None) if connection.settings_dict.get('OPTIONS', {}).get('pool') else None
+        if pool is None:
+            stats[alias] = {
+                'pooled': False,
+                'vendor': connection.vendor,
+                'conn_max_age': connection.settings_dict.get('CONN_MAX_AGE', 0),
+            }
+            continue
+
+        raw = pool.get_stats()
+        size = raw.get('pool_size', 0)
+        idle = raw.get('pool_available', 0)
+        checkouts = raw.get('requests_num', 0)
+        stats[alias] = {
+            'pooled': True,
+            'vendor': connection.vendor,
+            'min_size': raw.get('pool_min'),
+            'max_size': raw.get('pool_max'),
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'waiting': raw.get('requests_waiting', 0),
+            'checkouts': checkouts,
+            'checkout_wait_ms': round(raw.get('requests_wait_ms', 0) / checkouts, 3) if checkouts else 0.0,
+            'timeouts': raw.get('requests_errors', 0),
+            'errors': raw.get('connections_errors', 0) + raw.get('connections_lost', 0),
+        }
+    return stats
@@ -0,0 +1,294 @@
+'''
+Perfil das requisições (opcional, ligado por PROFILING_SAMPLE_RATE > 0).
+
+O ProfilingMiddleware sorteia uma fração das requisições e, para cada uma, mede:
+- tempo total
+- consultas ao banco: quantidade e tempo, em todos os bancos e threads da requisição
+  (inclusive fan_out entre shards e o ORM assíncrono)
+- tempo de serialização (SparseFieldsModelSerializer.to_representation)
+- tamanho do corpo da resposta
+- consultas repetidas: o mesmo SQL executado DUPLICATE_QUERY_THRESHOLD vezes ou mais,
+  o sinal típico de um N+1
+
+Os números vão no cabeçalho Server-Timing da resposta e nos histogramas por endpoint
+devolvidos em /api/metrics/. O contador de consultas só fica nas conexões durante
+as requisições sorteadas (record_queries); as demais custam um random().
+'''
+import bisect
+import logging
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Execuções do mesmo SQL (com parâmetros diferentes ou não) a partir das quais a requisição é marcada
+DUPLICATE_QUERY_THRESHOLD = 3
+
+# Limites superiores (ms) das faixas dos histogramas de tempo total
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+# Limites superiores das faixas dos histogramas de consultas por requisição
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+_current = ContextVar('automacao_profile', default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_ms = 0.0
+        self.serializer_ms = 0.0
+        self.statements = Counter()
+        self._serializing = 0
+        self._lock = threading.Lock()
+
+    def add_query(self, sql, ms):
+        with self._lock:
+            self.queries += 1
+            self.db_ms += ms
+            self.statements[sql] += 1
+
+    def duplicates(self):
+        '''{sql: execuções} dos comandos repetidos DUPLICATE_QUERY_THRESHOLD vezes ou mais.'''
+        return {sql: count for sql, count in self.statements.items() if count >= DUPLICATE_QUERY_THRESHOLD}
+
+    def server_timing(self, total_ms):
+        duplicates = self.duplicates()
+        parts = [
+            f'total;dur={total_ms:.1f}',
+            f'db;dur={self.db_ms:.1f};desc="{self.queries} queries"',
+            f'serializer;dur={self.serializer_ms:.1f}',
+        ]
+        if duplicates:
+            parts.append(f'dup;desc="{sum(duplicates.values())} repeated queries"')
+        return ', '.join(parts)
+
+
+def _record_query(execute, sql, params, many, context):
+    profile = _current.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    t0 = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.add_query(sql, (time.perf_counter() - t0) * 1000)
+
+
+def _install():
+    '''Instala o contador nas conexões da thread atual; retorna as que foram alteradas.'''
+    installed = []
+    for connection in connections.all():
+        if _record_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(_record_query)
+            installed.append(connection)
+    return installed
+
+
+def _uninstall(installed):
+    for connection in installed:
+        connection.execute_wrappers.remove(_record_query)
+
+
+@contextmanager
+def record_queries():
+    '''
+    Soma ao perfil da requisição (se ela foi sorteada) as consultas feitas dentro do
+    bloco pelas conexões da thread atual. Fora do bloco as conexões ficam intactas.
+    '''
+    if _current.get() is None:
+        yield
+        return
+    installed = _install()
+    try:
+        yield
+    finally:
+        _uninstall(installed)
+
+
+@contextmanager
+def profile_serialization():
+    '''Soma o tempo do bloco ao perfil da requisição; serializações aninhadas contam uma vez.'''
+    profile = _current.get()
+    if profile is None:
+        yield
+        return
+    profile._serializing += 1
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile._serializing -= 1
+        if not profile._serializing:
+            profile.serializer_ms += (time.perf_counter() - t0) * 1000
+
+
+class Histogram:
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+
+    def percentile(self, pct):
+        '''Limite superior da faixa que contém o percentil (None na última faixa, sem limite).'''
+        target = pct / 100 * sum(self.counts)
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if count and seen >= target:
+                return bound
+        return None
+
+    def as_dict(self):
+        labels = [f'le_{bound}' for bound in self.bounds] + ['inf']
+        return dict(zip(labels, self.counts))
+
+
+class EndpointStats:
+    def __init__(self):
+        self.requests = 0
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.total_ms = 0.0
+        self.query_count = 0
+        self.db_ms = 0.0
+        self.serializer_ms = 0.0
+        self.response_bytes = 0
+        self.with_duplicates = 0
+        self.duplicate_sql = Counter()
+
+    def add(self, profile, total_ms, size):
+        duplicates = profile.duplicates()
+        self.requests += 1
+        self.latency.add(total_ms)
+        self.queries.add(profile.queries)
+        self.total_ms += total_ms
+        self.query_count += profile.queries
+        self.db_ms += profile.db_ms
+        self.serializer_ms += profile.serializer_ms
+        self.response_bytes += size or 0
+        if duplicates:
+            self.with_duplicates += 1
+            self.duplicate_sql.update(duplicates.keys())
+
+    def as_dict(self):
+        return {
+            'requests': self.requests,
+            'mean_ms': round(self.total_ms / self.requests, 3),
+            'p50_ms': self.latency.percentile(50),
+            'p99_ms': self.latency.percentile(99),
+            'mean_db_ms': round(self.db_ms / self.requests, 3),
+            'mean_serializer_ms': round(self.serializer_ms / self.requests, 3),
+            'mean_queries': round(self.query_count / self.requests, 2),
+            'mean_response_bytes': round(self.response_bytes / self.requests),
+            'requests_with_duplicate_queries': self.with_duplicates,
+            'duplicate_queries': [sql[:200] for sql, _ in self.duplicate_sql.most_common(3)],
+            'latency_ms': self.latency.as_dict(),
+            'queries': self.queries.as_dict(),
+        }
+
+
+class Profiler:
+    '''Histogramas por endpoint ("MÉTODO nome-da-rota") das requisições sorteadas deste processo.'''
+
+    def __init__(self):
+        self.endpoints = {}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, profile, total_ms, size):
+        with self._lock:
+            if endpoint not in self.endpoints:
+                self.endpoints[endpoint] = EndpointStats()
+            self.endpoints[endpoint].add(profile, total_ms, size)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'sample_rate': getattr(settings, 'PROFILING_SAMPLE_RATE', 0),
+                'endpoints': {endpoint: stats.as_dict() for endpoint, stats in sorted(self.endpoints.items())},
+            }
+
+    def clear(self):
+        with self._lock:
+            self.endpoints = {}
+
+
+_profiler = Profiler()
+
+
+def get_profiler():
+    return _profiler
+
+
+class ProfilingMiddleware:
+    '''
+    Mede uma fração (PROFILING_SAMPLE_RATE) das requisições; desligado com 0.
+    Deve ficar no topo de MIDDLEWARE para o tempo total incluir os outros middlewares.
+    '''
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if random.random() >= self.sample_rate:
+            return self.get_response(request)
+        token = _current.set(RequestProfile())
+        try:
+            with record_queries():
+                response = self.get_response(request)
+            return self.finish(request, response)
+        finally:
+            _current.reset(token)
+
+    async def __acall__(self, request):
+        if random.random() >= self.sample_rate:
+            return await self.get_response(request)
+        token = _current.set(RequestProfile())
+        # As consultas do ORM assíncrono rodam na thread de sync_to_async da requisição
+        # (a mesma para todas as chamadas dela); o contador é instalado e removido lá
+        try:
+            installed = await sync_to_async(_install)()
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(_uninstall)(installed)
+            return self.finish(request, response)
+        finally:
+            _current.reset(token)
+
+    def finish(self, request, response):
+        profile = _current.get()
+        total_ms = (time.perf_counter() - profile.started) * 1000
+        size = None if response.streaming else len(response.content)
+        match = request.resolver_match
+        endpoint = f'{request.method} {match.view_name if match else "unresolved"}'
+
+        duplicates = profile.duplicates()
+        if duplicates:
+            sql, count = max(duplicates.items(), key=lambda item: item[1])
+            logger.warning('%s: consulta repetida %s vezes (%s): %s', endpoint, count, request.path, sql[:200])
+
+        get_profiler().record(endpoint, profile, total_ms, size)
+        response['Server-Timing'] = profile.server_timing(total_ms)
+        return response
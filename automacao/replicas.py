@@ -0,0 +1,171 @@
+'''
+Réplicas de leitura dos shards (settings.AUTOMACAO_REPLICAS: shard -> [aliases]).
+
+- Só leituras de requisições seguras (GET/HEAD/OPTIONS) vão às réplicas, liberadas
+  por allow_replica_reads() (ShardRoutingMixin); motor, gatilhos e comandos leem do primário.
+- As réplicas saudáveis de um shard se revezam (round-robin). Cada uma é verificada
+  a cada REPLICA_CHECK_SECONDS: falha de conexão ou atraso acima de REPLICA_MAX_LAG
+  a tira do revezamento até a próxima verificação boa. Sem réplicas saudáveis, lê do primário.
+- Leitura das próprias escritas: a requisição que escreveu marca o cliente com um
+  cookie, e por REPLICA_PIN_SECONDS as leituras dele continuam no primário. Dentro
+  da mesma requisição, qualquer escrita também leva as leituras seguintes ao primário.
+'''
+import itertools
+import logging
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Cookie com o instante (epoch) até o qual as leituras do cliente ficam no primário
+PIN_COOKIE = 'automacao_pin'
+
+_reads = ContextVar('automacao_replica_reads', default=False)
+
+# Atraso de replicação no Postgres; 0 quando a réplica já aplicou tudo o que recebeu
+POSTGRES_LAG_SQL = (
+    'SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 '
+    'ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) END'
+)
+
+
+def get_replicas():
+    return getattr(settings, 'AUTOMACAO_REPLICAS', {})
+
+
+def primary_of(alias):
+    '''Shard (primário) de uma réplica; outros aliases voltam inalterados.'''
+    for shard, replicas in get_replicas().items():
+        if alias in replicas:
+            return shard
+    return alias
+
+
+@contextmanager
+def allow_replica_reads(allowed=True):
+    token = _reads.set(allowed)
+    try:
+        yield
+    finally:
+        _reads.reset(token)
+
+
+def replica_reads_allowed():
+    return _reads.get()
+
+
+def pin_to_primary():
+    '''Leva ao primário as leituras seguintes do contexto atual (chamado a cada escrita).'''
+    if _reads.get():
+        _reads.set(False)
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def pin_response(response):
+    '''Marca o cliente para ler do primário durante REPLICA_PIN_SECONDS.'''
+    seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+    response.set_cookie(PIN_COOKIE, f'{time.time() + seconds:.3f}', max_age=max(1, int(seconds + 0.999)), httponly=True, samesite='Lax')
+
+
+class ReplicaPool:
+    def __init__(self, check_interval=5, max_lag=2):
+        self.check_interval = check_interval
+        self.max_lag = max_lag
+        self.reads = Counter()
+        self._health = {}  # alias -> (saudável, atraso, verificado_em)
+        self._cycles = {}
+        self._lock = threading.Lock()
+
+    def choose(self, shard):
+        '''Réplica saudável do shard para a próxima leitura, ou o próprio shard.'''
+        replicas = get_replicas().get(shard)
+        if not replicas:
+            return shard
+        if shard not in self._cycles:
+            self._cycles[shard] = itertools.cycle(replicas)
+        cycle = self._cycles[shard]
+        for _ in replicas:
+            alias = next(cycle)
+            if self.is_healthy(alias):
+                self.reads[alias] += 1
+                return alias
+        self.reads[shard] += 1
+        return shard
+
+    def is_healthy(self, alias):
+        health = self._health.get(alias)
+        if health is None or time.monotonic() - health[2] > self.check_interval:
+            with self._lock:
+                health = self._health.get(alias)
+                # Só uma thread verifica; as outras usam o resultado anterior
+                if health is None or time.monotonic() - health[2] > self.check_interval:
+                    health = self.check(alias)
+        return health[0]
+
+    def check(self, alias):
+        '''Mede o atraso da réplica e atualiza a saúde dela.'''
+        connection = None
+        try:
+            connection = connections[alias]
+            with connection.cursor() as cursor:
+                if connection.vendor == 'postgresql':
+                    cursor.execute(POSTGRES_LAG_SQL)
+                    lag = float(cursor.fetchone()[0] or 0)
+                else:
+                    cursor.execute('SELECT 1')
+                    lag = 0.0
+        except Exception as e:
+            logger.warning('Réplica %s indisponível (%s); leituras vão para o primário', alias, e)
+            # Descarta a conexão quebrada para a próxima verificação reconectar
+            if connection is not None:
+                connection.close_if_unusable_or_obsolete()
+            health = (False, None, time.monotonic())
+        else:
+            if lag > self.max_lag:
+                logger.warning('Réplica %s com %.1fs de atraso; leituras vão para o primário', alias, lag)
+            health = (lag <= self.max_lag, lag, time.monotonic())
+        self._health[alias] = health
+        return health
+
+    def stats(self):
+        return {
+            alias: {
+                'shard': shard,
+                'healthy': self._health[alias][0] if alias in self._health else None,
+                'lag': self._health[alias][1] if alias in self._health else None,
+                'reads': self.reads[alias],
+            }
+            for shard, replicas in get_replicas().items() for alias in replicas
+        }
+
+
+_pool = None
+
+
+def get_replica_pool():
+    global _pool
+    if _pool is None:
+        _pool = ReplicaPool(
+            check_interval=getattr(settings, 'REPLICA_CHECK_SECONDS', 5),
+            max_lag=getattr(settings, 'REPLICA_MAX_LAG', 2),
+        )
+    return _pool
+
+
+def read_db(shard):
+    '''Alias para uma leitura no shard: uma réplica quando liberado no contexto atual.'''
+    if shard is not None and _reads.get() and get_replicas():
+        return get_replica_pool().choose(shard)
+    return shard
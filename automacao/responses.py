@@ -0,0 +1,181 @@
+'''
+Cache das respostas serializadas de cômodos e cenas (árvores com dispositivos e ações).
+
+Uma leitura em cache não toca no ORM nem no DRF: a chave é montada só com
+consultas ao cache e a resposta guardada é devolvida como está.
+
+As chaves carregam "gerações" (tokens aleatórios guardados no próprio cache):
+- do objeto, trocada quando ele ou algo abaixo dele muda
+- das listagens da casa, trocada junto com a de qualquer objeto da casa
+- da casa inteira, trocada quando um dado repetido em todas as respostas muda
+  (ex.: o nome de um cômodo aparece nas ações de todas as cenas da casa)
+- global (epoch), trocada por clear()
+Invalidar é trocar a geração; as entradas antigas ficam inalcançáveis e saem pelo
+LRU (ou pelo backend compartilhado). As gerações são lidas antes da consulta ao
+banco e trocadas após o commit, então uma resposta montada com dados antigos nunca
+fica guardada sob a geração nova.
+
+As gerações só valem entre processos com um alias compartilhado de CACHES. Com o
+LRU local ('local') cada processo tem as suas, e a escrita feita em outro processo
+não as troca: nesse caso a chave inclui também House.version (automacao.versions),
+lida com uma consulta pela chave primária a cada leitura, e o acerto deixa de ser
+sem banco, mas nunca devolve uma resposta anterior à última escrita na casa.
+'''
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.db import transaction
+
+from .cache import LRUCache, build_cache
+from .models import Room, Scene, SceneAction
+from .sharding import current_db
+
+ROOM = 'room'
+SCENE = 'scene'
+
+# Model de cada tipo, usado para descobrir a casa dos objetos invalidados só pelo id
+_models = {ROOM: Room, SCENE: Scene}
+
+_local = threading.local()
+
+
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        # Só o LRU local precisa da versão da casa na chave (ver o início do módulo)
+        self.keyed_on_version = isinstance(backend, LRUCache)
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def _generation(self, key):
+        token = self.backend.get(key)
+        if token is None:
+            token = uuid.uuid4().hex[:12]
+            self.backend.set(key, token)
+        return token
+
+    def _bump(self, key):
+        self.backend.set(key, uuid.uuid4().hex[:12])
+
+    def detail_key(self, kind, pk, house_id, path, version=None):
+        return ':'.join([
+            kind, str(pk), str(version),
+            self._generation('gen:epoch'),
+            self._generation(f'gen:{kind}:house:{house_id}'),
+            self._generation(f'gen:{kind}:{pk}'),
+            path,
+        ])
+
+    def list_key(self, kind, house_id, path, version=None):
+        return ':'.join([
+            kind, 'list', str(house_id), str(version),
+            self._generation('gen:epoch'),
+            self._generation(f'gen:{kind}:house:{house_id}'),
+            self._generation(f'gen:{kind}:list:{house_id}'),
+            path,
+        ])
+
+    def get(self, kind, key):
+        '''Retorna (data, etag) ou None.'''
+        entry = self.backend.get(key)
+        if entry is None:
+            self.misses[kind] += 1
+        else:
+            self.hits[kind] += 1
+        return entry
+
+    def set(self, key, data, etag=None):
+        self.backend.set(key, (data, etag))
+
+    def house_of(self, kind, pk):
+        return self.backend.get(f'{kind}:house-of:{pk}:{self._generation("gen:epoch")}')
+
+    def remember_house(self, kind, pk, house_id):
+        self.backend.set(f'{kind}:house-of:{pk}:{self._generation("gen:epoch")}', house_id)
+
+    def invalidate_objects(self, kind, objects):
+        '''Invalida os objetos ({id: house_id}) e as listagens das casas deles.'''
+        for pk, house_id in objects.items():
+            self._bump(f'gen:{kind}:{pk}')
+            if house_id is not None:
+                self._bump(f'gen:{kind}:list:{house_id}')
+
+    def invalidate_houses(self, kind, house_ids):
+        '''Invalida todas as respostas do tipo nas casas informadas.'''
+        for house_id in house_ids:
+            self._bump(f'gen:{kind}:house:{house_id}')
+
+    def clear(self):
+        self._bump('gen:epoch')
+
+    def stats(self):
+        kinds = sorted(set(self.hits) | set(self.misses))
+        return {
+            'hits': sum(self.hits.values()),
+            'misses': sum(self.misses.values()),
+            'by_kind': {kind: {'hits': self.hits[kind], 'misses': self.misses[kind]} for kind in kinds},
+            'backend': self.backend.stats(),
+        }
+
+
+_cache = None
+
+
+def get_response_cache():
+    global _cache
+    if _cache is None:
+        _cache = ResponseCache(build_cache(
+            getattr(settings, 'RESPONSE_CACHE', 'local'),
+            getattr(settings, 'RESPONSE_CACHE_SIZE', 10000),
+            prefix='automacao:responses',
+        ))
+    return _cache
+
+
+def _pending():
+    if not hasattr(_local, 'pending'):
+        _local.pending = {kind: {'objects': {}, 'houses': set(), 'devices': set()} for kind in _models}
+    return _local.pending
+
+
+def invalidate_responses(kind, objects=(), houses=(), devices=()):
+    '''
+    Marca respostas do tipo 'kind' (ROOM ou SCENE) como desatualizadas:
+    - objects: ids, ou {id: house_id} quando a casa já é conhecida; as listagens
+      das casas deles também são invalidadas
+    - houses: casas com todas as respostas do tipo invalidadas
+    - devices: só para SCENE, as cenas com ações nesses dispositivos
+    A invalidação acontece após o commit da transação atual (ou na hora, fora de uma).
+    '''
+    pending = _pending()[kind]
+    if not isinstance(objects, dict):
+        objects = dict.fromkeys(objects)
+    for pk, house_id in objects.items():
+        if house_id is not None or pk not in pending['objects']:
+            pending['objects'][pk] = house_id
+    pending['houses'].update(houses)
+    pending['devices'].update(devices)
+    transaction.on_commit(flush, using=current_db())
+
+
+def flush():
+    '''Aplica as invalidações pendentes. Casas desconhecidas são buscadas em uma consulta por tipo.'''
+    pending = _pending()
+    del _local.pending
+
+    cache = get_response_cache()
+    for kind, changes in pending.items():
+        objects = changes['objects']
+        if changes['devices']:
+            objects.update(
+                SceneAction.objects.filter(device_id__in=changes['devices'])
+                .order_by().values_list('scene_id', 'scene__house_id').distinct()
+            )
+        unknown = [pk for pk, house_id in objects.items() if house_id is None]
+        if unknown:
+            # Objetos já removidos não aparecem aqui; quem os remove informa a casa
+            objects.update(_models[kind].objects.filter(pk__in=unknown).values_list('pk', 'house_id'))
+        cache.invalidate_objects(kind, objects)
+        cache.invalidate_houses(kind, changes['houses'])
@@ -0,0 +1,53 @@
+from django.db import DEFAULT_DB_ALIAS
+
+from .replicas import get_replicas, pin_to_primary, primary_of, read_db
+from .sharding import current_shard, get_shards
+
+
+class ShardRouter:
+    '''
+    Encaminha os models da app automacao para o shard da requisição (automacao.sharding)
+    e, nas leituras liberadas, para uma réplica dele (automacao.replicas).
+
+    - Instâncias já carregadas continuam no banco de onde vieram (relações e prefetches);
+      escritas de instâncias lidas em uma réplica vão para o primário dela
+    - Sem shard no contexto, vale o 'default'
+    - O diretório HouseShard e as outras apps ficam só no 'default'
+    '''
+    app_label = 'automacao'
+
+    def _routed(self, model):
+        return model._meta.app_label == self.app_label and model._meta.model_name != 'houseshard'
+
+    def db_for_read(self, model, **hints):
+        if not self._routed(model):
+            return DEFAULT_DB_ALIAS if model._meta.app_label == self.app_label else None
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return instance._state.db
+        return read_db(current_shard() or DEFAULT_DB_ALIAS)
+
+    def db_for_write(self, model, **hints):
+        if not self._routed(model):
+            return DEFAULT_DB_ALIAS if model._meta.app_label == self.app_label else None
+        # Depois de uma escrita, as leituras da requisição enxergam o primário
+        pin_to_primary()
+        instance = hints.get('instance')
+        if instance is not None and instance._state.db:
+            return primary_of(instance._state.db)
+        return current_shard()
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if obj1._meta.app_label == self.app_label and obj2._meta.app_label == self.app_label:
+            return primary_of(obj1._state.db) == primary_of(obj2._state.db)
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if any(db in replicas for replicas in get_replicas().values()):
+            return False  # as réplicas recebem o esquema pela replicação
+        shards = get_shards()
+        if db not in shards:
+            return None
+        if app_label == self.app_label:
+            return model_name != 'houseshard' or db == DEFAULT_DB_ALIAS
+        return db == DEFAULT_DB_ALIAS
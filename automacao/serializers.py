@@ -1,14 +1,106 @@
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
 from rest_framework import serializers
-from .models import House, Room, Device, Scene, SceneAction
+from rest_framework.settings import api_settings
+from .cron import CronSchedule
+from .models import House, Room, Device, DeviceGroup, Scene, SceneAction, SceneRun, SceneTrigger
+from .profiling import profile_serialization
+from .services import VersionConflict, save_device_fields
+from .sharding import current_db
+from .writebehind import get_state_buffer
+
+
+class SparseFieldsModelSerializer(serializers.ModelSerializer):
+    '''
+    ModelSerializer que aceita o argumento 'fields' para devolver só parte dos campos
+    (usado pelo SparseFieldsetMixin das viewsets com ?fields= e ?expand=).
+    '''
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+    def to_representation(self, instance):
+        # Entra no tempo de serialização do perfil da requisição (automacao.profiling)
+        with profile_serialization():
+            return super().to_representation(instance)
 
 
-class DeviceSerializer(serializers.ModelSerializer):
+class UniqueNameModelSerializer(SparseFieldsModelSerializer):
+    '''
+    A unicidade do nome é garantida por uma UniqueConstraint no banco, sem um SELECT
+    antes de cada escrita; a violação vira um erro de validação no campo 'name'.
+    As subclasses definem unique_name_constraint e unique_name_error.
+    '''
+    unique_name_constraint = None
+    unique_name_error = None
+
+    def create(self, validated_data):
+        return self._save_unique_name(validated_data, super().create, validated_data)
+
+    def update(self, instance, validated_data):
+        return self._save_unique_name(validated_data, super().update, instance, validated_data)
+
+    def _save_unique_name(self, validated_data, save, *args):
+        try:
+            # O savepoint mantém a transação externa utilizável após a violação
+            with transaction.atomic(using=current_db()):
+                return save(*args)
+        except IntegrityError as e:
+            if self.unique_name_constraint not in str(e):
+                raise
+            name = validated_data.get('name', getattr(self.instance, 'name', ''))
+            # Mesmo formato dos erros de is_valid(): lista de mensagens por campo
+            raise serializers.ValidationError({'name': [self.unique_name_error.format(name=name)]})
+
+class DeviceSerializer(UniqueNameModelSerializer):
     room_name = serializers.CharField(source='room.name', read_only=True) # Acessa o cômodo do dispositivo
     house_name = serializers.CharField(source='room.house.name', read_only=True) # Nome do cômodo
 
     class Meta:
         model = Device
-        fields = ['id', 'name', 'description', 'activated', 'room', 'room_name', 'house_name']
+        fields = ['id', 'name', 'description', 'activated', 'room', 'room_name', 'house_name', 'version']
+
+    # Evita nomes duplicados no mesmo cômodo
+    unique_name_constraint = 'unique_device_name_per_room'
+    unique_name_error = "Já existe um dispositivo chamado '{name}' neste cômodo."
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        # No modo write-behind o estado ainda não gravado no banco vale sobre o da instância
+        buffer = get_state_buffer()
+        pending = buffer.get(instance.pk) if buffer is not None else None
+        if pending is not None:
+            for field, value in zip(('activated', 'version'), pending):
+                if field in data:
+                    data[field] = value
+        return data
+
+    def update(self, instance, validated_data):
+        return self._save_unique_name(validated_data, self._update_changed_fields, instance, validated_data)
+
+    def _update_changed_fields(self, instance, validated_data):
+        '''
+        Grava só os campos que mudaram, com UPDATE condicional pela versão
+        (a esperada vem do If-Match, em context['expected_version']).
+        Lança VersionConflict se outra escrita chegou antes.
+        '''
+        expected_version = self.context.get('expected_version')
+        changed = [field for field, value in validated_data.items() if getattr(instance, field) != value]
+        if not changed:
+            if expected_version is not None and expected_version != instance.version:
+                raise VersionConflict(instance.version)
+            return instance
+
+        for field in changed:
+            setattr(instance, field, validated_data[field])
+        return save_device_fields(instance, changed, expected_version)
 
     def validate_name(self, value):
         # Valida se o nome do dispositivo não está vazio
@@ -16,25 +108,7 @@ class DeviceSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("O nome do dispositivo deve ter pelo menos 2 caracteres.")
         return value.strip()
     
-    def validate(self, data):
-        # Validação para evitar nomes duplicados no mesmo cômodo
-        room = data.get('room')
-        name = data.get('name', '').strip()
-        
-        instance_id = self.instance.id if self.instance else None
-        
-        existing_device = Device.objects.filter(room=room, name__iexact=name)
-        if instance_id:
-            existing_device = existing_device.exclude(id=instance_id)
-            
-        if existing_device.exists():
-            raise serializers.ValidationError({
-                'name': f"Já existe um dispositivo chamado '{name}' neste cômodo."
-            })
-        
-        return data
-
-class RoomSerializer(serializers.ModelSerializer):
+class RoomSerializer(UniqueNameModelSerializer):
     devices = serializers.SerializerMethodField()  # Para controlar melhor a serialização
     devices_count = serializers.SerializerMethodField()
 
@@ -42,13 +116,21 @@ class RoomSerializer(serializers.ModelSerializer):
         model = Room
         fields = ['id', 'name', 'house', 'devices', 'devices_count']
 
+    # Evita nomes duplicados na mesma casa
+    unique_name_constraint = 'unique_room_name_per_house'
+    unique_name_error = "Já existe um cômodo chamado '{name}' nesta casa."
+
     def get_devices(self, obj):
         # Retorna dispositivos da sala com informações básicas
+        # (usa o prefetch da RoomViewSet quando disponível)
         devices = obj.devices.all()
         return DeviceSerializer(devices, many=True, context=self.context).data
     
     def get_devices_count(self, obj):
         # Retorna a quantidade de dispositivos na sala
+        # Lê a anotação Count da RoomViewSet e só consulta o banco se ela não existir
+        if hasattr(obj, 'devices_count'):
+            return obj.devices_count
         return obj.devices.count()
     
     def validate_name(self, value):
@@ -57,33 +139,15 @@ class RoomSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("O nome do cômodo deve ter pelo menos 2 caracteres.")
         return value.strip()
     
-def validate(self, data):
-        # Validação customizada para evitar nomes duplicados na mesma casa
-        house = data.get('house')
-        name = data.get('name', '').strip()
-        
-        # Se estamos atualizando, pega o ID atual
-        instance_id = self.instance.id if self.instance else None
-        
-        # Verifica se já existe um cômodo com esse nome na mesma casa
-        existing_room = Room.objects.filter(house=house, name__iexact=name)
-        if instance_id:
-            existing_room = existing_room.exclude(id=instance_id)
-        
-        if existing_room.exists():
-            raise serializers.ValidationError({
-                'name': f"Já existe um cômodo chamado '{name}' nesta casa."
-            })
-        
-        return data
-
-class SceneActionSerializer(serializers.ModelSerializer):
+class SceneActionSerializer(SparseFieldsModelSerializer):
     device_name = serializers.CharField(source='device.name', read_only=True)
     room_name = serializers.CharField(source='device.room.name', read_only=True)
 
     class Meta:
         model = SceneAction
-        fields = ['id', 'device', 'device_name', 'room_name', 'interval', 'order', 'newState']
+        fields = ['id', 'scene', 'device', 'device_name', 'room_name', 'interval', 'order', 'newState']
+        # O cômodo vem junto com o dispositivo, para o validate comparar as casas sem outra consulta
+        extra_kwargs = {'device': {'queryset': Device.objects.select_related('room')}}
 
     def validate_interval(self, value):
         # Valida se o intervalo é um número positivo razoável
@@ -101,18 +165,18 @@ class SceneActionSerializer(serializers.ModelSerializer):
     
     def validate(self, data):
         # Validação para garantir que o dispositivo pertence à mesma casa da cena
-        scene = data.get('scene')
-        device = data.get('device')
+        scene = data.get('scene', getattr(self.instance, 'scene', None))
+        device = data.get('device', getattr(self.instance, 'device', None))
         
         if scene and device:
-            if device.room.house != scene.house:
+            if device.room.house_id != scene.house_id:
                 raise serializers.ValidationError({
                     'device': 'O dispositivo deve pertencer à mesma casa da cena.'
                 })
         
         return data
 
-class SceneSerializer(serializers.ModelSerializer):
+class SceneSerializer(UniqueNameModelSerializer):
     actions = SceneActionSerializer(many=True, read_only=True) # actions pq é o related_name no model SceneAction
     actions_count = serializers.SerializerMethodField()
 
@@ -120,8 +184,15 @@ class SceneSerializer(serializers.ModelSerializer):
         model = Scene
         fields = ['id', 'name', 'activated', 'house', 'actions', 'actions_count']
 
+    # Evita nomes duplicados na mesma casa
+    unique_name_constraint = 'unique_scene_name_per_house'
+    unique_name_error = "Já existe uma cena chamada '{name}' nesta casa."
+
     def get_actions_count(self, obj):
         # Retorna a quantidade de ações na cena
+        # Lê a anotação Count da SceneViewSet e só consulta o banco se ela não existir
+        if hasattr(obj, 'actions_count'):
+            return obj.actions_count
         return obj.actions.count()
     
     def validate_name(self, value):
@@ -130,25 +201,7 @@ class SceneSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("O nome da cena deve ter pelo menos 2 caracteres.")
         return value.strip()
     
-    def validate(self, data):
-        # Validação para evitar nomes duplicados na mesma casa
-        house = data.get('house')
-        name = data.get('name', '').strip()
-        
-        instance_id = self.instance.id if self.instance else None
-        
-        existing_scene = Scene.objects.filter(house=house, name__iexact=name)
-        if instance_id:
-            existing_scene = existing_scene.exclude(id=instance_id)
-            
-        if existing_scene.exists():
-            raise serializers.ValidationError({
-                'name': f"Já existe uma cena chamada '{name}' nesta casa."
-            })
-        
-        return data
-
-class HouseSerializer(serializers.ModelSerializer):
+class HouseSerializer(SparseFieldsModelSerializer):
     class Meta:
         model = House
         fields = '__all__'
@@ -175,6 +228,54 @@ class DeviceStateSerializer(serializers.Serializer):
             raise serializers.ValidationError("O estado deve ser um booleano.")
         return value
 
+class DeviceBulkStateItemSerializer(serializers.Serializer):
+    '''Estado desejado para um dispositivo dentro de uma atualização em lote'''
+    id = serializers.IntegerField(required=True)
+    activated = serializers.BooleanField(required=True)
+
+class DeviceBulkStateSerializer(serializers.Serializer):
+    '''
+    Serializador para alterar o estado de vários dispositivos de uma vez.
+    Aceita uma lista 'devices' com {id, activated} ou um seletor 'room'/'house' com 'activated'.
+    '''
+    devices = DeviceBulkStateItemSerializer(many=True, required=False)
+    room = serializers.PrimaryKeyRelatedField(queryset=Room.objects.all(), required=False)
+    house = serializers.PrimaryKeyRelatedField(queryset=House.objects.all(), required=False)
+    activated = serializers.BooleanField(required=False)
+
+    def validate(self, data):
+        # Exatamente uma forma de seleção deve ser enviada
+        selectors = [key for key in ('devices', 'room', 'house') if key in data]
+        if len(selectors) != 1:
+            raise serializers.ValidationError("Envie apenas um dos campos 'devices', 'room' ou 'house'.")
+
+        if 'devices' in data:
+            if not data['devices']:
+                raise serializers.ValidationError({'devices': 'A lista de dispositivos não pode ser vazia.'})
+            ids = [item['id'] for item in data['devices']]
+            if len(ids) != len(set(ids)):
+                raise serializers.ValidationError({'devices': 'Cada dispositivo deve aparecer apenas uma vez.'})
+        elif 'activated' not in data:
+            raise serializers.ValidationError({'activated': "O campo 'activated' é obrigatório ao usar 'room' ou 'house'."})
+
+        return data
+
+class TimeRangeSerializer(serializers.Serializer):
+    '''Intervalo de tempo dos relatórios de histórico (padrão: últimas 24 horas)'''
+    start = serializers.DateTimeField(required=False)
+    end = serializers.DateTimeField(required=False)
+
+    def validate(self, data):
+        end = data.get('end') or timezone.now()
+        start = data.get('start') or end - timedelta(hours=24)
+        if start >= end:
+            raise serializers.ValidationError("O início do intervalo deve ser anterior ao fim.")
+        return {'start': start, 'end': end}
+
+class SnapshotQuerySerializer(serializers.Serializer):
+    '''Parâmetros do retrato da casa: 'since' é a última versão que o cliente já tem'''
+    since = serializers.IntegerField(required=False, min_value=0)
+
 class SceneActivationSerializer(serializers.Serializer):
     '''Serializador para ativar/desativar uma cena'''	
     activated = serializers.BooleanField(required=True)
@@ -184,10 +285,213 @@ class SceneActivationSerializer(serializers.Serializer):
         if not isinstance(value, bool):
             raise serializers.ValidationError("O estado deve ser um booleano.")
 
+class SceneActionBulkListSerializer(serializers.ListSerializer):
+    '''
+    Lista completa das ações de uma cena (context['scene']), validada como conjunto
+    e gravada como diferença em relação às ações atuais (instance).
+    '''
+
+    def to_internal_value(self, data):
+        items = super().to_internal_value(data)
+        scene = self.context['scene']
+
+        # Uma consulta para todos os dispositivos citados, em vez de uma por ação
+        houses = dict(
+            Device.objects.filter(pk__in={item['device_id'] for item in items})
+            .values_list('pk', 'room__house_id')
+        )
+        first_index = {}
+        errors = {}
+        for index, item in enumerate(items):
+            item_errors = {}
+            house_id = houses.get(item['device_id'])
+            if house_id is None:
+                item_errors['device_id'] = [f"O dispositivo {item['device_id']} não existe."]
+            elif house_id != scene.house_id:
+                item_errors['device_id'] = ['O dispositivo deve pertencer à mesma casa da cena.']
+            if item['order'] in first_index:
+                item_errors['order'] = [f"A ordem {item['order']} já foi usada no item {first_index[item['order']]}."]
+            else:
+                first_index[item['order']] = index
+            if item_errors:
+                errors[index] = item_errors
+
+        if errors:
+            # Mesmo formato dos erros por item do ListSerializer
+            if not getattr(api_settings, 'LIST_SERIALIZER_ERRORS_AS_DICT', False):
+                errors = [errors.get(index, {}) for index in range(len(items))]
+            raise serializers.ValidationError(errors)
+        return items
+
+    def update(self, instance, validated_data):
+        '''
+        Compara pela ordem: ações iguais ficam intactas, as alteradas recebem um UPDATE
+        em lote, as novas um INSERT em lote e as que saíram da lista um DELETE.
+        As quantidades ficam em self.changes.
+        '''
+        scene = self.context['scene']
+        fields = ['device_id', 'newState', 'interval']
+        current = {action.order: action for action in instance}
+        wanted = {item['order']: item for item in validated_data}
+
+        removed = [action.pk for order, action in current.items() if order not in wanted]
+        updated = []
+        created = []
+        for order, item in wanted.items():
+            action = current.get(order)
+            if action is None:
+                created.append(SceneAction(scene=scene, order=order, **{field: item[field] for field in fields}))
+            elif any(getattr(action, field) != item[field] for field in fields):
+                for field in fields:
+                    setattr(action, field, item[field])
+                updated.append(action)
+
+        if removed:
+            SceneAction.objects.filter(pk__in=removed).delete()
+        if updated:
+            SceneAction.objects.bulk_update(updated, fields)
+        if created:
+            SceneAction.objects.bulk_create(created)
+
+        self.changes = {'created': len(created), 'updated': len(updated), 'deleted': len(removed)}
+        return sorted(
+            [action for order, action in current.items() if order in wanted] + created,
+            key=lambda action: action.order,
+        )
+
+
 class SceneActionBulkUpdateSerializer(serializers.Serializer):
     """Serializador para atualizar várias ações de uma cena"""
 
     device_id = serializers.IntegerField(required=True)
     order = serializers.IntegerField(min_value=1, required=True)
     newState = serializers.BooleanField(required=True)
-    interval = serializers.IntegerField(min_value=0, default=0)
\ No newline at end of file
+    interval = serializers.IntegerField(min_value=0, max_value=3600, default=0)
+
+    class Meta:
+        list_serializer_class = SceneActionBulkListSerializer
+
+class SceneRunSerializer(SparseFieldsModelSerializer):
+    '''Serializador para acompanhar uma execução de cena'''
+    scene_name = serializers.CharField(source='scene.name', read_only=True)
+
+    class Meta:
+        model = SceneRun
+        fields = ['id', 'scene', 'scene_name', 'trigger', 'status', 'steps_done', 'steps_total', 'error', 'created_at', 'started_at', 'finished_at']
+        read_only_fields = fields
+
+class SceneTriggerSerializer(SparseFieldsModelSerializer):
+    '''
+    Gatilho de uma cena. 'schedule' exige 'cron'; 'device_state' exige 'device' e 'state',
+    com o dispositivo na mesma casa da cena.
+    '''
+    class Meta:
+        model = SceneTrigger
+        fields = ['id', 'scene', 'kind', 'cron', 'device', 'state', 'enabled', 'last_fired_at', 'updated_at']
+        read_only_fields = ['last_fired_at', 'updated_at']
+
+    def validate_cron(self, value):
+        value = ' '.join(value.split())
+        if value:
+            try:
+                CronSchedule(value)
+            except ValueError as e:
+                raise serializers.ValidationError(str(e))
+        return value
+
+    def validate(self, data):
+        kind = data.get('kind', getattr(self.instance, 'kind', None))
+        scene = data.get('scene', getattr(self.instance, 'scene', None))
+        cron = data.get('cron', getattr(self.instance, 'cron', ''))
+        device = data.get('device', getattr(self.instance, 'device', None))
+        state = data.get('state', getattr(self.instance, 'state', None))
+
+        if kind == SceneTrigger.SCHEDULE:
+            if not cron:
+                raise serializers.ValidationError({'cron': "O campo 'cron' é obrigatório para gatilhos agendados."})
+            # Campos do outro tipo são descartados
+            data['device'] = None
+            data['state'] = None
+        else:
+            errors = {}
+            if device is None:
+                errors['device'] = "O campo 'device' é obrigatório para gatilhos por estado."
+            if state is None:
+                errors['state'] = "O campo 'state' é obrigatório para gatilhos por estado."
+            if errors:
+                raise serializers.ValidationError(errors)
+            if device.room.house_id != scene.house_id:
+                raise serializers.ValidationError({'device': 'O dispositivo deve pertencer à mesma casa da cena.'})
+            data['cron'] = ''
+
+        return data
+
+class DeviceIdsField(serializers.ListField):
+    '''Ids dos dispositivos de um ManyToMany; a escrita é validada em conjunto pelo serializer.'''
+    child = serializers.IntegerField()
+
+    def to_representation(self, value):
+        return [device.pk for device in value.all()]
+
+class DeviceGroupSerializer(UniqueNameModelSerializer):
+    '''
+    Grupo de dispositivos. 'static' usa 'devices' (ids da mesma casa); 'dynamic' usa
+    'room' e 'name_pattern' (ex.: "Luz*"), e sem eles abrange a casa toda.
+    '''
+    devices = DeviceIdsField(required=False)
+
+    class Meta:
+        model = DeviceGroup
+        fields = ['id', 'name', 'house', 'kind', 'devices', 'room', 'name_pattern']
+
+    # Evita nomes duplicados na mesma casa
+    unique_name_constraint = 'unique_group_name_per_house'
+    unique_name_error = "Já existe um grupo chamado '{name}' nesta casa."
+
+    def validate_name(self, value):
+        # Valida se o nome do grupo não está vazio
+        if not value or len(value.strip()) < 2:
+            raise serializers.ValidationError("O nome do grupo deve ter pelo menos 2 caracteres.")
+        return value.strip()
+
+    def validate(self, data):
+        house = data.get('house', getattr(self.instance, 'house', None))
+        kind = data.get('kind', getattr(self.instance, 'kind', DeviceGroup.STATIC))
+        room = data.get('room', getattr(self.instance, 'room', None))
+
+        if kind == DeviceGroup.STATIC:
+            if data.get('room') is not None or data.get('name_pattern'):
+                raise serializers.ValidationError("Grupos estáticos usam apenas 'devices'; 'room' e 'name_pattern' são dos dinâmicos.")
+            # Filtros de quando o grupo era dinâmico saem junto com a mudança de tipo
+            data['room'] = None
+            data['name_pattern'] = ''
+            if 'devices' in data:
+                # Uma consulta para todos os ids, em vez de uma por dispositivo
+                device_ids = set(data['devices'])
+                found = set(Device.objects.filter(pk__in=device_ids, room__house=house).values_list('pk', flat=True))
+                missing = sorted(device_ids - found)
+                if missing:
+                    raise serializers.ValidationError({'devices': f'Dispositivos inexistentes ou de outra casa: {missing}.'})
+        else:
+            if data.get('devices'):
+                raise serializers.ValidationError({'devices': 'Grupos dinâmicos não têm dispositivos fixos.'})
+            if room is not None and room.house_id != house.pk:
+                raise serializers.ValidationError({'room': 'O cômodo deve pertencer à casa do grupo.'})
+            # Dispositivos de quando o grupo era estático saem junto com a mudança de tipo
+            data['devices'] = []
+        return data
+
+    def create(self, validated_data):
+        devices = validated_data.pop('devices', None)
+        group = super().create(validated_data)
+        if devices:
+            group.devices.set(devices)
+        return group
+
+    def update(self, instance, validated_data):
+        devices = validated_data.pop('devices', None)
+        group = super().update(instance, validated_data)
+        if devices is not None:
+            # set() só insere e remove as diferenças
+            group.devices.set(devices)
+        return group
@@ -0,0 +1,200 @@
+'''
+Escrita do estado (activated) dos dispositivos.
+
+As mudanças de estado feitas pela API e pelo motor de cenas passam por aqui e são
+gravadas com UPDATEs em lote, nunca com um save() completo por dispositivo.
+
+Toda escrita incrementa Device.version. As escritas de um dispositivo pela API são
+condicionais (UPDATE ... WHERE version = ?), e as escritas em lote travam as linhas
+em ordem de id, então execuções de cena em paralelo não entram em deadlock.
+'''
+from django.db import router, transaction
+from django.db.models import BooleanField, Case, F, Value, When
+from django.db.models.signals import post_save
+from django.dispatch import Signal
+
+from .events import device_locations, publish_device_states
+from .history import record_device_states
+from .models import Device
+from .responses import ROOM, invalidate_responses
+from .sharding import current_db
+from .versions import touch
+
+# Enviado após o commit de toda escrita de estado, com states={device_id: activated} e
+# changed={ids cujo estado de fato mudou}; escrever o estado que o dispositivo já tinha
+# não é uma transição (ex.: os gatilhos de cena em automacao.triggers só olham 'changed')
+device_states_committed = Signal()
+
+
+def device_states_changed(states, changed):
+    '''
+    Efeitos de uma mudança de estado já gravada: invalida as respostas dos cômodos,
+    publica os eventos em tempo real e registra o histórico. Chamada após o commit
+    das escritas em lote (o save() de Device tem o equivalente em automacao.signals).
+    Eventos e histórico só recebem os dispositivos em 'changed'; reescrever o estado
+    que o dispositivo já tinha não é uma mudança para quem ouve.
+    '''
+    locations = device_locations(states)
+    invalidate_responses(ROOM, dict(locations.values()))
+    transitions = {device_id: states[device_id] for device_id in changed}
+    if transitions:
+        publish_device_states(transitions, locations)
+        record_device_states(transitions)
+    device_states_committed.send(sender=Device, states=states, changed=changed)
+
+
+def device_states_written(states, changed):
+    '''
+    Efeitos de mudanças de estado gravadas sem transação nem sinais (ex.: pelas views
+    assíncronas): incrementa a versão das casas e segue como device_states_changed.
+    '''
+    touch(devices=states)
+    device_states_changed(states, changed)
+
+
+# Tentativas de set_device_state sem versão esperada antes de desistir por concorrência
+STATE_WRITE_ATTEMPTS = 3
+
+
+class VersionConflict(Exception):
+    '''A versão do dispositivo no banco não é a esperada; 'current' é a atual (None se ele foi removido).'''
+
+    def __init__(self, current):
+        super().__init__(current)
+        self.current = current
+
+
+def save_device_fields(device, fields, expected_version=None):
+    '''
+    Grava só 'fields' da instância e incrementa a versão com um UPDATE condicional:
+    UPDATE ... SET <fields>, version = version + 1 WHERE id = ? AND version = ?
+
+    Sem 'expected_version' a condição usa a versão lida na instância, então uma
+    escrita concorrente nunca é sobrescrita sem ser percebida. Lança VersionConflict
+    quando outra escrita chegou antes.
+    '''
+    expected = device.version if expected_version is None else expected_version
+    values = {field: getattr(device, field) for field in fields}
+    target = Device.objects.filter(pk=device.pk, version=expected)
+    state_changed = None
+    if 'activated' in values:
+        # Primeiro só se o estado muda: o número de linhas diz, sem outra leitura,
+        # se a escrita foi uma transição (usado pelos gatilhos de cena)
+        state_changed = bool(target.exclude(activated=values['activated']).update(version=F('version') + 1, **values))
+    if not state_changed and not target.update(version=F('version') + 1, **values):
+        raise VersionConflict(Device.objects.filter(pk=device.pk).values_list('version', flat=True).first())
+
+    device.version = expected + 1
+    # UPDATE não dispara sinais: os receptores de automacao.signals recebem o mesmo post_save de um save()
+    post_save.send(
+        sender=Device, instance=device, created=False, raw=False,
+        update_fields=frozenset([*fields, 'version']), using=router.db_for_write(Device, instance=device),
+        state_changed=state_changed,
+    )
+    return device
+
+
+def set_device_state(device, activated, expected_version=None):
+    '''
+    Liga ou desliga um dispositivo sem tocar nos outros campos.
+
+    Com 'expected_version' (If-Match) a escrita falha com VersionConflict se o
+    dispositivo mudou. Sem ela vale a última escrita: um conflito só relê a versão
+    e tenta de novo.
+    '''
+    device.activated = activated
+    for attempt in range(STATE_WRITE_ATTEMPTS):
+        try:
+            return save_device_fields(device, ['activated'], expected_version)
+        except VersionConflict as e:
+            if expected_version is not None or e.current is None or attempt == STATE_WRITE_ATTEMPTS - 1:
+                raise
+            device.version = e.current
+
+
+def apply_device_states(states, existing=None):
+    '''
+    Aplica um dicionário {device_id: activated} em uma única transação.
+
+    Todos os dispositivos são atualizados por um só UPDATE (com CASE quando há
+    dispositivos ligando e desligando ao mesmo tempo), depois de travados em ordem
+    de id pela mesma consulta que confere a existência deles.
+    'existing' indica que o chamador já sabe que os ids são válidos (ex.: ações de
+    uma cena, garantidas pela chave estrangeira); a trava em ordem continua sendo
+    feita, e é ela que informa o estado anterior de cada dispositivo.
+    Retorna o conjunto de ids que existiam e foram atualizados.
+    '''
+    if not states:
+        return set()
+
+    with transaction.atomic(using=current_db()):
+        previous = _lock_devices(states if existing is None else existing)
+        found = set(previous)
+        if found:
+            turn_on = [device_id for device_id in found if states[device_id]]
+            if len(turn_on) in (0, len(found)):
+                new_state = Value(bool(turn_on))
+            else:
+                new_state = Case(
+                    When(id__in=turn_on, then=Value(True)),
+                    default=Value(False),
+                    output_field=BooleanField(),
+                )
+            Device.objects.filter(id__in=found).update(activated=new_state, version=F('version') + 1)
+            touch(devices=found)
+
+            # UPDATE não dispara sinais: os efeitos da mudança rodam após o commit
+            changes = {device_id: states[device_id] for device_id in found}
+            changed = {device_id for device_id, activated in previous.items() if activated != states[device_id]}
+            transaction.on_commit(lambda: device_states_changed(changes, changed), using=current_db())
+
+    return found
+
+
+def apply_state_to_devices(queryset, activated):
+    '''
+    Liga ou desliga todos os dispositivos de um queryset (ex.: de um cômodo, casa ou grupo)
+    com um único UPDATE ... WHERE id IN (subconsulta), sem mandar a lista de ids ao banco.
+    Antes, as linhas são travadas em ordem de id (como em _lock_devices); os ids lidos
+    na trava (com o estado anterior) alimentam os efeitos após o commit. Retorna a lista
+    de ids atualizados.
+    '''
+    with transaction.atomic(using=current_db()):
+        # of=('self',): só as linhas dos dispositivos, não as das tabelas do filtro
+        previous = dict(queryset.select_for_update(of=('self',)).order_by('id').values_list('id', 'activated'))
+        device_ids = list(previous)
+        if device_ids:
+            Device.objects.filter(id__in=queryset.values('id')).update(activated=activated, version=F('version') + 1)
+            touch(devices=device_ids)
+            changed = {device_id for device_id, was in previous.items() if was != activated}
+            transaction.on_commit(lambda: device_states_changed(dict.fromkeys(device_ids, activated), changed), using=current_db())
+
+    return device_ids
+
+
+def _lock_devices(device_ids):
+    '''
+    Trava as linhas (SELECT ... FOR UPDATE) sempre em ordem crescente de id: duas
+    transações que atualizam conjuntos sobrepostos esperam uma pela outra em vez
+    de cada uma segurar parte das linhas. Retorna {id: activated} dos encontrados.
+    '''
+    return dict(Device.objects.select_for_update().filter(id__in=device_ids).order_by('id').values_list('id', 'activated'))
+
+
+def fold_scene_steps(steps):
+    '''
+    Agrupa os passos (device_id, newState, interval) de uma cena em lotes.
+
+    Um lote novo começa a cada ação com intervalo; dentro de um lote só importa o
+    estado final de cada dispositivo, pois uma ação posterior sobrescreve a anterior.
+    Retorna uma lista de (interval, {device_id: activated}, quantidade_de_acoes).
+    '''
+    batches = []
+    for device_id, new_state, interval in steps:
+        if interval or not batches:
+            batches.append((interval, {}, 0))
+        batch_interval, states, count = batches[-1]
+        states[device_id] = new_state
+        batches[-1] = (batch_interval, states, count + 1)
+    return batches
+
@@ -0,0 +1,319 @@
+'''
+Particionamento das casas entre bancos (shards).
+
+Cada casa e tudo abaixo dela (cômodos, dispositivos, cenas, ações, execuções,
+gatilhos, grupos e histórico) ficam em um único shard, um alias de settings.AUTOMACAO_SHARDS.
+- O diretório (HouseShard, sempre no 'default') diz o shard de cada casa e é lido
+  com cache de SHARD_DIRECTORY_TTL segundos por processo.
+- Os ids são únicos entre shards: cada shard numera a partir de índice * SHARD_ID_SPAN
+  (reserve_id_range, após o migrate), então caches e eventos indexados por id continuam válidos.
+- O shard da requisição fica em uma ContextVar (use_shard), lida pelo ShardRouter;
+  transações e on_commit usam current_db().
+- Sem shards extras configurados tudo fica no 'default' e nada disso custa consultas.
+'''
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, close_old_connections, connections, transaction
+from django.db.models import Count
+
+from .cache import LRUCache
+from .models import (
+    Device, DeviceGroup, DeviceStateEvent, House, HouseShard, Room, Scene, SceneAction, SceneRun, SceneTrigger,
+)
+from .profiling import record_queries
+
+logger = logging.getLogger(__name__)
+
+# Faixa de ids de cada shard: o shard de índice i numera a partir de i * SHARD_ID_SPAN
+SHARD_ID_SPAN = 10 ** 12
+
+# Caminho de cada model até o id da casa, na ordem em que uma casa é copiada entre shards
+HOUSE_PATHS = {
+    House: 'pk',
+    Room: 'house_id',
+    Device: 'room__house_id',
+    Scene: 'house_id',
+    SceneAction: 'scene__house_id',
+    SceneTrigger: 'scene__house_id',
+    SceneRun: 'scene__house_id',
+    DeviceGroup: 'house_id',
+    DeviceGroup.devices.through: 'devicegroup__house_id',
+    DeviceStateEvent: 'device__room__house_id',
+}
+
+_current = ContextVar('automacao_shard', default=None)
+
+# house_id -> (shard, status, expira_em)
+_directory = LRUCache(maxsize=100_000)
+# (model, pk) -> house_id; a casa de um objeto não muda de shard sem mudar de casa
+_object_houses = LRUCache(maxsize=100_000)
+
+_executor = None
+
+
+class HouseMoving(Exception):
+    '''Escrita recusada: a casa está sendo movida de shard (move_house).'''
+
+    def __init__(self, house_id):
+        super().__init__(house_id)
+        self.house_id = house_id
+
+
+def get_shards():
+    return getattr(settings, 'AUTOMACAO_SHARDS', [DEFAULT_DB_ALIAS])
+
+
+def is_sharded():
+    return len(get_shards()) > 1
+
+
+def current_shard():
+    '''Shard escolhido para o contexto atual, ou None.'''
+    return _current.get()
+
+
+def current_db():
+    '''Alias a usar em transaction.atomic() e on_commit() no contexto atual.'''
+    return _current.get() or DEFAULT_DB_ALIAS
+
+
+@contextmanager
+def use_shard(alias):
+    token = _current.set(alias)
+    try:
+        yield alias
+    finally:
+        _current.reset(token)
+
+
+def shard_from_id(pk):
+    '''Shard em que o id foi gerado (pela faixa de ids); uma casa movida pode estar em outro.'''
+    shards = get_shards()
+    index = int(pk) // SHARD_ID_SPAN
+    return shards[index] if index < len(shards) else shards[0]
+
+
+def _directory_entry(house_id):
+    entry = _directory.get(house_id)
+    if entry is None or entry[2] < time.monotonic():
+        row = HouseShard.objects.using(DEFAULT_DB_ALIAS).filter(house_id=house_id).values_list('shard', 'status').first()
+        shard, status = row or (shard_from_id(house_id), HouseShard.ACTIVE)
+        entry = (shard, status, time.monotonic() + getattr(settings, 'SHARD_DIRECTORY_TTL', 5))
+        _directory.set(house_id, entry)
+    return entry
+
+
+def shard_for_house(house_id):
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+    return _directory_entry(int(house_id))[0]
+
+
+def house_is_moving(house_id):
+    return is_sharded() and _directory_entry(int(house_id))[1] == HouseShard.MOVING
+
+
+def locate_houses(model, pks):
+    '''
+    Retorna {id: house_id} dos objetos existentes de um model de HOUSE_PATHS.
+    Os que não estão no cache são procurados shard a shard, uma consulta por shard,
+    começando pelo shard da faixa dos ids.
+    '''
+    if model is House:
+        return {int(pk): int(pk) for pk in pks}
+
+    found = {}
+    missing = []
+    for pk in map(int, pks):
+        house_id = _object_houses.get((model, pk))
+        if house_id is None:
+            missing.append(pk)
+        else:
+            found[pk] = house_id
+
+    if missing:
+        first = shard_from_id(missing[0])
+        for alias in [first] + [alias for alias in get_shards() if alias != first]:
+            rows = model.objects.using(alias).filter(pk__in=missing).values_list('pk', HOUSE_PATHS[model])
+            for pk, house_id in rows:
+                _object_houses.set((model, pk), house_id)
+                found[pk] = house_id
+            missing = [pk for pk in missing if pk not in found]
+            if not missing:
+                break
+    return found
+
+
+def locate_house(model, pk):
+    '''Id da casa de um objeto de qualquer model de HOUSE_PATHS, ou None se ele não existir.'''
+    return locate_houses(model, [pk]).get(int(pk))
+
+
+def check_writable(house_id):
+    '''Levanta HouseMoving se a casa estiver no meio de um move_house.'''
+    if house_id is not None and house_is_moving(house_id):
+        raise HouseMoving(house_id)
+
+
+def locate(model, pk):
+    '''Shard de um objeto pelo id, ou None se ele não existir em nenhum shard.'''
+    if not is_sharded():
+        return DEFAULT_DB_ALIAS
+    house_id = locate_house(model, pk)
+    return shard_for_house(house_id) if house_id is not None else None
+
+
+def group_by_shard(model, pks):
+    '''
+    Agrupa ids de objetos do model por shard: {alias: [ids]}. Ids inexistentes
+    ficam de fora; objetos de casas em migração levantam HouseMoving.
+    '''
+    if not is_sharded():
+        return {DEFAULT_DB_ALIAS: list(pks)}
+    groups = {}
+    for pk, house_id in locate_houses(model, pks).items():
+        check_writable(house_id)
+        groups.setdefault(shard_for_house(house_id), []).append(pk)
+    return groups
+
+
+def query_shards():
+    '''Shards que uma leitura no contexto atual precisa percorrer.'''
+    shard = current_shard()
+    return [shard] if shard else get_shards()
+
+
+def place_new_house():
+    '''Shard de uma casa nova: o que tem menos casas no diretório.'''
+    counts = dict(HouseShard.objects.using(DEFAULT_DB_ALIAS).values_list('shard').annotate(total=Count('pk')).order_by())
+    return min(get_shards(), key=lambda alias: counts.get(alias, 0))
+
+
+def register_house(house_id, alias):
+    HouseShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(house_id=house_id, defaults={'shard': alias, 'status': HouseShard.ACTIVE})
+    _directory.delete(house_id)
+
+
+def unregister_house(house_id):
+    HouseShard.objects.using(DEFAULT_DB_ALIAS).filter(house_id=house_id).delete()
+    _directory.delete(house_id)
+
+
+def _in_shard(context, alias, func):
+    close_old_connections()
+    try:
+        return context.run(_run_in_shard, alias, func)
+    finally:
+        close_old_connections()
+
+
+def _run_in_shard(alias, func):
+    # record_queries: as consultas da thread entram no perfil da requisição, se houver
+    with use_shard(alias), record_queries():
+        return func(alias)
+
+
+def fan_out(func, shards=None):
+    '''
+    Executa func(alias) em todos os shards em paralelo (cada um com sua conexão)
+    e retorna os resultados na ordem de get_shards(). Cada chamada recebe uma cópia
+    do contexto atual (ex.: leituras liberadas para réplicas).
+    '''
+    global _executor
+    shards = shards or get_shards()
+    if len(shards) == 1:
+        with use_shard(shards[0]):
+            return [func(shards[0])]
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(len(get_shards()), 2), thread_name_prefix='shard-fan-out')
+    contexts = [copy_context() for _ in shards]
+    return list(_executor.map(lambda context, alias: _in_shard(context, alias, func), contexts, shards))
+
+
+def reserve_id_range(alias):
+    '''
+    Faz as tabelas da app no shard 'alias' numerarem a partir da faixa dele.
+    Idempotente: só avança sequências que ainda estão abaixo da faixa.
+    '''
+    shards = get_shards()
+    if alias not in shards or shards.index(alias) == 0:
+        return
+    start = shards.index(alias) * SHARD_ID_SPAN
+    connection = connections[alias]
+
+    with connection.cursor() as cursor:
+        for model in HOUSE_PATHS:
+            table = model._meta.db_table
+            cursor.execute(f'SELECT MAX(id) FROM {connection.ops.quote_name(table)}')
+            current = cursor.fetchone()[0] or 0
+            if current >= start:
+                continue
+            if connection.vendor == 'postgresql':
+                cursor.execute("SELECT setval(pg_get_serial_sequence(%s, 'id'), %s, false)", [table, start])
+            elif connection.vendor == 'sqlite':
+                cursor.execute('DELETE FROM sqlite_sequence WHERE name = %s', [table])
+                cursor.execute('INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)', [table, start - 1])
+            else:
+                logger.warning('Faixa de ids não reservada no shard %s (%s)', alias, connection.vendor)
+                return
+
+
+def move_house(house_id, target, batch_size=1000, log=logger.info, wait=time.sleep):
+    '''
+    Move uma casa e tudo abaixo dela para o shard 'target' sem tirar a casa do ar:
+    1. marca a casa como em migração (escritas recebem 503; leituras continuam na origem)
+    2. espera o TTL do diretório, para todos os processos enxergarem a marca
+    3. copia as linhas, com os mesmos ids, em uma transação no destino
+    4. aponta o diretório para o destino e espera o TTL de novo
+    5. remove a casa da origem
+    Execuções de cena já em andamento terminam na origem.
+    '''
+    if target not in get_shards():
+        raise ValueError(f'Shard desconhecido: {target}')
+    _directory.delete(house_id)
+    source = shard_for_house(house_id)
+    if source == target:
+        raise ValueError(f'A casa {house_id} já está no shard {target}.')
+    if not House.objects.using(source).filter(pk=house_id).exists():
+        raise ValueError(f'A casa {house_id} não existe no shard {source}.')
+
+    ttl = getattr(settings, 'SHARD_DIRECTORY_TTL', 5)
+    HouseShard.objects.using(DEFAULT_DB_ALIAS).update_or_create(
+        house_id=house_id, defaults={'shard': source, 'status': HouseShard.MOVING},
+    )
+    log(f'Casa {house_id}: escritas bloqueadas, aguardando {ttl}s')
+    wait(ttl)
+
+    try:
+        with transaction.atomic(using=target):
+            for model, path in HOUSE_PATHS.items():
+                rows = model.objects.using(source).filter(**{path: house_id}).order_by('pk')
+                batch = []
+                copied = 0
+                for row in rows.iterator(chunk_size=batch_size):
+                    batch.append(row)
+                    if len(batch) >= batch_size:
+                        model.objects.using(target).bulk_create(batch)
+                        copied += len(batch)
+                        batch = []
+                if batch:
+                    model.objects.using(target).bulk_create(batch)
+                    copied += len(batch)
+                log(f'  {model._meta.model_name}: {copied} linhas copiadas')
+    except Exception:
+        register_house(house_id, source)
+        raise
+
+    register_house(house_id, target)
+    log(f'Casa {house_id}: diretório aponta para {target}, aguardando {ttl}s')
+    wait(ttl)
+
+    with use_shard(source):
+        House.objects.using(source).filter(pk=house_id).delete()
+    _object_houses.clear()
+    log(f'Casa {house_id}: removida de {source}')
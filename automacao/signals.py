@@ -0,0 +1,165 @@
+'''
+Receptores de sinais que mantêm os caches e as versões das casas coerentes com
+o banco, publicam e registram as mudanças de estado dos dispositivos
+(automacao.events e automacao.history) e disparam os gatilhos de cena
+(automacao.triggers). Também mantêm o diretório de shards (automacao.sharding).
+
+Escritas em lote (bulk_create, update) não disparam sinais; quem as faz chama as
+funções de invalidação diretamente (ver SceneViewSet.set_scene_actions).
+'''
+from django.db import transaction
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+from django.dispatch import receiver
+
+from .events import forget_device_location, forget_device_locations, publish_device
+from .history import record_device_states
+from .models import Device, House, Room, Scene, SceneAction, SceneTrigger
+from .plans import invalidate_scene_plan
+from .responses import ROOM, SCENE, invalidate_responses
+from .services import device_states_committed
+from .sharding import current_db, is_sharded, register_house, reserve_id_range, shard_for_house, unregister_house
+from .triggers import evaluate_device_states, get_device_rule_index
+from .versions import touch
+from .writebehind import get_state_buffer
+
+
+def invalidate_scene_plans(*scene_ids):
+    '''
+    Invalida os planos agora e de novo após o commit, para que uma leitura
+    concorrente não guarde no cache um plano anterior à transação.
+    '''
+    invalidate_scene_plan(*scene_ids)
+    transaction.on_commit(lambda: invalidate_scene_plan(*scene_ids), using=current_db())
+
+
+@receiver(post_save, sender=Scene)
+@receiver(post_delete, sender=Scene)
+def scene_changed(sender, instance, **kwargs):
+    invalidate_scene_plans(instance.pk)
+    invalidate_responses(SCENE, {instance.pk: instance.house_id})
+    touch(houses=[instance.house_id])
+
+
+# Remover um dispositivo remove suas ações em cascata, o que também cai aqui
+@receiver(post_save, sender=SceneAction)
+@receiver(post_delete, sender=SceneAction)
+def scene_action_changed(sender, instance, **kwargs):
+    invalidate_scene_plans(instance.scene_id)
+    invalidate_responses(SCENE, [instance.scene_id])
+    touch(scenes=[instance.scene_id])
+
+
+@receiver(pre_save, sender=Device)
+def device_saving(sender, instance, using, update_fields=None, **kwargs):
+    # Um save() não diz se o estado mudou: guarda o anterior para device_saved
+    # (set_state e o PATCH passam por save_device_fields, que já informa, sem este sinal)
+    if not instance._state.adding and (update_fields is None or 'activated' in update_fields):
+        instance._previous_activated = Device.objects.using(using).filter(pk=instance.pk).values_list('activated', flat=True).first()
+
+
+@receiver(post_save, sender=Device)
+def device_saved(sender, instance, created, update_fields=None, state_changed=None, **kwargs):
+    forget_device_location(instance.pk)
+    device_responses_changed(instance, state_only=update_fields is not None and set(update_fields) <= {'activated', 'version'})
+    touch(rooms=[instance.room_id])
+    # Cobre set_state, o admin e as escritas completas pela API
+    if update_fields is None or 'activated' in update_fields:
+        activated = instance.activated
+        previous = instance.__dict__.pop('_previous_activated', None)
+        if state_changed is None:
+            # Criar um dispositivo não é uma transição
+            state_changed = not created and previous != activated
+        changed = {instance.pk} if state_changed else set()
+        # Como em device_states_changed: eventos e histórico só com o estado inicial ou uma transição
+        if created or state_changed:
+            transaction.on_commit(lambda: publish_device(instance), using=current_db())
+            transaction.on_commit(lambda: record_device_states({instance.pk: activated}), using=current_db())
+        transaction.on_commit(
+            lambda: device_states_committed.send(sender=Device, states={instance.pk: activated}, changed=changed),
+            using=current_db(),
+        )
+
+
+@receiver(post_delete, sender=Device)
+def device_deleted(sender, instance, **kwargs):
+    forget_device_location(instance.pk)
+    # As ações que usavam o dispositivo são removidas em cascata e invalidam suas cenas
+    device_responses_changed(instance, state_only=True)
+    touch(rooms=[instance.room_id])
+
+
+def device_responses_changed(device, state_only=False):
+    '''
+    O dispositivo aparece no detalhe e na listagem do seu cômodo e, pelo nome,
+    nas ações das cenas que o usam; uma mudança só de estado não afeta as cenas.
+    '''
+    # Com o cômodo já carregado (ex.: get_object de DeviceViewSet) a casa não é consultada
+    house_id = device.room.house_id if Device.room.is_cached(device) else None
+    invalidate_responses(ROOM, {device.room_id: house_id})
+    if not state_only:
+        invalidate_responses(SCENE, devices=[device.pk])
+
+
+@receiver(post_save, sender=Room)
+def room_saved(sender, instance, created, **kwargs):
+    invalidate_responses(ROOM, {instance.pk: instance.house_id})
+    # O nome do cômodo aparece nas ações das cenas (room_name)
+    if not created:
+        invalidate_responses(SCENE, houses=[instance.house_id])
+    touch(houses=[instance.house_id])
+    # Um cômodo pode ter mudado de casa; é raro, então basta esquecer todas as localizações
+    if not created:
+        forget_device_locations()
+
+
+@receiver(post_delete, sender=Room)
+def room_deleted(sender, instance, **kwargs):
+    invalidate_responses(ROOM, {instance.pk: instance.house_id})
+    touch(houses=[instance.house_id])
+
+
+@receiver(post_save, sender=House)
+def house_saved(sender, instance, created, using, **kwargs):
+    # O nome da casa aparece nas respostas dos dispositivos (house_name)
+    invalidate_responses(ROOM, houses=[instance.pk])
+    touch(houses=[instance.pk])
+    if created and is_sharded():
+        transaction.on_commit(lambda: register_house(instance.pk, using), using=using)
+
+
+@receiver(post_delete, sender=House)
+def house_deleted(sender, instance, using, **kwargs):
+    # Ao fim de move_house a cópia da origem é removida, mas o diretório já aponta para o destino
+    if is_sharded() and shard_for_house(instance.pk) == using:
+        house_id = instance.pk
+        transaction.on_commit(lambda: unregister_house(house_id), using=using)
+
+
+@receiver(post_migrate)
+def shard_migrated(sender, using, **kwargs):
+    if sender.name == 'automacao':
+        reserve_id_range(using)
+
+
+
+@receiver(device_states_committed)
+def device_states_trigger_scenes(sender, states, changed, **kwargs):
+    # Só transições: reescrever o estado atual (ex.: cena ligando o que já está ligado) não dispara
+    transitions = {device_id: states[device_id] for device_id in changed if device_id in states}
+    if transitions:
+        evaluate_device_states(transitions)
+
+
+@receiver(device_states_committed)
+def device_states_discard_pending(sender, states, **kwargs):
+    # Uma escrita direta no banco vale sobre o estado pendente do modo write-behind
+    buffer = get_state_buffer()
+    if buffer is not None:
+        buffer.discard(states)
+
+
+@receiver(post_save, sender=SceneTrigger)
+@receiver(post_delete, sender=SceneTrigger)
+def scene_trigger_changed(sender, instance, **kwargs):
+    # O agendador percebe a mudança pela assinatura dos gatilhos; aqui só o índice de regras por dispositivo
+    transaction.on_commit(get_device_rule_index().invalidate, using=current_db())
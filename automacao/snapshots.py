@@ -0,0 +1,76 @@
+'''
+Retrato compacto do estado de todos os dispositivos de uma casa.
+
+Monta um payload colunar (sem um objeto por dispositivo) a partir de uma única
+consulta, para painéis que só precisam saber o que está ligado:
+- devices: ids dos dispositivos, ordenados por cômodo e id
+- rooms / room_sizes: ids dos cômodos e quantos dispositivos de 'devices' são de cada um
+- activated: bitset em base64; o bit i (byte i // 8, bit menos significativo primeiro)
+  é o estado de devices[i]
+'''
+import base64
+
+from .models import House
+
+
+def pack_bits(values):
+    '''Empacota uma sequência de booleanos em bytes, 8 por byte, bit menos significativo primeiro.'''
+    packed = bytearray((len(values) + 7) // 8)
+    for index, value in enumerate(values):
+        if value:
+            packed[index >> 3] |= 1 << (index & 7)
+    return bytes(packed)
+
+
+def unpack_bits(data, count):
+    return [bool(data[index >> 3] & (1 << (index & 7))) for index in range(count)]
+
+
+def _snapshot_rows(house_id):
+    return (
+        House.objects.filter(pk=house_id)
+        .order_by('rooms__id', 'rooms__devices__id')
+        .values_list('version', 'rooms__id', 'rooms__devices__id', 'rooms__devices__activated')
+    )
+
+
+def _build_snapshot(house_id, rows):
+    version = None
+    devices, states, rooms, room_sizes = [], [], [], []
+    for version, room_id, device_id, activated in rows:
+        if room_id is None:
+            continue
+        if not rooms or rooms[-1] != room_id:
+            rooms.append(room_id)
+            room_sizes.append(0)
+        if device_id is not None:
+            devices.append(device_id)
+            states.append(activated)
+            room_sizes[-1] += 1
+
+    if version is None:
+        return None
+
+    return {
+        'house': int(house_id),
+        'version': version,
+        'changed': True,
+        'count': len(devices),
+        'devices': devices,
+        'rooms': rooms,
+        'room_sizes': room_sizes,
+        'activated': base64.b64encode(pack_bits(states)).decode('ascii'),
+    }
+
+
+def house_snapshot(house_id):
+    '''
+    Retorna o retrato da casa ou None se ela não existir.
+    Cômodos vazios aparecem com tamanho 0 (o LEFT JOIN devolve uma linha sem dispositivo).
+    '''
+    return _build_snapshot(house_id, _snapshot_rows(house_id))
+
+
+async def ahouse_snapshot(house_id):
+    '''Versão assíncrona de house_snapshot (mesma consulta, pelo ORM assíncrono).'''
+    return _build_snapshot(house_id, [row async for row in _snapshot_rows(house_id)])
@@ -1,3 +1,1449 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import tempfile
+import threading
+import time
+import uuid
+from io import StringIO
+from unittest import skipUnless
+from datetime import datetime, timedelta, timezone as dt_timezone
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import F
+from django.test import AsyncClient, AsyncRequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.timezone import now as timezone_now
+from rest_framework.test import APIClient
+
+from .cache import build_cache
+from .cron import CronSchedule
+from .events import get_broker
+from .history import StateHistoryWriter, device_on_time, prune_device_history, stop_history_writer
+from .idempotency import SingleFlight
+from . import engine, plans, responses, writebehind
+from .models import House, HouseShard, Room, Device, DeviceGroup, DeviceStateEvent, Scene, SceneAction, SceneRun, SceneTrigger
+from .plans import get_scene_plan
+from .profiling import RequestProfile, _current, _record_query, get_profiler, record_queries
+from .replicas import PIN_COOKIE, ReplicaPool
+from .responses import ResponseCache, get_response_cache
+from .services import apply_device_states, set_device_state
+from .routers import ShardRouter
+from .sharding import (
+    HOUSE_PATHS, SHARD_ID_SPAN, _directory, group_by_shard, house_is_moving, shard_for_house, shard_from_id, use_shard,
+)
+from .snapshots import unpack_bits
+from .triggers import (
+    DEVICE_TRIGGER_COOLDOWN, LAST_FIRED_MAX, DeviceRuleIndex, TriggerScheduler, evaluate_device_states, get_device_rule_index,
+)
+from .views import device_events
+
+
+# Nos testes o histórico é gravado na hora, dentro da transação de cada teste: a thread
+# do writer gravaria depois, inclusive depois de o banco de teste ser destruído
+_history_settings = override_settings(DEVICE_HISTORY_FLUSH_MS=0)
+
+
+def setUpModule():
+    _history_settings.enable()
+    stop_history_writer()
+
+
+def tearDownModule():
+    stop_history_writer()
+    _history_settings.disable()
+
+
+def criar_casa(rooms=1, devices_per_room=1, scenes=0, actions_per_scene=0):
+    '''Cria uma casa com cômodos, dispositivos e cenas para os testes.'''
+    house = House.objects.create(name='Casa', address='Rua A', owner='Maria')
+    devices = []
+    for r in range(rooms):
+        room = Room.objects.create(name=f'Comodo {r}', house=house)
+        devices += Device.objects.bulk_create(
+            Device(name=f'Dispositivo {d}', room=room) for d in range(devices_per_room)
+        )
+    for s in range(scenes):
+        scene = Scene.objects.create(name=f'Cena {s}', house=house)
+        SceneAction.objects.bulk_create(
+            SceneAction(scene=scene, device=devices[a % len(devices)], order=a + 1, newState=True)
+            for a in range(actions_per_scene)
+        )
+    return house
+
+
+class ListQueryCountTests(TestCase):
+    '''O número de consultas das listagens não pode crescer com a quantidade de linhas.'''
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def assertListQueries(self, url, num):
+        with self.assertNumQueries(num):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_rooms(self):
+        criar_casa(rooms=2, devices_per_room=2)
+        self.assertListQueries('/api/rooms/', 2)
+
+        criar_casa(rooms=20, devices_per_room=5)
+        response = self.assertListQueries('/api/rooms/', 2)
+        self.assertEqual(len(response.data['results']), 22)
+        self.assertEqual(response.data['results'][-1]['devices_count'], 5)
+        self.assertEqual(response.data['results'][-1]['devices'][0]['house_name'], 'Casa')
+
+    def test_devices(self):
+        criar_casa(rooms=1, devices_per_room=2)
+        self.assertListQueries('/api/devices/', 1)
+
+        criar_casa(rooms=10, devices_per_room=10)
+        self.assertListQueries('/api/devices/', 1)
+
+    def test_scenes(self):
+        criar_casa(rooms=1, devices_per_room=2, scenes=1, actions_per_scene=2)
+        self.assertListQueries('/api/scenes/', 2)
+
+        criar_casa(rooms=3, devices_per_room=3, scenes=10, actions_per_scene=8)
+        response = self.assertListQueries('/api/scenes/', 2)
+        self.assertEqual(response.data['results'][-1]['actions_count'], 8)
+        self.assertEqual(response.data['results'][-1]['actions'][0]['room_name'], 'Comodo 0')
+
+    def test_sparse_fields_skip_nested_queries(self):
+        criar_casa(rooms=5, devices_per_room=5)
+
+        response = self.assertListQueries('/api/rooms/?fields=id,name', 1)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'name'})
+
+        response = self.assertListQueries('/api/rooms/?fields=id&expand=devices', 2)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'devices'})
+
+    def test_cursor_pagination(self):
+        criar_casa(rooms=5, devices_per_room=1)
+
+        first = self.assertListQueries('/api/rooms/?page_size=2', 2)
+        second = self.assertListQueries(first.data['next'], 2)
+
+        self.assertEqual([room['name'] for room in second.data['results']], ['Comodo 2', 'Comodo 3'])
+
+    def test_scene_actions(self):
+        criar_casa(rooms=1, devices_per_room=2, scenes=1, actions_per_scene=2)
+        self.assertListQueries('/api/scene-actions/', 1)
+
+        criar_casa(rooms=2, devices_per_room=5, scenes=5, actions_per_scene=10)
+        self.assertListQueries('/api/scene-actions/', 1)
+
+
+class SceneExecutionQueryCountTests(TestCase):
+    '''Cenas sem intervalos executam em um número constante de consultas.'''
+
+    def setUp(self):
+        self.client = APIClient()
+
+    def executar(self, scene):
+        response = self.client.post(f'/api/scenes/{scene.id}/execute/')
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_constant_queries(self):
+        small = criar_casa(rooms=1, devices_per_room=5, scenes=1, actions_per_scene=5).scenes.get()
+        large = criar_casa(rooms=10, devices_per_room=20, scenes=1, actions_per_scene=200).scenes.get()
+
+        # Inclui o SELECT ... FOR UPDATE que trava os dispositivos em ordem de id
+        with self.assertNumQueries(9):
+            self.executar(small)
+        with self.assertNumQueries(9):
+            self.executar(large)
+
+        self.assertEqual(Device.objects.filter(room__house=large.house, activated=True).count(), 200)
+
+    def test_later_action_wins(self):
+        house = criar_casa(rooms=1, devices_per_room=2)
+        first, second = Device.objects.filter(room__house=house).order_by('id')
+        scene = Scene.objects.create(name='Cena', house=house)
+        SceneAction.objects.bulk_create([
+            SceneAction(scene=scene, device=first, order=1, newState=True),
+            SceneAction(scene=scene, device=second, order=2, newState=True),
+            SceneAction(scene=scene, device=first, order=3, newState=False),
+        ])
+
+        response = self.executar(scene)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertFalse(first.activated)
+        self.assertTrue(second.activated)
+        self.assertEqual(scene.runs.get(pk=response.data['run_id']).status, 'completed')
+
+
+class SceneEngineTests(TransactionTestCase):
+    '''Execuções com intervalo no motor de cenas (com commits de verdade, vistos pelas threads do motor).'''
+
+    def setUp(self):
+        self.engine = engine._engine = engine.SceneEngine(max_workers=2, heartbeat=60, stale_after=120)
+        house = criar_casa(rooms=1, devices_per_room=3)
+        self.devices = list(Device.objects.filter(room__house=house).order_by('id'))
+        self.scene = Scene.objects.create(name='Cena', house=house)
+        SceneAction.objects.bulk_create([
+            SceneAction(scene=self.scene, device=self.devices[0], order=1, newState=True),
+            SceneAction(scene=self.scene, device=self.devices[1], order=2, newState=True, interval=1),
+            SceneAction(scene=self.scene, device=self.devices[2], order=3, newState=True),
+        ])
+        self.client = APIClient()
+
+    def tearDown(self):
+        self.engine.stop()
+        engine._engine = None
+
+    def executar(self):
+        '''Executa a cena pela API; retorna o id do SceneRun e o seu RunProgress no motor.'''
+        response = self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+        self.assertEqual(response.status_code, 202)
+        run_id = response.data['run_id']
+        # O motor recebe a execução no on_commit da própria requisição
+        progress = self.engine.progress(run_id)
+        self.assertIsNotNone(progress)
+        return run_id, progress
+
+    def wait_steps(self, run_id, progress, steps_done):
+        # Espera o motor (sem consultar o banco em laço, o que disputaria a trava do SQLite)
+        self.assertTrue(progress.wait(steps_done, timeout=5))
+        return SceneRun.objects.get(pk=run_id)
+
+    def wait_finished(self, progress):
+        self.assertTrue(progress.wait(timeout=5))
+
+    def states(self):
+        return list(Device.objects.filter(pk__in=[d.pk for d in self.devices]).order_by('id').values_list('activated', flat=True))
+
+    def test_run_applies_batches_after_each_interval(self):
+        run_id, progress = self.executar()
+
+        run = self.wait_steps(run_id, progress, 1)
+        self.assertEqual((run.status, run.steps_total), (SceneRun.RUNNING, 3))
+        self.assertIsNotNone(run.heartbeat_at)
+        self.assertEqual(self.states(), [True, False, False])
+
+        self.wait_finished(progress)
+        self.assertEqual(progress.steps_done, 3)
+        run = SceneRun.objects.get(pk=run_id)
+        self.assertEqual((run.status, run.steps_done, run.error), (SceneRun.COMPLETED, 3, None))
+        self.assertGreaterEqual((run.finished_at - run.started_at).total_seconds(), 1)
+        self.assertEqual(self.states(), [True, True, True])
+
+    def test_cancel(self):
+        run_id, progress = self.executar()
+        self.wait_steps(run_id, progress, 1)
+
+        response = self.client.post(f'/api/scene-runs/{run_id}/cancel/')
+        self.assertEqual((response.status_code, response.data['status']), (200, SceneRun.CANCELLED))
+        self.assertEqual(self.client.post(f'/api/scene-runs/{run_id}/cancel/').status_code, 409)
+
+        self.wait_finished(progress)
+        self.assertEqual(SceneRun.objects.get(pk=run_id).steps_done, 1)
+        self.assertEqual(self.states(), [True, False, False])
+
+    def test_cancel_from_another_process(self):
+        # Só o banco muda (o motor deste processo não é avisado): o próximo lote não é aplicado
+        run_id, progress = self.executar()
+        self.wait_steps(run_id, progress, 1)
+        SceneRun.objects.filter(pk=run_id).update(status=SceneRun.CANCELLED)
+
+        self.wait_finished(progress)
+        run = SceneRun.objects.get(pk=run_id)
+        self.assertEqual((run.status, run.steps_done), (SceneRun.CANCELLED, 1))
+        self.assertEqual(self.states(), [True, False, False])
+
+    def test_reap_stale_runs(self):
+        old = timezone_now() - timedelta(minutes=10)
+        orphan = SceneRun.objects.create(scene=self.scene, status=SceneRun.RUNNING, heartbeat_at=old)
+        never_started = SceneRun.objects.create(scene=self.scene)
+        alive = SceneRun.objects.create(scene=self.scene, status=SceneRun.RUNNING, heartbeat_at=timezone_now())
+        queued = SceneRun.objects.create(scene=self.scene)
+        completed = SceneRun.objects.create(scene=self.scene, status=SceneRun.COMPLETED)
+        SceneRun.objects.filter(pk__in=[never_started.pk, completed.pk]).update(created_at=old)
+
+        self.assertEqual(engine.reap_stale_runs(120), 2)
+        self.assertEqual(
+            dict(SceneRun.objects.values_list('pk', 'status')),
+            {orphan.pk: SceneRun.FAILED, never_started.pk: SceneRun.FAILED, alive.pk: SceneRun.RUNNING,
+             queued.pk: SceneRun.QUEUED, completed.pk: SceneRun.COMPLETED}
+        )
+        self.assertEqual(SceneRun.objects.get(pk=orphan.pk).error, engine.STALE_ERROR)
+
+
+class BulkSetStateTests(TestCase):
+    '''bulk_set_state: lista de dispositivos ou seletor de cômodo/casa.'''
+    url = '/api/devices/bulk_set_state/'
+
+    def setUp(self):
+        self.house = criar_casa(rooms=2, devices_per_room=3)
+        self.other = criar_casa(rooms=1, devices_per_room=2)
+        self.room = self.house.rooms.order_by('id').first()
+
+    def post(self, data):
+        return self.client.post(self.url, data, content_type='application/json')
+
+    def states(self, house):
+        return list(Device.objects.filter(room__house=house).order_by('id').values_list('activated', 'version'))
+
+    def test_device_list_reports_missing_ids(self):
+        first, second = Device.objects.filter(room__house=self.house).order_by('id').values_list('id', flat=True)[:2]
+        response = self.post({'devices': [{'id': first, 'activated': True}, {'id': second, 'activated': False}, {'id': 999999, 'activated': True}]})
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'updated': 2, 'results': [
+            {'id': first, 'status': 'updated', 'new_state': True},
+            {'id': second, 'status': 'updated', 'new_state': False},
+            {'id': 999999, 'status': 'not found'},
+        ]})
+        self.assertEqual(self.states(self.house)[:3], [(True, 1), (False, 1), (False, 0)])
+
+    def test_room_and_house_selectors(self):
+        response = self.post({'room': self.room.id, 'activated': True})
+        self.assertEqual(response.json()['updated'], 3)
+        self.assertEqual(self.states(self.house), [(True, 1)] * 3 + [(False, 0)] * 3)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.post({'house': self.house.id, 'activated': False})
+        self.assertEqual(response.json()['updated'], 6)
+        self.assertEqual({item['status'] for item in response.json()['results']}, {'updated'})
+        # Um UPDATE só, com o filtro como subconsulta
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "automacao_device"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('IN (SELECT', updates[0])
+        self.assertEqual(self.states(self.house), [(False, 2)] * 3 + [(False, 1)] * 3)
+        self.assertEqual(self.states(self.other), [(False, 0)] * 2)
+
+    def test_invalid_bodies(self):
+        self.assertEqual(self.post({'room': self.room.id, 'house': self.house.id, 'activated': True}).status_code, 400)
+        self.assertEqual(self.post({'room': self.room.id}).status_code, 400)
+        self.assertEqual(self.post({'devices': []}).status_code, 400)
+        device = Device.objects.filter(room=self.room).first()
+        self.assertEqual(self.post({'devices': [{'id': device.id, 'activated': True}] * 2}).status_code, 400)
+
+
+class ScenePlanCacheTests(TestCase):
+    '''Com o plano da cena em cache, a execução não lê a cena nem as ações no banco.'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.house = criar_casa(rooms=1, devices_per_room=3, scenes=1, actions_per_scene=3)
+        self.scene = self.house.scenes.get()
+
+    def test_warm_cache_only_locks_devices(self):
+        self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+
+        self.assertEqual(response.status_code, 200)
+        # A única leitura é a trava dos dispositivos (SELECT ... FOR UPDATE), nada da cena ou das ações
+        reads = [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+        self.assertEqual(len(reads), 1)
+        self.assertNotIn('automacao_scene', reads[0])
+
+    def test_set_scene_actions_invalidates_plan(self):
+        self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+        device = Device.objects.filter(room__house=self.house).first()
+        Device.objects.update(activated=True)
+
+        response = self.client.post(
+            f'/api/scenes/{self.scene.id}/set_scene_actions/',
+            [{'device_id': device.id, 'order': 1, 'newState': False}],
+            format='json',
+        )
+        self.assertEqual(response.status_code, 201)
+        self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+
+        self.assertEqual(Device.objects.filter(activated=False).get(), device)
+
+    def test_toggle_activation_invalidates_plan(self):
+        self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+        self.client.patch(f'/api/scenes/{self.scene.id}/toggle_activation/', {'activated': False}, format='json')
+
+        response = self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+
+        self.assertEqual(response.status_code, 403)
+
+    def test_plan_expires_after_ttl(self):
+        plans._cache = build_cache('local', 16, prefix='automacao:scene-plan', ttl=0.05)
+        self.addCleanup(setattr, plans, '_cache', None)
+        self.client.post(f'/api/scenes/{self.scene.id}/execute/')
+
+        # Alteração feita por outro processo: nenhum sinal invalida o cache deste
+        SceneAction.objects.filter(scene=self.scene).update(newState=False)
+        self.assertTrue(all(state for _, state, _ in get_scene_plan(self.scene.id).steps))
+
+        time.sleep(0.06)
+        self.assertFalse(any(state for _, state, _ in get_scene_plan(self.scene.id).steps))
+        self.assertEqual(plans._cache.stats()['ttl'], 0.05)
+
+
+class DeviceEventsTests(TestCase):
+    '''Stream SSE de device_events e o InMemoryBroker.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=2, devices_per_room=2, scenes=1, actions_per_scene=2)
+        self.other = criar_casa(rooms=1, devices_per_room=1)
+        self.devices = list(Device.objects.filter(room__house=self.house).order_by('id'))
+
+    def write(self, method, url, data=None):
+        '''Faz a requisição do DRF rodando os efeitos de após o commit, como em produção.'''
+        with self.captureOnCommitCallbacks(execute=True):
+            return getattr(APIClient(), method)(url, data, format='json')
+
+    async def open_stream(self, **params):
+        request = AsyncRequestFactory().get('/api/events/devices/', params)
+        response = await device_events(request)
+        stream = response.streaming_content
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        self.assertEqual(await anext(stream), b'retry: 3000\n\n')
+        return stream
+
+    async def next_event(self, stream):
+        chunk = await asyncio.wait_for(anext(stream), 1)
+        self.assertTrue(chunk.startswith(b'data: '))
+        return json.loads(chunk[len(b'data: '):])
+
+    async def test_set_state_events_for_the_house(self):
+        broker = get_broker()
+        stream = await self.open_stream(house=self.house.id)
+        device = self.devices[0]
+
+        # Mudanças em outra casa não chegam a este cliente
+        other_device = await Device.objects.aget(room__house=self.other)
+        await sync_to_async(self.write)('post', f'/api/devices/{other_device.id}/set_state/', {'activated': True})
+        await sync_to_async(self.write)('post', f'/api/devices/{device.id}/set_state/', {'activated': True})
+
+        self.assertEqual(await self.next_event(stream), {
+            'device': device.id, 'room': device.room_id, 'house': self.house.id, 'activated': True,
+        })
+
+        # A desconexão (cancelamento da tarefa da resposta pelo ASGI) remove a inscrição
+        pending = asyncio.ensure_future(anext(stream))
+        await asyncio.sleep(0)
+        self.assertTrue(broker.has_subscribers())
+        pending.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await pending
+        self.assertFalse(broker.has_subscribers())
+
+    async def test_scene_and_bulk_events_for_the_room(self):
+        room_id = self.devices[0].room_id
+        stream = await self.open_stream(room=room_id)
+        scene = await Scene.objects.aget(house=self.house)
+
+        response = await sync_to_async(self.write)('post', f'/api/scenes/{scene.id}/execute/')
+        self.assertEqual(response.status_code, 200)
+        events = [await self.next_event(stream) for _ in range(2)]
+        self.assertEqual(
+            sorted((event['device'], event['activated']) for event in events),
+            [(self.devices[0].id, True), (self.devices[1].id, True)]
+        )
+
+        await sync_to_async(self.write)('post', '/api/devices/bulk_set_state/', {'house': self.house.id, 'activated': False})
+        events = [await self.next_event(stream) for _ in range(2)]
+        self.assertEqual({event['room'] for event in events}, {room_id})
+        self.assertEqual(sorted(event['device'] for event in events), [self.devices[0].id, self.devices[1].id])
+        await stream.aclose()
+
+    async def test_requires_one_numeric_filter(self):
+        for params in ({}, {'house': 1, 'room': 1}, {'house': 'x'}):
+            response = await device_events(AsyncRequestFactory().get('/api/events/devices/', params))
+            self.assertEqual(response.status_code, 400)
+
+
+class UniqueNameTests(TestCase):
+    '''As restrições de unicidade do banco viram erros 400 no campo violado.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=2, devices_per_room=1, scenes=1)
+        self.rooms = list(self.house.rooms.order_by('id'))
+
+    def test_room_and_scene_names_ignore_case(self):
+        response = self.client.post('/api/rooms/', {'name': 'COMODO 0', 'house': self.house.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'name': ["Já existe um cômodo chamado 'COMODO 0' nesta casa."]})
+
+        response = self.client.post('/api/scenes/', {'name': 'cena 0', 'house': self.house.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('name', response.json())
+
+        # Outra casa pode repetir o nome; a transação da requisição segue utilizável após a violação
+        other = criar_casa()
+        response = self.client.post('/api/rooms/', {'name': 'Comodo 1', 'house': other.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_device_rename_into_existing_name(self):
+        first, second = Device.objects.filter(room=self.rooms[0]).get(), Device.objects.filter(room=self.rooms[1]).get()
+        Device.objects.filter(pk=second.pk).update(name='Lampada')
+        Device.objects.filter(pk=first.pk).update(name='Abajur', room=self.rooms[1])
+
+        response = self.client.patch(f'/api/devices/{first.id}/', {'name': 'LAMPADA'}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'name': ["Já existe um dispositivo chamado 'LAMPADA' neste cômodo."]})
+        first.refresh_from_db()
+        self.assertEqual((first.name, first.version), ('Abajur', 0))
+
+    def test_scene_action_order(self):
+        scene = self.house.scenes.get()
+        device = Device.objects.filter(room__house=self.house).first()
+        SceneAction.objects.create(scene=scene, device=device, order=1, newState=True)
+        response = self.client.post('/api/scene-actions/', {'scene': scene.id, 'device': device.id, 'order': 1, 'newState': False}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+
+class DeviceHistoryTests(TestCase):
+    '''Histórico de estado: gravação em lote e tempo ligado calculado no banco.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=1, devices_per_room=3)
+        self.devices = list(Device.objects.filter(room__house=self.house).order_by('id').values_list('id', flat=True))
+        self.t0 = datetime(2026, 1, 1, 12, 0, tzinfo=dt_timezone.utc)
+
+    def events(self, *changes):
+        DeviceStateEvent.objects.bulk_create(
+            DeviceStateEvent(device_id=device_id, activated=activated, changed_at=self.t0 + timedelta(minutes=minutes))
+            for device_id, activated, minutes in changes
+        )
+
+    def test_buffered_writer(self):
+        writer = StateHistoryWriter(batch_size=100, flush_interval_ms=60000)
+        try:
+            writer.record({self.devices[0]: True, self.devices[1]: False})
+            writer.record({self.devices[0]: False})
+            self.assertFalse(DeviceStateEvent.objects.exists())
+            with self.assertNumQueries(1):
+                self.assertEqual(writer.flush(), 3)
+            self.assertEqual(writer.flush(), 0)
+        finally:
+            self.assertEqual(writer.stop(), 0)
+        self.assertEqual(
+            sorted(DeviceStateEvent.objects.values_list('device_id', 'activated')),
+            sorted([(self.devices[0], True), (self.devices[1], False), (self.devices[0], False)]),
+        )
+
+        # Parado, o writer grava na hora
+        writer.record({self.devices[2]: True})
+        self.assertTrue(DeviceStateEvent.objects.filter(device_id=self.devices[2]).exists())
+
+    def test_only_transitions_are_recorded(self):
+        first, second, third = self.devices
+        Device.objects.filter(pk=first).update(activated=True)
+
+        # Em lote e por set_state, reescrever o estado atual não gera evento
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_device_states({first: True, second: True})
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/devices/{third}/set_state/', {'activated': False}, content_type='application/json')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/devices/{first}/set_state/', {'activated': False}, content_type='application/json')
+
+        self.assertEqual(
+            sorted(DeviceStateEvent.objects.values_list('device_id', 'activated')),
+            [(first, False), (second, True)],
+        )
+
+    def test_on_time(self):
+        first, second, third = self.devices
+        self.events(
+            # Ligado de 0 a 10 e de 30 em diante (período aberto)
+            (first, True, 0), (first, False, 10), (first, True, 30),
+            # Ligado desde antes do intervalo, sem desligar
+            (second, True, -60),
+            # Ligado e desligado antes do intervalo
+            (third, True, -30), (third, False, -20),
+        )
+        start, end = self.t0 + timedelta(minutes=5), self.t0 + timedelta(minutes=40)
+
+        self.assertEqual(device_on_time(start, end), {first: 15 * 60, second: 35 * 60})
+
+        params = {'start': start.isoformat(), 'end': end.isoformat()}
+        response = self.client.get(f'/api/devices/{first}/on_time/', params)
+        self.assertEqual(response.json()['on_seconds'], 15 * 60)
+        response = self.client.get('/api/devices/on_time/', {**params, 'house': self.house.id})
+        self.assertEqual(response.json()['results'], [{'device': first, 'on_seconds': 900}, {'device': second, 'on_seconds': 2100}])
+        self.assertEqual(self.client.get('/api/devices/on_time/', {'start': end.isoformat(), 'end': start.isoformat()}).status_code, 400)
+
+    def test_prune(self):
+        old = timezone_now() - timedelta(days=91)
+        DeviceStateEvent.objects.create(device_id=self.devices[0], activated=True, changed_at=old)
+        DeviceStateEvent.objects.create(device_id=self.devices[0], activated=False, changed_at=timezone_now())
+        self.assertEqual(prune_device_history(90), 1)
+        self.assertEqual(DeviceStateEvent.objects.count(), 1)
+
+
+class ConditionalGetTests(TestCase):
+    '''Leituras com If-None-Match atual custam só a consulta da versão da casa.'''
+
+    def setUp(self):
+        self.client = APIClient()
+        get_response_cache().clear()
+        self.house = criar_casa(rooms=3, devices_per_room=3)
+        self.url = f'/api/rooms/?house={self.house.id}'
+
+    def test_not_modified(self):
+        # Listagem de dispositivos: não passa pelo cache de respostas
+        url = f'/api/devices/?room={self.house.rooms.first().id}'
+        etag = self.client.get(url)['ETag']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+
+    def test_write_changes_etag(self):
+        etag = self.client.get(self.url)['ETag']
+        room = self.house.rooms.first()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.patch(f'/api/rooms/{room.id}/', {'name': 'Cozinha'}, format='json')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class ResponseCacheTests(TestCase):
+    '''Leituras repetidas de cômodos e cenas saem do cache, e as escritas o invalidam.'''
+
+    def setUp(self):
+        self.client = APIClient()
+        get_response_cache().clear()
+        self.house = criar_casa(rooms=2, devices_per_room=3, scenes=1, actions_per_scene=3)
+        self.room = self.house.rooms.order_by('id').first()
+        self.scene = self.house.scenes.get()
+
+    def test_hot_reads_skip_database(self):
+        hits_before = get_response_cache().stats()['hits']
+        url = f'/api/rooms/?house={self.house.id}'
+        first = self.client.get(url)
+
+        # Com o cache local, só a versão da casa
+        with self.assertNumQueries(1):
+            second = self.client.get(url)
+        self.assertEqual(second.data, first.data)
+
+        # O detalhe entra no cache a partir da segunda leitura (a primeira descobre a casa)
+        self.client.get(f'/api/scenes/{self.scene.id}/')
+        self.client.get(f'/api/scenes/{self.scene.id}/')
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/scenes/{self.scene.id}/')
+        self.assertEqual(response.data['actions_count'], 3)
+
+        metrics = self.client.get('/api/metrics/').data['response_cache']
+        self.assertEqual(metrics['hits'] - hits_before, 2)
+
+    def test_write_from_another_process_is_seen(self):
+        url = f'/api/rooms/?house={self.house.id}'
+        self.client.get(url)
+        self.client.get(url)
+
+        # Outro processo grava e incrementa a versão; as gerações deste não mudam
+        Device.objects.filter(pk=self.room.devices.order_by('id').first().pk).update(name='Abajur')
+        House.objects.filter(pk=self.house.pk).update(version=F('version') + 1)
+
+        self.assertEqual(self.client.get(url).data['results'][0]['devices'][0]['name'], 'Abajur')
+
+    def test_shared_backend_hits_skip_database(self):
+        responses._cache = ResponseCache(build_cache('default', 0, prefix='automacao:responses:test'))
+        self.addCleanup(setattr, responses, '_cache', None)
+        self.addCleanup(caches['default'].clear)
+        url = f'/api/rooms/?house={self.house.id}'
+        first = self.client.get(url)
+
+        with self.assertNumQueries(0):
+            second = self.client.get(url)
+        self.assertEqual(second.data, first.data)
+
+    def test_device_rename_invalidates_room_and_scenes(self):
+        rooms_url = f'/api/rooms/?house={self.house.id}'
+        scene_url = f'/api/scenes/{self.scene.id}/'
+        self.client.get(rooms_url)
+        self.client.get(scene_url)
+        self.client.get(scene_url)
+
+        device = self.room.devices.order_by('id').first()
+        device.name = 'Abajur'
+        with self.captureOnCommitCallbacks(execute=True):
+            device.save(update_fields=['name'])
+
+        rooms = self.client.get(rooms_url).data['results']
+        self.assertEqual(rooms[0]['devices'][0]['name'], 'Abajur')
+        actions = self.client.get(scene_url).data['actions']
+        self.assertIn('Abajur', [action['device_name'] for action in actions])
+
+    def test_set_scene_actions_invalidates_scene(self):
+        url = f'/api/scenes/{self.scene.id}/'
+        self.client.get(url)
+        self.client.get(url)
+
+        device = self.room.devices.first()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(
+                f'/api/scenes/{self.scene.id}/set_scene_actions/',
+                [{'device_id': device.id, 'order': 1, 'newState': False, 'interval': 0}],
+                format='json',
+            )
+
+        self.assertEqual(self.client.get(url).data['actions_count'], 1)
+
+
+class HouseSnapshotTests(TestCase):
+    '''O retrato da casa sai de uma única consulta, em formato colunar.'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.house = criar_casa(rooms=3, devices_per_room=4)
+        Device.objects.filter(room__house=self.house, name='Dispositivo 1').update(activated=True)
+        Room.objects.create(name='Vazio', house=self.house)
+        self.url = f'/api/houses/{self.house.id}/snapshot/'
+
+    def test_snapshot(self):
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url)
+
+        data = response.data
+        self.assertEqual(data['count'], 12)
+        self.assertEqual(data['room_sizes'], [4, 4, 4, 0])
+        expected = dict(Device.objects.filter(room__house=self.house).values_list('id', 'activated'))
+        states = unpack_bits(base64.b64decode(data['activated']), data['count'])
+        self.assertEqual(dict(zip(data['devices'], states)), expected)
+
+    def test_since_current_version(self):
+        version = self.client.get(self.url).data['version']
+
+        with self.assertNumQueries(1):
+            response = self.client.get(self.url, {'since': version})
+        self.assertEqual(response.data, {'house': self.house.id, 'version': version, 'changed': False})
+
+        self.assertTrue(self.client.get(self.url, {'since': version + 1}).data['changed'])
+
+
+class SceneTriggerTests(TestCase):
+    '''Agendas cron pelo heap do agendador e regras por estado pelo índice de dispositivos.'''
+
+    def setUp(self):
+        get_device_rule_index().invalidate()
+        # Motor próprio, encerrado ao fim do teste (as execuções enfileiradas não passam da fila)
+        engine._engine = engine.SceneEngine(max_workers=1)
+        self.addCleanup(setattr, engine, '_engine', None)
+        self.addCleanup(engine._engine.stop)
+        self.house = criar_casa(rooms=1, devices_per_room=2, scenes=2, actions_per_scene=2)
+        self.device = Device.objects.filter(room__house=self.house).first()
+        self.scenes = list(self.house.scenes.order_by('id'))
+
+    def test_cron_next_after(self):
+        # Dias úteis às 7h30; 2026-10-16 é uma sexta-feira
+        schedule = CronSchedule('30 7 * * 1-5')
+        moment = datetime(2026, 10, 16, 8, 0, tzinfo=dt_timezone.utc)
+        self.assertEqual(schedule.next_after(moment), datetime(2026, 10, 19, 7, 30, tzinfo=dt_timezone.utc))
+
+        with self.assertRaises(ValueError):
+            CronSchedule('61 * * * *')
+
+    def test_scheduler_pops_due_triggers_in_order(self):
+        SceneTrigger.objects.create(scene=self.scenes[0], kind=SceneTrigger.SCHEDULE, cron='*/10 * * * *')
+        SceneTrigger.objects.create(scene=self.scenes[1], kind=SceneTrigger.SCHEDULE, cron='5 * * * *')
+        scheduler = TriggerScheduler()
+        scheduler.load(datetime(2026, 10, 16, 8, 0, tzinfo=dt_timezone.utc))
+
+        due = scheduler.pop_due(datetime(2026, 10, 16, 8, 10, tzinfo=dt_timezone.utc))
+
+        self.assertEqual([scene_id for _, scene_id in due], [self.scenes[1].id, self.scenes[0].id])
+        self.assertEqual(scheduler.next_fire_at(), datetime(2026, 10, 16, 8, 20, tzinfo=dt_timezone.utc))
+        self.assertFalse(scheduler.reload_if_changed(datetime(2026, 10, 16, 8, 10, tzinfo=dt_timezone.utc)))
+
+    def test_device_state_rule_queues_scene(self):
+        trigger = SceneTrigger.objects.create(
+            scene=self.scenes[0], kind=SceneTrigger.DEVICE_STATE, device=self.device, state=True,
+        )
+
+        evaluate_device_states({self.device.id: False})
+        self.assertFalse(SceneRun.objects.exists())
+
+        evaluate_device_states({self.device.id: True})
+        run = SceneRun.objects.get()
+        self.assertEqual((run.scene_id, run.trigger_id, run.status), (self.scenes[0].id, trigger.id, SceneRun.QUEUED))
+
+    def test_only_transitions_fire(self):
+        trigger = SceneTrigger.objects.create(
+            scene=self.scenes[0], kind=SceneTrigger.DEVICE_STATE, device=self.device, state=True,
+        )
+        client = APIClient()
+        index = get_device_rule_index()
+
+        def fired_after(write):
+            index._last_fired.clear()  # sem o intervalo mínimo entre disparos
+            with self.captureOnCommitCallbacks(execute=True):
+                write()
+            return SceneRun.objects.filter(trigger=trigger).count()
+
+        self.assertEqual(fired_after(lambda: client.post(f'/api/devices/{self.device.id}/set_state/', {'activated': True}, format='json')), 1)
+        # Escritas com o estado que o dispositivo já tem não são transições
+        self.assertEqual(fired_after(lambda: client.post(f'/api/devices/{self.device.id}/set_state/', {'activated': True}, format='json')), 1)
+        self.assertEqual(fired_after(lambda: client.post(f'/api/scenes/{self.scenes[1].id}/execute/')), 1)
+        self.assertEqual(fired_after(lambda: client.post('/api/devices/bulk_set_state/', {'house': self.house.id, 'activated': True}, format='json')), 1)
+
+        def rename():
+            device = Device.objects.get(pk=self.device.pk)
+            device.name = 'Abajur'
+            device.save()
+        self.assertEqual(fired_after(rename), 1)
+
+        self.assertEqual(fired_after(lambda: apply_device_states({self.device.id: False})), 1)
+        self.assertEqual(fired_after(lambda: apply_device_states({self.device.id: True})), 2)
+
+    def test_last_fired_is_bounded(self):
+        index = DeviceRuleIndex()
+        for trigger_id in range(3 * LAST_FIRED_MAX):
+            with index._lock:
+                index._remember_fired(trigger_id, trigger_id * DEVICE_TRIGGER_COOLDOWN)
+        self.assertLessEqual(len(index._last_fired), LAST_FIRED_MAX)
+
+    def test_api_validates_trigger_fields(self):
+        client = APIClient()
+        other_house = criar_casa(rooms=1, devices_per_room=1)
+        response = client.post('/api/scene-triggers/', {
+            'scene': self.scenes[0].id, 'kind': 'device_state',
+            'device': Device.objects.get(room__house=other_house).id, 'state': True,
+        }, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('device', response.data)
+
+        response = client.post('/api/scene-triggers/', {'scene': self.scenes[0].id, 'kind': 'schedule', 'cron': '0 7 * *'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('cron', response.data)
+
+
+class DeviceConcurrencyTests(TestCase):
+    '''Escritas em dispositivos são condicionais à versão (If-Match) e não sobrescrevem outros campos.'''
+
+    def setUp(self):
+        self.client = APIClient()
+        self.device = Device.objects.filter(room__house=criar_casa(rooms=1, devices_per_room=1)).get()
+        self.url = f'/api/devices/{self.device.id}/'
+
+    def test_set_state_if_match(self):
+        response = self.client.post(f'{self.url}set_state/', {'activated': True}, format='json', HTTP_IF_MATCH='"0"')
+        self.assertEqual((response.status_code, response.data['version']), (200, 1))
+
+        response = self.client.post(f'{self.url}set_state/', {'activated': False}, format='json', HTTP_IF_MATCH='"0"')
+        self.assertEqual((response.status_code, response.data['version']), (412, 1))
+        self.device.refresh_from_db()
+        self.assertTrue(self.device.activated)
+
+    def test_set_state_does_not_clobber_rename(self):
+        stale = Device.objects.get(pk=self.device.pk)
+        Device.objects.filter(pk=self.device.pk).update(name='Abajur', version=5)
+
+        # Sem versão esperada vale a última escrita do estado, relendo a versão no conflito
+        # (a tentativa que conflita faz os dois UPDATEs: o da transição e o incondicional)
+        with self.assertNumQueries(4):
+            set_device_state(stale, True)
+        self.assertEqual(stale.version, 6)
+
+        stale.refresh_from_db()
+        self.assertEqual((stale.name, stale.activated), ('Abajur', True))
+
+    def test_patch_if_match(self):
+        response = self.client.patch(self.url, {'name': 'Abajur'}, format='json', HTTP_IF_MATCH='"1"')
+        self.assertEqual(response.status_code, 412)
+
+        response = self.client.patch(self.url, {'name': 'Abajur'}, format='json', HTTP_IF_MATCH='"0"')
+        self.assertEqual((response.status_code, response.data['version']), (200, 1))
+
+
+@override_settings(AUTOMACAO_SHARDS=['default', 'shard1'])
+class ShardDirectoryTests(TestCase):
+    '''O diretório de casas decide o shard; sem entrada vale a faixa do id.'''
+
+    def setUp(self):
+        _directory.clear()
+        self.addCleanup(_directory.clear)
+
+    def test_id_ranges(self):
+        self.assertEqual(shard_from_id(SHARD_ID_SPAN - 1), 'default')
+        self.assertEqual(shard_from_id(SHARD_ID_SPAN + 7), 'shard1')
+        self.assertEqual(shard_for_house(SHARD_ID_SPAN + 7), 'shard1')
+
+    def test_directory_overrides_id_range(self):
+        house = criar_casa(rooms=1, devices_per_room=2)
+        devices = list(Device.objects.values_list('id', flat=True))
+        self.assertEqual(group_by_shard(Device, devices), {'default': devices})
+
+        HouseShard.objects.create(house_id=house.id, shard='shard1', status=HouseShard.MOVING)
+        _directory.clear()
+        self.assertEqual(shard_for_house(house.id), 'shard1')
+        self.assertTrue(house_is_moving(house.id))
+
+        response = APIClient().post(f'/api/devices/{devices[0]}/set_state/', {'activated': True}, format='json')
+        self.assertEqual(response.status_code, 503)
+
+
+@skipUnless('shard1' in settings.DATABASES, 'requer um segundo shard (ex.: DB_SHARDS=shard1)')
+@override_settings(AUTOMACAO_SHARDS=['default', 'shard1'], SHARD_DIRECTORY_TTL=0)
+class ShardMoveTests(TransactionTestCase):
+    '''
+    Com dois shards de verdade: move_house copia todas as tabelas da casa, a API segue a
+    casa no novo shard e as listagens juntam os dois shards.
+    '''
+    # Sem o alias, a classe é pulada, mas o runner ainda criaria os bancos pedidos
+    databases = {'default', 'shard1'} & set(settings.DATABASES)
+
+    def setUp(self):
+        _directory.clear()
+        self.addCleanup(_directory.clear)
+        get_response_cache().clear()
+        self.house = criar_casa(rooms=2, devices_per_room=2, scenes=1, actions_per_scene=3)
+        self.devices = list(Device.objects.filter(room__house=self.house).order_by('id'))
+        scene = self.house.scenes.get()
+        SceneTrigger.objects.create(scene=scene, kind=SceneTrigger.SCHEDULE, cron='0 7 * * *')
+        SceneRun.objects.create(scene=scene, status=SceneRun.COMPLETED)
+        group = DeviceGroup.objects.create(name='Grupo', house=self.house)
+        group.devices.set(self.devices[:3])
+        DeviceStateEvent.objects.create(device=self.devices[0], activated=True, changed_at=timezone_now())
+
+    def rows(self, alias):
+        return {model: model.objects.using(alias).filter(**{path: self.house.id}).count() for model, path in HOUSE_PATHS.items()}
+
+    def test_move_house(self):
+        before = self.rows('default')
+        self.assertEqual(before[DeviceGroup.devices.through], 3)
+        self.assertTrue(all(before.values()))
+
+        call_command('move_house', self.house.id, 'shard1', stdout=StringIO())
+
+        # Todas as tabelas (inclusive a intermediária do M2M) foram copiadas e removidas da origem
+        self.assertEqual(self.rows('shard1'), before)
+        self.assertFalse(any(self.rows('default').values()))
+        self.assertEqual(
+            HouseShard.objects.values_list('shard', 'status').get(house_id=self.house.id),
+            ('shard1', HouseShard.ACTIVE)
+        )
+        self.assertEqual(shard_for_house(self.house.id), 'shard1')
+
+        # Leitura e escrita pela API seguem a casa
+        device = self.devices[0]
+        response = self.client.get(f'/api/devices/{device.id}/')
+        self.assertEqual((response.status_code, response.json()['name']), (200, device.name))
+        response = self.client.post(f'/api/devices/{device.id}/set_state/', {'activated': True}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(Device.objects.using('shard1').get(pk=device.id).activated)
+        self.assertFalse(Device.objects.using('default').filter(pk=device.id).exists())
+
+        # Uma lista sem casa junta as páginas dos dois shards pelo id, e o cursor vale para os dois
+        other = criar_casa()
+        response = self.client.get('/api/houses/', {'page_size': 1})
+        self.assertEqual([house['id'] for house in response.json()['results']], [self.house.id])
+        response = self.client.get(response.json()['next'])
+        self.assertEqual([house['id'] for house in response.json()['results']], [other.id])
+        self.assertIsNone(response.json()['next'])
+
+    def test_router_and_prune_on_both_shards(self):
+        router = ShardRouter()
+        with use_shard('shard1'):
+            self.assertEqual(router.db_for_read(Device), 'shard1')
+            self.assertEqual(router.db_for_write(Device), 'shard1')
+            # O diretório fica só no default
+            self.assertEqual(router.db_for_write(HouseShard), 'default')
+            other = criar_casa()
+        self.assertEqual(shard_from_id(other.id), 'shard1')
+        self.assertEqual(router.db_for_read(Device, instance=self.devices[0]), 'default')
+        remote = Device.objects.using('shard1').get(room__house=other)
+        self.assertFalse(router.allow_relation(self.devices[0], remote))
+        self.assertFalse(router.allow_migrate('shard1', 'automacao', 'houseshard'))
+        self.assertTrue(router.allow_migrate('shard1', 'automacao', 'device'))
+
+        old = timezone_now() - timedelta(days=91)
+        DeviceStateEvent.objects.filter(device=self.devices[0]).update(changed_at=old)
+        DeviceStateEvent.objects.using('shard1').create(device=remote, activated=True, changed_at=old)
+        self.assertEqual(prune_device_history(90), 2)
+        self.assertFalse(DeviceStateEvent.objects.using('shard1').exists())
+
+
+class DatabaseRoutingTests(TestCase):
+    '''
+    Escritas marcam o cliente para ler do primário; réplicas inacessíveis saem do revezamento.
+    As métricas trazem as conexões de cada banco.
+    '''
+
+    @override_settings(AUTOMACAO_REPLICAS={'default': ['default']}, REPLICA_PIN_SECONDS=30)
+    def test_write_pins_client(self):
+        device = Device.objects.filter(room__house=criar_casa()).get()
+        client = APIClient()
+
+        response = client.get(f'/api/devices/{device.id}/')
+        self.assertNotIn(PIN_COOKIE, response.cookies)
+
+        response = client.post(f'/api/devices/{device.id}/set_state/', {'activated': True}, format='json')
+        self.assertEqual(response.cookies[PIN_COOKIE]['max-age'], 30)
+
+    @override_settings(AUTOMACAO_REPLICAS={'default': ['broken', 'default']})
+    def test_unhealthy_replica_is_skipped(self):
+        pool = ReplicaPool(check_interval=60)
+        with self.assertLogs('automacao.replicas', 'WARNING'):
+            self.assertEqual([pool.choose('default') for _ in range(3)], ['default'] * 3)
+        self.assertFalse(pool.stats()['broken']['healthy'])
+
+    def test_metrics_report_connections(self):
+        pools = APIClient().get('/api/metrics/').data['database_pools']
+        # O SQLite dos testes não usa o pool do psycopg
+        self.assertEqual(pools['default']['pooled'], False)
+        self.assertIn('conn_max_age', pools['default'])
+
+
+class AsyncViewTests(TestCase):
+    '''As rotas assíncronas (/api/async/) devolvem o mesmo que as do DRF.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=1, devices_per_room=3, scenes=1, actions_per_scene=2)
+        self.device = Device.objects.filter(room__house=self.house).order_by('id').first()
+
+    async def test_set_state_and_detail(self):
+        client = AsyncClient()
+        url = f'/api/async/devices/{self.device.id}/'
+
+        response = await client.post(f'{url}set_state/', {'activated': True}, content_type='application/json')
+        self.assertEqual(response.json(), {'status': 'device toggled', 'new_state': True, 'version': 1})
+        response = await client.post(f'{url}set_state/', {'activated': False}, content_type='application/json', headers={'If-Match': '"0"'})
+        self.assertEqual((response.status_code, response.json()['version']), (412, 1))
+
+        response = await client.get(url)
+        expected = await sync_to_async(lambda: APIClient().get(f'/api/devices/{self.device.id}/').json())()
+        self.assertEqual(response.json(), expected)
+        self.assertTrue(expected['activated'])
+
+    async def test_execute_and_snapshot(self):
+        client = AsyncClient()
+        scene = await Scene.objects.aget(house=self.house)
+
+        response = await client.post(f'/api/async/scenes/{scene.id}/execute/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await SceneRun.objects.filter(pk=response.json()['run_id']).aexists())
+
+        response = await client.get(f'/api/async/houses/{self.house.id}/snapshot/')
+        expected = await sync_to_async(lambda: APIClient().get(f'/api/houses/{self.house.id}/snapshot/').json())()
+        self.assertEqual(response.json(), expected)
+
+
+@override_settings(PROFILING_SAMPLE_RATE=1)
+class ProfilingTests(TestCase):
+    '''ProfilingMiddleware: Server-Timing, histogramas por endpoint e consultas repetidas.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=2, devices_per_room=3)
+        get_response_cache().clear()
+        get_profiler().clear()
+
+    def test_server_timing_and_endpoint_stats(self):
+        response = self.client.get(f'/api/rooms/?house={self.house.id}')
+        self.assertRegex(response['Server-Timing'], r'^total;dur=[\d.]+, db;dur=[\d.]+;desc="\d+ queries", serializer;dur=[\d.]+$')
+
+        stats = self.client.get('/api/metrics/').json()['profiling']['endpoints']['GET room-list']
+        self.assertEqual(stats['requests'], 1)
+        self.assertGreater(stats['mean_queries'], 0)
+        self.assertEqual(stats['mean_response_bytes'], len(response.content))
+        self.assertEqual(stats['requests_with_duplicate_queries'], 0)
+        self.assertNotIn(_record_query, connection.execute_wrappers)
+
+    def test_repeated_queries_are_flagged(self):
+        Room.objects.create(house=self.house, name='Comodo 2')
+        token = _current.set(RequestProfile())
+        try:
+            with record_queries():
+                # N+1: uma consulta de dispositivos por cômodo
+                for room in Room.objects.filter(house=self.house):
+                    list(room.devices.all())
+            profile = _current.get()
+        finally:
+            _current.reset(token)
+
+        self.assertEqual(profile.queries, 4)
+        self.assertEqual(list(profile.duplicates().values()), [3])
+        # Fora do bloco as conexões voltam ao normal
+        self.assertNotIn(_record_query, connection.execute_wrappers)
+
+    async def test_async_requests_count_orm_queries(self):
+        device = await Device.objects.filter(room__house=self.house).afirst()
+        response = await AsyncClient().get(f'/api/async/devices/{device.id}/')
+        self.assertRegex(response['Server-Timing'], r'db;dur=[\d.]+;desc="[1-9]\d* queries"')
+        self.assertNotIn(_record_query, connection.execute_wrappers)
+
+
+class HouseTransferTests(TestCase):
+    '''Exportação e importação NDJSON de uma casa inteira.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=2, devices_per_room=3, scenes=2, actions_per_scene=3)
+        scene = self.house.scenes.order_by('id').first()
+        device = Device.objects.filter(room__house=self.house).order_by('id').last()
+        SceneTrigger.objects.create(scene=scene, kind=SceneTrigger.SCHEDULE, cron='0 7 * * 1-5')
+        SceneTrigger.objects.create(scene=scene, kind=SceneTrigger.DEVICE_STATE, device=device, state=True, enabled=False)
+
+    def export(self, house_id):
+        response = self.client.get(f'/api/houses/{house_id}/export/')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return b''.join(response.streaming_content).decode()
+
+    def test_round_trip(self):
+        exported = self.export(self.house.id)
+        self.assertEqual(len(exported.splitlines()), 1 + 2 + 6 + 2 + 6 + 2)
+
+        response = self.client.post('/api/houses/import/', exported, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            {key: value for key, value in response.json().items() if key != 'house'},
+            {'rooms': 2, 'devices': 6, 'scenes': 2, 'actions': 6, 'triggers': 2},
+        )
+        self.assertEqual(self.export(response.json()['house']), exported)
+
+    def test_invalid_file_writes_nothing(self):
+        lines = [
+            '{"type": "room", "name": "sala"}',
+            '{"type": "room", "name": "SALA"}',
+            '{"type": "device", "room": "Cozinha", "name": "Luz"}',
+            'não é json',
+        ]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(f'/api/houses/{self.house.id}/import/', '\n'.join(lines), content_type='application/x-ndjson')
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['line'] for error in response.json()['errors']], [2, 3, 4])
+        self.assertFalse(any(query['sql'].startswith('INSERT') for query in queries.captured_queries))
+
+        # Nomes que a casa já tem também contam
+        response = self.client.post(f'/api/houses/{self.house.id}/import/', '{"type": "room", "name": "comodo 0"}', content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(f'/api/houses/{self.house.id}/import/', '{"type": "room", "name": "Varanda"}', content_type='application/x-ndjson')
+        self.assertEqual(response.json()['rooms'], 1)
+        self.assertTrue(self.house.rooms.filter(name='Varanda').exists())
+
+
+class SetSceneActionsTests(TestCase):
+    '''set_scene_actions valida a lista como conjunto e grava só a diferença.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=2, devices_per_room=100, scenes=1)
+        self.scene = self.house.scenes.get()
+        self.devices = list(Device.objects.filter(room__house=self.house).order_by('id').values_list('id', flat=True))
+        self.url = f'/api/scenes/{self.scene.id}/set_scene_actions/'
+
+    def replace(self, count, new_state=True):
+        payload = [{'device_id': self.devices[i], 'order': i + 1, 'newState': new_state} for i in range(count)]
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post(self.url, payload, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        return [q['sql'].split()[0] for q in queries.captured_queries]
+
+    def test_per_item_errors(self):
+        other = criar_casa(rooms=1, devices_per_room=1)
+        payload = [
+            {'device_id': self.devices[0], 'order': 1, 'newState': True},
+            {'device_id': 999999, 'order': 2, 'newState': True},
+            {'device_id': Device.objects.get(room__house=other).id, 'order': 3, 'newState': True},
+            {'device_id': self.devices[1], 'order': 1, 'newState': True},
+        ]
+        response = self.client.post(self.url, payload, content_type='application/json')
+
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()
+        # Erros por índice: dicionário ou lista, conforme REST_FRAMEWORK['LIST_SERIALIZER_ERRORS_AS_DICT']
+        if isinstance(errors, list):
+            errors = {str(index): error for index, error in enumerate(errors) if error}
+        self.assertEqual(errors, {
+            '1': {'device_id': ['O dispositivo 999999 não existe.']},
+            '2': {'device_id': ['O dispositivo deve pertencer à mesma casa da cena.']},
+            '3': {'order': ['A ordem 1 já foi usada no item 0.']},
+        })
+        self.assertFalse(self.scene.actions.exists())
+
+    def test_replacement_is_a_diff_in_constant_queries(self):
+        self.replace(3)
+        small = self.replace(3, new_state=False)
+        self.replace(150)
+        large = self.replace(150, new_state=False)
+        self.assertEqual(small, large)
+
+        # Sem mudanças nada é escrito; ações que saíram da lista são removidas, as demais mantêm o id
+        kept = list(self.scene.actions.filter(order__lte=100).values_list('id', flat=True))
+        self.assertNotIn('UPDATE', self.replace(150, new_state=False))
+        self.replace(100, new_state=False)
+        self.assertEqual(list(self.scene.actions.values_list('id', flat=True)), kept)
+
+
+class DeviceGroupTests(TestCase):
+    '''Comandos de grupo resolvem os membros no banco e gravam com um UPDATE só.'''
+
+    def setUp(self):
+        get_response_cache().clear()
+        self.house = criar_casa(rooms=2, devices_per_room=5)
+        self.room = self.house.rooms.order_by('id').first()
+        Device.objects.filter(room=self.room, name='Dispositivo 1').update(name='Luz da sala')
+        Device.objects.filter(room=self.room, name='Dispositivo 2').update(name='LUZ do teto')
+
+    def command(self, group, activated=True):
+        return self.client.post(f'/api/device-groups/{group.id}/command/', {'activated': activated}, content_type='application/json')
+
+    def test_dynamic_group_command(self):
+        group = DeviceGroup.objects.create(name='Luzes', house=self.house, kind='dynamic', room=self.room, name_pattern='luz*')
+        lights = set(Device.objects.filter(room=self.room, name__istartswith='luz').values_list('id', flat=True))
+        self.assertEqual(set(group.members().values_list('id', flat=True)), lights)
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.command(group)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['updated'], 2)
+        # Um UPDATE só, com os membros resolvidos por subconsulta e não por uma lista de ids
+        updates = [q['sql'] for q in queries.captured_queries if q['sql'].startswith('UPDATE "automacao_device"')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('IN (SELECT', updates[0])
+        self.assertEqual(set(Device.objects.filter(activated=True).values_list('id', flat=True)), lights)
+
+        # Os membros acompanham os dispositivos criados depois do grupo
+        Device.objects.create(name='Luz da mesa', room=self.room)
+        self.assertEqual(self.command(group).json()['updated'], 3)
+
+    def test_static_group_rejects_devices_of_other_houses(self):
+        other = Device.objects.create(name='Outro', room=criar_casa().rooms.get())
+        mine = list(Device.objects.filter(room__house=self.house).values_list('id', flat=True)[:2])
+        url = '/api/device-groups/'
+
+        response = self.client.post(url, {'name': 'Grupo', 'house': self.house.id, 'devices': mine + [other.id]}, content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('devices', response.json())
+
+        response = self.client.post(url, {'name': 'Grupo', 'house': self.house.id, 'devices': mine}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(sorted(response.json()['devices']), sorted(mine))
+        self.assertEqual(self.command(DeviceGroup.objects.get(), activated=True).json()['updated'], 2)
+
+
+class IdempotencyTests(TestCase):
+    '''Repetições com a mesma Idempotency-Key recebem a primeira resposta sem tocar no banco.'''
+
+    def setUp(self):
+        self.house = criar_casa(rooms=1, devices_per_room=2, scenes=1, actions_per_scene=2)
+        self.device = Device.objects.filter(room__house=self.house).order_by('id').first()
+        self.scene = self.house.scenes.get()
+
+    def post(self, url, data, key):
+        return self.client.post(url, data, content_type='application/json', headers={'Idempotency-Key': key})
+
+    def test_set_state_replay(self):
+        url = f'/api/devices/{self.device.id}/set_state/'
+        key = uuid.uuid4().hex
+        first = self.post(url, {'activated': True}, key)
+        self.assertEqual(first.json()['version'], 1)
+
+        with self.assertNumQueries(0):
+            replay = self.post(url, {'activated': True}, key)
+        self.assertEqual((replay.status_code, replay.json()), (200, first.json()))
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+
+        self.assertEqual(self.post(url, {'activated': False}, key).status_code, 422)
+        self.assertEqual(self.post(url, {'activated': False}, 'x' * 256).status_code, 400)
+        self.device.refresh_from_db()
+        self.assertEqual((self.device.activated, self.device.version), (True, 1))
+
+    def test_execute_runs_once(self):
+        url = f'/api/scenes/{self.scene.id}/execute/'
+        key = uuid.uuid4().hex
+        run_ids = {self.post(url, {}, key).json()['run_id'] for _ in range(3)}
+        self.assertEqual(len(run_ids), 1)
+        self.assertEqual(SceneRun.objects.filter(scene=self.scene).count(), 1)
+        # Sem a chave cada chamada é uma execução nova
+        self.client.post(url)
+        self.assertEqual(SceneRun.objects.filter(scene=self.scene).count(), 2)
+
+    async def test_async_set_state_replay(self):
+        client = AsyncClient()
+        url = f'/api/async/devices/{self.device.id}/set_state/'
+        headers = {'Idempotency-Key': uuid.uuid4().hex}
+        first = await client.post(url, {'activated': True}, content_type='application/json', headers=headers)
+        replay = await client.post(url, {'activated': True}, content_type='application/json', headers=headers)
+        self.assertEqual(replay.json(), first.json())
+        self.assertEqual(replay['Idempotent-Replayed'], 'true')
+        self.assertEqual(await Device.objects.filter(pk=self.device.id).values_list('version', flat=True).aget(), 1)
+
+    def test_singleflight_coalesces_concurrent_calls(self):
+        flight = SingleFlight()
+        calls = []
+        release = threading.Event()
+
+        def write():
+            calls.append(1)
+            release.wait(5)
+            return 'ok'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('device:1:on', write))) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # A primeira chamada só termina depois que as outras quatro estão esperando por ela
+        while flight.coalesced < 4:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(sorted(results), [('ok', False)] + [('ok', True)] * 4)
+
+    async def test_singleflight_survives_leader_cancellation(self):
+        flight = SingleFlight()
+        calls = []
+        release = asyncio.Event()
+
+        async def write():
+            calls.append(1)
+            await release.wait()
+            return 'ok'
+
+        leader = asyncio.ensure_future(flight.ado('device:1:on', write))
+        await asyncio.sleep(0)
+        follower = asyncio.ensure_future(flight.ado('device:1:on', write))
+        await asyncio.sleep(0)
+        # O cliente da primeira requisição desconecta: só a espera dele é cancelada
+        leader.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await leader
+        release.set()
+
+        self.assertEqual(await asyncio.wait_for(follower, 1), ('ok', True))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.stats(), {'executed': 1, 'coalesced': 1})
+        self.assertEqual(flight._futures, {})
+
+
+@override_settings(DEVICE_STATE_WRITE_BEHIND=True)
+class WriteBehindTests(TestCase):
+    '''No modo write-behind set_state escreve em memória e o flush grava o estado final em lote.'''
+
+    def setUp(self):
+        get_response_cache().clear()
+        self.house = criar_casa(rooms=1, devices_per_room=3)
+        self.devices = list(Device.objects.filter(room__house=self.house).order_by('id'))
+        # Intervalo longo: nos testes o flush é chamado explicitamente
+        self.buffer = writebehind._buffer = writebehind.DeviceStateBuffer(flush_interval_ms=60000)
+
+    def tearDown(self):
+        self.buffer.stop()
+        writebehind._buffer = None
+
+    def test_toggles_are_served_from_memory_and_flushed_once(self):
+        device = self.devices[0]
+        url = f'/api/devices/{device.id}/'
+        for i in range(50):
+            self.client.post(f'{url}set_state/', {'activated': i % 2 == 0}, content_type='application/json')
+        self.client.post(f'/api/devices/{self.devices[1].id}/set_state/', {'activated': True}, content_type='application/json')
+
+        device.refresh_from_db()
+        self.assertEqual((device.activated, device.version), (False, 0))
+        self.assertEqual(
+            {k: v for k, v in self.client.get(url).json().items() if k in ('activated', 'version')},
+            {'activated': False, 'version': 50},
+        )
+        response = self.client.post(f'{url}set_state/', {'activated': True}, content_type='application/json', headers={'If-Match': '"3"'})
+        self.assertEqual((response.status_code, response.json()['version']), (412, 50))
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(sum(q['sql'].startswith('UPDATE "automacao_device"') for q in queries.captured_queries), 1)
+        self.assertEqual(
+            list(Device.objects.filter(room__house=self.house).order_by('id').values_list('activated', 'version')),
+            [(False, 50), (True, 1), (False, 0)],
+        )
+        self.assertIsNone(self.buffer.get(device.id))
+
+    def test_direct_writes_discard_pending_state(self):
+        device = self.devices[0]
+        self.buffer.set(device.id, True, device.version)
+        with self.captureOnCommitCallbacks(execute=True):
+            apply_device_states({device.id: False})
+        self.assertIsNone(self.buffer.get(device.id))
+        self.assertEqual(self.buffer.flush(), 0)
+
+    def test_direct_write_during_flush_wins(self):
+        device = self.devices[0]
+        for activated in (True, False, True):
+            self.client.post(f'/api/devices/{device.id}/set_state/', {'activated': activated}, content_type='application/json')
+        self.assertEqual(self.buffer.get(device.id), (True, 3))
+
+        # Uma cena desliga o dispositivo enquanto o lote (versão 3, sobre a 0) está sendo gravado
+        write = self.buffer._write
+
+        def direct_write_then_write(batch, done):
+            with self.captureOnCommitCallbacks(execute=True):
+                apply_device_states({device.id: False})
+            self.assertIsNone(self.buffer.get(device.id))
+            return write(batch, done)
+
+        self.buffer._write = direct_write_then_write
+        self.assertEqual(self.buffer.flush(), 0)
+
+        device.refresh_from_db()
+        self.assertEqual((device.activated, device.version), (False, 1))
+        self.assertEqual(self.buffer.stats()['pending'], 0)
+
+    def test_etag_and_room_cache_change_before_flush(self):
+        device = self.devices[0]
+        room_url = f'/api/rooms/{device.room_id}/'
+        device_url = f'/api/devices/{device.id}/'
+        self.client.get(room_url)
+        room_etag = self.client.get(room_url)['ETag']
+        device_etag = self.client.get(device_url)['ETag']
+
+        self.client.post(f'{device_url}set_state/', {'activated': True}, content_type='application/json')
+
+        response = self.client.get(room_url, headers={'If-None-Match': room_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], room_etag)
+        self.assertTrue(response.json()['devices'][0]['activated'])
+        response = self.client.get(device_url, headers={'If-None-Match': device_etag})
+        self.assertEqual((response.status_code, response.json()['activated']), (200, True))
+
+        # Sem escritas novas, o ETag volta a confirmar a resposta
+        self.assertEqual(self.client.get(device_url, headers={'If-None-Match': response['ETag']}).status_code, 304)
+
+    async def test_async_set_state_changes_etag(self):
+        device = self.devices[0]
+        client = AsyncClient()
+        etag = (await client.get(f'/api/devices/{device.id}/'))['ETag']
+
+        response = await client.post(f'/api/async/devices/{device.id}/set_state/', {'activated': True}, content_type='application/json')
+        self.assertEqual(response.json()['version'], 1)
+
+        response = await client.get(f'/api/devices/{device.id}/', headers={'If-None-Match': etag})
+        self.assertEqual((response.status_code, response.json()['activated']), (200, True))
+
+    def test_wal_recovers_unflushed_states(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'states.wal')
+            crashed = writebehind.DeviceStateBuffer(flush_interval_ms=60000, wal_path=path)
+            for device in self.devices[:2]:
+                crashed.set(device.id, True, device.version)
+            crashed.set(self.devices[0].id, False, 0)
+
+            # Um novo processo relê o WAL e grava o que faltava
+            with self.assertLogs('automacao.writebehind', 'WARNING'):
+                recovered = writebehind.DeviceStateBuffer(flush_interval_ms=60000, wal_path=path)
+            # O buffer "caído" não grava nada na saída do processo de teste
+            crashed.discard([device.id for device in self.devices])
+            crashed.stop()
+            self.assertEqual(recovered.get(self.devices[0].id), (False, 2))
+            self.assertEqual(recovered.flush(), 2)
+            self.assertEqual(
+                list(Device.objects.filter(room__house=self.house).order_by('id').values_list('activated', 'version')),
+                [(False, 2), (True, 1), (False, 0)],
+            )
+            with open(path) as wal:
+                self.assertEqual(wal.read(), '')
+            recovered.stop()
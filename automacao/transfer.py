@@ -0,0 +1,333 @@
+'''
+Importação e exportação de uma casa inteira em NDJSON (um objeto JSON por linha).
+
+Cada linha tem um "type" e as referências entre linhas são pelos nomes, que são
+únicos (sem diferenciar maiúsculas) na casa ou, para dispositivos, no cômodo:
+
+    {"type": "house", "name": "Casa", "address": "Rua A", "owner": "Maria"}
+    {"type": "room", "name": "Sala"}
+    {"type": "device", "room": "Sala", "name": "Lâmpada", "description": null, "activated": false}
+    {"type": "scene", "name": "Cinema", "activated": true}
+    {"type": "action", "scene": "Cinema", "room": "Sala", "device": "Lâmpada", "order": 1, "newState": true, "interval": 0}
+    {"type": "trigger", "scene": "Cinema", "kind": "schedule", "cron": "0 19 * * *", "enabled": true}
+    {"type": "trigger", "scene": "Cinema", "kind": "device_state", "room": "Sala", "device": "Lâmpada", "state": true, "enabled": true}
+
+- Exportação: as linhas são geradas sob demanda, lendo cada tabela com
+  iterator(chunk_size=...), então a memória não cresce com o tamanho da casa.
+- Importação: valida todas as linhas em memória, contra os nomes que a casa já tem
+  (carregados uma vez) e os das linhas anteriores, sem um SELECT por objeto. Sem
+  erros, grava tudo em uma transação com bulk_create em lotes. Uma linha só pode
+  citar objetos de linhas anteriores (a ordem da exportação). Em uma casa nova a
+  linha "house" é obrigatória; em uma existente ela é ignorada.
+Execuções de cena, histórico e versões não fazem parte do arquivo.
+'''
+import json
+
+from django.db import DEFAULT_DB_ALIAS, transaction
+from rest_framework.parsers import BaseParser
+
+from .cron import CronSchedule
+from .models import Device, House, Room, Scene, SceneAction, SceneTrigger
+from .responses import ROOM, SCENE, invalidate_responses
+from .sharding import current_db
+from .signals import invalidate_scene_plans
+from .triggers import get_device_rule_index
+from .versions import touch
+
+NDJSON = 'application/x-ndjson'
+
+# Erros devolvidos por importação; a validação para ao atingir o limite
+MAX_IMPORT_ERRORS = 100
+
+
+class InvalidImport(Exception):
+    '''Arquivo recusado; 'errors' traz [{"line": n, "error": mensagem}].'''
+
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} erro(s) no arquivo')
+        self.errors = errors
+
+
+class NDJSONParser(BaseParser):
+    '''Entrega o corpo da requisição como um iterável de linhas, sem lê-lo de uma vez.'''
+    media_type = NDJSON
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        return stream if stream is not None else ()
+
+
+def _line(record):
+    return json.dumps(record, ensure_ascii=False) + '\n'
+
+
+def export_house(house_id, using=DEFAULT_DB_ALIAS, chunk_size=2000):
+    '''Gera as linhas NDJSON da casa, lidas do banco 'using' aos poucos.'''
+    house = House.objects.using(using).filter(pk=house_id).values('name', 'address', 'owner').get()
+    yield _line({'type': 'house', **house})
+
+    rooms = Room.objects.using(using).filter(house_id=house_id).order_by('pk')
+    for name in rooms.values_list('name', flat=True).iterator(chunk_size=chunk_size):
+        yield _line({'type': 'room', 'name': name})
+
+    devices = Device.objects.using(using).filter(room__house_id=house_id).order_by('pk')
+    for room, name, description, activated in devices.values_list(
+        'room__name', 'name', 'description', 'activated'
+    ).iterator(chunk_size=chunk_size):
+        yield _line({'type': 'device', 'room': room, 'name': name, 'description': description, 'activated': activated})
+
+    scenes = Scene.objects.using(using).filter(house_id=house_id).order_by('pk')
+    for name, activated in scenes.values_list('name', 'activated').iterator(chunk_size=chunk_size):
+        yield _line({'type': 'scene', 'name': name, 'activated': activated})
+
+    actions = SceneAction.objects.using(using).filter(scene__house_id=house_id).order_by('pk')
+    for scene, room, device, order, new_state, interval in actions.values_list(
+        'scene__name', 'device__room__name', 'device__name', 'order', 'newState', 'interval'
+    ).iterator(chunk_size=chunk_size):
+        yield _line({
+            'type': 'action', 'scene': scene, 'room': room, 'device': device,
+            'order': order, 'newState': new_state, 'interval': interval,
+        })
+
+    triggers = SceneTrigger.objects.using(using).filter(scene__house_id=house_id).order_by('pk')
+    for scene, kind, cron, room, device, state, enabled in triggers.values_list(
+        'scene__name', 'kind', 'cron', 'device__room__name', 'device__name', 'state', 'enabled'
+    ).iterator(chunk_size=chunk_size):
+        record = {'type': 'trigger', 'scene': scene, 'kind': kind}
+        if kind == SceneTrigger.SCHEDULE:
+            record['cron'] = cron
+        else:
+            record.update(room=room, device=device, state=state)
+        record['enabled'] = enabled
+        yield _line(record)
+
+
+class _Invalid(Exception):
+    pass
+
+
+def _text(record, field, max_length, label, min_length=2):
+    value = record.get(field)
+    if not isinstance(value, str) or len(value.strip()) < min_length:
+        raise _Invalid(f'{label} deve ter pelo menos {min_length} caracteres.')
+    value = value.strip()
+    if len(value) > max_length:
+        raise _Invalid(f'{label} deve ter no máximo {max_length} caracteres.')
+    return value
+
+
+def _flag(record, field, default):
+    value = record.get(field, default)
+    if not isinstance(value, bool):
+        raise _Invalid(f'O campo "{field}" deve ser um boolean.')
+    return value
+
+
+def _integer(record, field, default, low, high):
+    value = record.get(field, default)
+    if not isinstance(value, int) or isinstance(value, bool) or not low <= value <= high:
+        raise _Invalid(f'O campo "{field}" deve ser um número inteiro entre {low} e {high}.')
+    return value
+
+
+def _reference(names, key, label):
+    if key not in names:
+        raise _Invalid(f'{label} não existe na casa nem em uma linha anterior.')
+    return key
+
+
+class HouseImport:
+    '''Valida as linhas de um arquivo (feed) e grava os objetos novos (save).'''
+
+    def __init__(self, house=None):
+        self.house = house
+        self.house_fields = None
+        self.errors = []
+        # Nomes em minúsculas -> id (None para os objetos do arquivo, ainda não gravados)
+        self.rooms = {}
+        self.devices = {}  # (cômodo, dispositivo) -> id
+        self.scenes = {}
+        self.orders = {}  # cena -> ordens já usadas
+        self.new_rooms = []
+        self.new_devices = []
+        self.new_scenes = []
+        self.new_actions = []
+        self.new_triggers = []
+        if house is not None:
+            self._preload(house)
+
+    def _preload(self, house):
+        '''Nomes e ordens que a casa já tem, em uma consulta por tabela.'''
+        for pk, name in Room.objects.filter(house=house).values_list('pk', 'name'):
+            self.rooms[name.lower()] = pk
+        for pk, room, name in Device.objects.filter(room__house=house).values_list('pk', 'room__name', 'name').iterator():
+            self.devices[room.lower(), name.lower()] = pk
+        for pk, name in Scene.objects.filter(house=house).values_list('pk', 'name'):
+            self.scenes[name.lower()] = pk
+        for scene, order in SceneAction.objects.filter(scene__house=house).values_list('scene__name', 'order').iterator():
+            self.orders.setdefault(scene.lower(), set()).add(order)
+
+    def feed(self, lines):
+        '''Valida as linhas (str ou bytes), acumulando os erros em self.errors.'''
+        for number, line in enumerate(lines, start=1):
+            try:
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+            except ValueError:
+                self._error(number, 'A linha não é um JSON válido em UTF-8.')
+                continue
+            try:
+                if not isinstance(record, dict):
+                    raise _Invalid('Cada linha deve ser um objeto JSON.')
+                handler = getattr(self, f'_add_{record.get("type")}', None)
+                if handler is None:
+                    raise _Invalid('O campo "type" deve ser house, room, device, scene, action ou trigger.')
+                handler(record)
+            except _Invalid as e:
+                self._error(number, str(e))
+            if len(self.errors) >= MAX_IMPORT_ERRORS:
+                return
+        if self.house is None and self.house_fields is None and not self.errors:
+            self._error(None, 'A linha "house" é obrigatória para criar uma casa.')
+
+    def _error(self, line, message):
+        self.errors.append({'line': line, 'error': message})
+
+    def _add_house(self, record):
+        if self.house_fields is not None:
+            raise _Invalid('O arquivo deve ter uma única linha "house".')
+        fields = {
+            'name': _text(record, 'name', 255, 'O nome da casa'),
+            'address': _text(record, 'address', 255, 'O endereço', min_length=1),
+            'owner': _text(record, 'owner', 100, 'O nome do proprietário'),
+        }
+        # Em uma casa existente a linha só é conferida
+        self.house_fields = fields
+
+    def _add_room(self, record):
+        name = _text(record, 'name', 100, 'O nome do cômodo')
+        if name.lower() in self.rooms:
+            raise _Invalid(f"Já existe um cômodo chamado '{name}' nesta casa.")
+        self.rooms[name.lower()] = None
+        self.new_rooms.append(name)
+
+    def _add_device(self, record):
+        room = _reference(self.rooms, _text(record, 'room', 100, 'O cômodo').lower(), 'O cômodo')
+        name = _text(record, 'name', 100, 'O nome do dispositivo')
+        description = record.get('description')
+        if description is not None and not isinstance(description, str):
+            raise _Invalid('O campo "description" deve ser um texto.')
+        activated = _flag(record, 'activated', False)
+        if (room, name.lower()) in self.devices:
+            raise _Invalid(f"Já existe um dispositivo chamado '{name}' neste cômodo.")
+        self.devices[room, name.lower()] = None
+        self.new_devices.append((room, name, description, activated))
+
+    def _add_scene(self, record):
+        name = _text(record, 'name', 100, 'O nome da cena')
+        activated = _flag(record, 'activated', True)
+        if name.lower() in self.scenes:
+            raise _Invalid(f"Já existe uma cena chamada '{name}' nesta casa.")
+        self.scenes[name.lower()] = None
+        self.new_scenes.append((name, activated))
+
+    def _device_key(self, record):
+        room = _text(record, 'room', 100, 'O cômodo').lower()
+        device = _text(record, 'device', 100, 'O dispositivo').lower()
+        return _reference(self.devices, (room, device), 'O dispositivo')
+
+    def _add_action(self, record):
+        scene = _reference(self.scenes, _text(record, 'scene', 100, 'A cena').lower(), 'A cena')
+        device = self._device_key(record)
+        order = _integer(record, 'order', None, 1, 2 ** 31 - 1)
+        new_state = _flag(record, 'newState', False)
+        interval = _integer(record, 'interval', 0, 0, 3600)
+        orders = self.orders.setdefault(scene, set())
+        if order in orders:
+            raise _Invalid(f'A cena já tem uma ação na ordem {order}.')
+        orders.add(order)
+        self.new_actions.append((scene, device, order, new_state, interval))
+
+    def _add_trigger(self, record):
+        scene = _reference(self.scenes, _text(record, 'scene', 100, 'A cena').lower(), 'A cena')
+        kind = record.get('kind')
+        enabled = _flag(record, 'enabled', True)
+        if kind == SceneTrigger.SCHEDULE:
+            cron = ' '.join(str(record.get('cron', '')).split())
+            try:
+                CronSchedule(cron)
+            except ValueError as e:
+                raise _Invalid(str(e))
+            self.new_triggers.append((scene, kind, cron, None, None, enabled))
+        elif kind == SceneTrigger.DEVICE_STATE:
+            device = self._device_key(record)
+            if not isinstance(record.get('state'), bool):
+                raise _Invalid("O campo 'state' é obrigatório para gatilhos por estado.")
+            self.new_triggers.append((scene, kind, '', device, record['state'], enabled))
+        else:
+            raise _Invalid('O campo "kind" deve ser schedule ou device_state.')
+
+    def save(self, batch_size=1000):
+        '''Grava os objetos novos em uma transação no banco atual e retorna as quantidades.'''
+        with transaction.atomic(using=current_db()):
+            house = self.house or House.objects.create(**self.house_fields)
+
+            rooms = Room.objects.bulk_create([Room(house=house, name=name) for name in self.new_rooms], batch_size=batch_size)
+            self.rooms.update((room.name.lower(), room.pk) for room in rooms)
+
+            devices = Device.objects.bulk_create([
+                Device(room_id=self.rooms[room], name=name, description=description, activated=activated)
+                for room, name, description, activated in self.new_devices
+            ], batch_size=batch_size)
+            self.devices.update(((room, device.name.lower()), device.pk) for (room, *_), device in zip(self.new_devices, devices))
+
+            scenes = Scene.objects.bulk_create([
+                Scene(house=house, name=name, activated=activated) for name, activated in self.new_scenes
+            ], batch_size=batch_size)
+            # Cenas que já existiam e ganharam ações têm planos em cache
+            changed_scenes = {self.scenes[scene] for scene, *_ in self.new_actions if self.scenes[scene] is not None}
+            self.scenes.update((scene.name.lower(), scene.pk) for scene in scenes)
+
+            SceneAction.objects.bulk_create([
+                SceneAction(scene_id=self.scenes[scene], device_id=self.devices[device], order=order, newState=new_state, interval=interval)
+                for scene, device, order, new_state, interval in self.new_actions
+            ], batch_size=batch_size)
+            SceneTrigger.objects.bulk_create([
+                SceneTrigger(
+                    scene_id=self.scenes[scene], kind=kind, cron=cron, enabled=enabled, state=state,
+                    device_id=self.devices[device] if device is not None else None,
+                )
+                for scene, kind, cron, device, state, enabled in self.new_triggers
+            ], batch_size=batch_size)
+
+            # bulk_create não dispara os sinais que mantêm caches e versões
+            if changed_scenes:
+                invalidate_scene_plans(*changed_scenes)
+            invalidate_responses(ROOM, houses=[house.pk])
+            invalidate_responses(SCENE, houses=[house.pk])
+            touch(houses=[house.pk])
+            if self.new_triggers:
+                transaction.on_commit(get_device_rule_index().invalidate, using=current_db())
+
+        return {
+            'house': house.pk,
+            'rooms': len(self.new_rooms),
+            'devices': len(self.new_devices),
+            'scenes': len(self.new_scenes),
+            'actions': len(self.new_actions),
+            'triggers': len(self.new_triggers),
+        }
+
+
+def import_house(lines, house=None, batch_size=1000):
+    '''
+    Valida as linhas NDJSON e grava o conteúdo em uma casa nova (ou em 'house').
+    Lança InvalidImport sem gravar nada se alguma linha for inválida.
+    '''
+    importer = HouseImport(house)
+    importer.feed(lines)
+    if importer.errors:
+        raise InvalidImport(importer.errors)
+    return importer.save(batch_size=batch_size)
@@ -0,0 +1,227 @@
+'''
+Gatilhos de cena (SceneTrigger): agendas cron e regras "quando o dispositivo X mudar para Y".
+
+- Agendas: um único processo (comando run_scene_scheduler) mantém um heap com o
+  próximo disparo de cada gatilho e dorme até o primeiro deles; a tabela só é
+  relida quando a assinatura dos gatilhos (quantidade e última alteração) muda.
+- Estado de dispositivo: avaliadas no processo onde a mudança acontece, logo após
+  o commit (sinal device_states_committed), por um índice device_id -> regras, então
+  o custo é proporcional às regras do dispositivo que mudou, não ao total da casa.
+  Só transições contam: uma escrita com o estado que o dispositivo já tinha não dispara.
+
+Em ambos os casos a cena é executada pelo motor (automacao.engine), nunca dentro
+de quem disparou, o que evita recursão quando uma cena dispara outra. Os gatilhos
+são lidos de todos os shards; cada disparo acontece no shard da casa da cena.
+'''
+import heapq
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from .cron import CronSchedule
+from .engine import queue_scene_run
+from .models import Scene, SceneTrigger
+from .plans import get_scene_plan
+from .sharding import current_db, fan_out, locate, use_shard
+
+logger = logging.getLogger(__name__)
+
+# Intervalo mínimo (s) entre dois disparos da mesma regra, contra cenas que se disparam em ciclo
+DEVICE_TRIGGER_COOLDOWN = 1.0
+# Acima desta quantidade de disparos lembrados, os mais antigos que o intervalo mínimo são descartados
+LAST_FIRED_MAX = 1024
+
+
+def fire_trigger(trigger_id, scene_id):
+    '''
+    Enfileira a execução da cena do gatilho. Cenas desativadas ou sem ações são ignoradas.
+    Retorna o SceneRun criado ou None.
+    '''
+    plan = get_scene_plan(scene_id)
+    if plan is None or not plan.activated or not plan.steps:
+        return None
+
+    with transaction.atomic(using=current_db()):
+        run = queue_scene_run(plan, trigger_id=trigger_id)
+        SceneTrigger.objects.filter(pk=trigger_id).update(last_fired_at=timezone.now())
+    return run
+
+
+class DeviceRuleIndex:
+    '''device_id -> [(trigger_id, scene_id, state)] dos gatilhos por estado habilitados.'''
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self._rules = None
+        self._loaded_at = 0
+        self._last_fired = {}
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._rules = None
+
+    def rules_for(self, device_id):
+        rules = self._rules
+        # Recarrega periodicamente para enxergar gatilhos alterados por outros processos
+        if rules is None or time.monotonic() - self._loaded_at > self.ttl:
+            rules = self._load()
+        return rules.get(device_id, ())
+
+    def _load(self):
+        rules = {}
+        for triggers in fan_out(_device_rules):
+            for trigger_id, device_id, scene_id, state in triggers:
+                rules.setdefault(device_id, []).append((trigger_id, scene_id, state))
+        with self._lock:
+            self._rules = rules
+            self._loaded_at = time.monotonic()
+        return rules
+
+    def _remember_fired(self, trigger_id, now):
+        # Chamado com self._lock: só os disparos dentro do intervalo mínimo importam
+        self._last_fired[trigger_id] = now
+        if len(self._last_fired) > LAST_FIRED_MAX:
+            self._last_fired = {
+                fired_id: fired_at for fired_id, fired_at in self._last_fired.items()
+                if now - fired_at < DEVICE_TRIGGER_COOLDOWN
+            }
+
+    def matching(self, states):
+        '''Retorna [(trigger_id, scene_id)] das regras satisfeitas pelas transições {device_id: activated}.'''
+        now = time.monotonic()
+        matches = []
+        for device_id, activated in states.items():
+            for trigger_id, scene_id, state in self.rules_for(device_id):
+                if state != activated:
+                    continue
+                with self._lock:
+                    if now - self._last_fired.get(trigger_id, float('-inf')) < DEVICE_TRIGGER_COOLDOWN:
+                        continue
+                    self._remember_fired(trigger_id, now)
+                matches.append((trigger_id, scene_id))
+        return matches
+
+
+def _device_rules(alias):
+    triggers = SceneTrigger.objects.filter(kind=SceneTrigger.DEVICE_STATE, enabled=True)
+    return list(triggers.values_list('id', 'device_id', 'scene_id', 'state'))
+
+
+def _schedule_signature(alias):
+    return SceneTrigger.objects.filter(kind=SceneTrigger.SCHEDULE).aggregate(count=Count('id'), updated=Max('updated_at'))
+
+
+def _scheduled_triggers(alias):
+    triggers = SceneTrigger.objects.filter(kind=SceneTrigger.SCHEDULE, enabled=True)
+    return list(triggers.values_list('id', 'scene_id', 'cron'))
+
+
+_index = None
+
+
+def get_device_rule_index():
+    global _index
+    if _index is None:
+        _index = DeviceRuleIndex(ttl=getattr(settings, 'SCENE_TRIGGER_RELOAD_SECONDS', 30))
+    return _index
+
+
+def evaluate_device_states(states):
+    '''
+    Dispara as cenas das regras satisfeitas por transições já gravadas ({device_id: novo estado}).
+    Roda no shard da mudança, que é o mesmo da cena (gatilho e dispositivo são da mesma casa).
+    '''
+    for trigger_id, scene_id in get_device_rule_index().matching(states):
+        try:
+            fire_trigger(trigger_id, scene_id)
+        except Exception:
+            logger.exception('Falha ao disparar o gatilho %s', trigger_id)
+
+
+class TriggerScheduler:
+    '''Heap de (próximo disparo, trigger_id, scene_id) dos gatilhos agendados habilitados.'''
+
+    def __init__(self, reload_interval=30):
+        self.reload_interval = reload_interval
+        self._heap = []
+        self._schedules = {}  # trigger_id -> CronSchedule
+        self._signature = None
+
+    def signature(self):
+        return fan_out(_schedule_signature)
+
+    def load(self, now):
+        '''Relê os gatilhos agendados (de todos os shards) e recalcula o heap a partir de 'now'.'''
+        self._signature = self.signature()
+        self._schedules = {}
+        self._heap = []
+        for trigger_id, scene_id, cron in (row for rows in fan_out(_scheduled_triggers) for row in rows):
+            try:
+                schedule = CronSchedule(cron)
+            except ValueError:
+                logger.warning('Gatilho %s com expressão cron inválida: %r', trigger_id, cron)
+                continue
+            self._schedules[trigger_id] = schedule
+            self._push(schedule.next_after(now), trigger_id, scene_id)
+
+    def reload_if_changed(self, now):
+        if self.signature() != self._signature:
+            self.load(now)
+            return True
+        return False
+
+    def _push(self, fire_at, trigger_id, scene_id):
+        if fire_at is not None:
+            heapq.heappush(self._heap, (fire_at, trigger_id, scene_id))
+
+    def next_fire_at(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now):
+        '''Retira os gatilhos vencidos até 'now' e já agenda o próximo disparo de cada um.'''
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, trigger_id, scene_id = heapq.heappop(self._heap)
+            due.append((trigger_id, scene_id))
+            self._push(self._schedules[trigger_id].next_after(fire_at), trigger_id, scene_id)
+        return due
+
+    def run_forever(self, stop_event=None, log=logger.info):
+        '''Laço do agendador: dorme até o próximo disparo ou a próxima verificação de mudanças.'''
+        stop_event = stop_event or threading.Event()
+        self.load(timezone.now())
+        log(f'{len(self._schedules)} gatilhos agendados carregados')
+        next_reload = time.monotonic() + self.reload_interval
+
+        while not stop_event.is_set():
+            now = timezone.now()
+            if time.monotonic() >= next_reload:
+                close_old_connections()
+                if self.reload_if_changed(now):
+                    log(f'Gatilhos recarregados: {len(self._schedules)} agendados')
+                next_reload = time.monotonic() + self.reload_interval
+
+            for trigger_id, scene_id in self.pop_due(now):
+                try:
+                    # A casa pode ter mudado de shard desde a carga dos gatilhos
+                    shard = locate(Scene, scene_id)
+                    if shard is None:
+                        continue
+                    with use_shard(shard):
+                        run = fire_trigger(trigger_id, scene_id)
+                except Exception:
+                    logger.exception('Falha ao disparar o gatilho %s', trigger_id)
+                    continue
+                if run is not None:
+                    log(f'Gatilho {trigger_id}: cena {scene_id} enviada (execução {run.id})')
+
+            timeout = next_reload - time.monotonic()
+            next_fire_at = self.next_fire_at()
+            if next_fire_at is not None:
+                timeout = min(timeout, (next_fire_at - timezone.now()).total_seconds())
+            stop_event.wait(max(0, timeout))
@@ -1,7 +1,8 @@
 from django.urls import path, include
 from rest_framework import urlpatterns
 from rest_framework.routers import DefaultRouter
-from .views import HouseViewSet, RoomViewSet, DeviceViewSet, SceneViewSet, SceneActionViewSet
+from . import async_views
+from .views import HouseViewSet, RoomViewSet, DeviceViewSet, SceneViewSet, SceneActionViewSet, SceneRunViewSet, SceneTriggerViewSet, DeviceGroupViewSet, device_events, metrics
 
 router = DefaultRouter()
 router.register(r'houses', HouseViewSet, basename='house')
@@ -9,7 +10,20 @@ router.register(r'rooms', RoomViewSet, basename='room')
 router.register(r'devices', DeviceViewSet, basename='device')
 router.register(r'scenes', SceneViewSet, basename='scene')
 router.register(r'scene-actions', SceneActionViewSet, basename='sceneaction')
+router.register(r'scene-runs', SceneRunViewSet, basename='scenerun')
+router.register(r'scene-triggers', SceneTriggerViewSet, basename='scenetrigger')
+router.register(r'device-groups', DeviceGroupViewSet, basename='devicegroup')
 
 urlpatterns = [
+    # Versões assíncronas (ASGI) dos endpoints mais chamados pelos gateways
+    path('async/devices/', async_views.device_list, name='async-device-list'),
+    path('async/devices/<int:pk>/', async_views.device_detail, name='async-device-detail'),
+    path('async/devices/<int:pk>/set_state/', async_views.device_set_state, name='async-device-set-state'),
+    path('async/scenes/<int:pk>/execute/', async_views.scene_execute, name='async-scene-execute'),
+    path('async/houses/<int:pk>/snapshot/', async_views.house_snapshot, name='async-house-snapshot'),
+    # Stream em tempo real do estado dos dispositivos (SSE, servido pelo ASGI)
+    path('events/devices/', device_events, name='device-events'),
+    # Métricas dos caches (acertos e falhas)
+    path('metrics/', metrics, name='metrics'),
     path('', include(router.urls)),
 ]
\ No newline at end of file
@@ -0,0 +1,57 @@
+'''
+Contador de versão por casa (House.version).
+
+Toda escrita em uma casa ou abaixo dela (cômodos, dispositivos, cenas e ações)
+incrementa o contador, que vira o ETag das leituras (ConditionalGetMixin). As casas
+afetadas por uma transação são acumuladas e incrementadas com um único UPDATE após o
+commit, então mesmo uma exclusão em cascata de milhares de linhas custa uma escrita.
+'''
+import threading
+
+from django.db import transaction
+from django.db.models import F, Q
+
+from .models import House
+from .sharding import current_db
+
+_local = threading.local()
+
+
+def _pending():
+    if not hasattr(_local, 'pending'):
+        _local.pending = {'houses': set(), 'rooms': set(), 'devices': set(), 'scenes': set()}
+    return _local.pending
+
+
+def touch(houses=(), rooms=(), devices=(), scenes=()):
+    '''
+    Marca como alteradas as casas dos objetos informados (por id).
+    O incremento acontece após o commit da transação atual (ou na hora, fora de uma).
+    '''
+    pending = _pending()
+    pending['houses'].update(houses)
+    pending['rooms'].update(rooms)
+    pending['devices'].update(devices)
+    pending['scenes'].update(scenes)
+    transaction.on_commit(flush, using=current_db())
+
+
+def flush():
+    '''Incrementa a versão de todas as casas pendentes. Chamadas repetidas não fazem nada.'''
+    pending = _pending()
+    if not any(pending.values()):
+        return
+    # Troca o acumulador antes de consultar: os filtros abaixo guardam referência aos conjuntos
+    del _local.pending
+
+    condition = Q()
+    if pending['houses']:
+        condition |= Q(pk__in=pending['houses'])
+    if pending['rooms']:
+        condition |= Q(pk__in=House.objects.filter(rooms__in=pending['rooms']).values('pk'))
+    if pending['devices']:
+        condition |= Q(pk__in=House.objects.filter(rooms__devices__in=pending['devices']).values('pk'))
+    if pending['scenes']:
+        condition |= Q(pk__in=House.objects.filter(scenes__in=pending['scenes']).values('pk'))
+
+    House.objects.filter(condition).update(version=F('version') + 1)
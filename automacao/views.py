@@ -1,40 +1,207 @@
+import asyncio
+import json
+
 from django.shortcuts import render
-from django.db import transaction
+from django.db import router, transaction
+from django.db.models import Count, Prefetch
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import parse_etags
 
 from rest_framework import viewsets, status
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
-from drf_spectacular.utils import extend_schema
-from .models import House, Room, Device, Scene, SceneAction
-from .serializers import HouseSerializer, RoomSerializer, DeviceSerializer, SceneActionBulkUpdateSerializer, SceneActivationSerializer, SceneSerializer, SceneActionSerializer, DeviceStateSerializer
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
+from .engine import get_engine, queue_scene_run, run_scene_now
+from .history import device_on_time
+from .idempotency import IDEMPOTENCY_HEADER, get_idempotency_store, get_singleflight, idempotent
+from .events import get_broker
+from .mixins import ConditionalGetMixin, QueryPlanMixin, ResponseCacheMixin, ShardRoutingMixin, SparseFieldsetMixin
+from .models import House, Room, Device, DeviceGroup, DeviceStateEvent, Scene, SceneAction, SceneRun, SceneTrigger
+from .pagination import RecentFirstCursorPagination
+from .serializers import HouseSerializer, RoomSerializer, DeviceSerializer, SceneActionBulkUpdateSerializer, SceneActivationSerializer, SceneSerializer, SceneActionSerializer, DeviceStateSerializer, SceneRunSerializer, DeviceBulkStateSerializer, TimeRangeSerializer, SnapshotQuerySerializer, SceneTriggerSerializer, DeviceGroupSerializer
+from .plans import get_plan_cache, get_scene_plan
+from .pools import database_pool_stats
+from .profiling import get_profiler
+from .replicas import get_replica_pool
+from .responses import ROOM, SCENE, get_response_cache, invalidate_responses
+from .services import VersionConflict, apply_device_states, apply_state_to_devices, set_device_state
+from .sharding import current_db, fan_out, group_by_shard, query_shards, use_shard
+from .snapshots import house_snapshot
+from .signals import invalidate_scene_plans
+from .transfer import NDJSON, InvalidImport, NDJSONParser, export_house, import_house
+from .versions import touch
+from .writebehind import get_state_buffer
+
+IDEMPOTENCY_KEY_PARAMETER = OpenApiParameter(
+    IDEMPOTENCY_HEADER, str, OpenApiParameter.HEADER, required=False,
+    description='Chave única do comando; repetições com a mesma chave recebem a primeira resposta.',
+)
+
+
+def parse_if_match(header):
+    '''Versão de um If-Match: "<version>"; None sem o cabeçalho ou com *. ValueError se malformado.'''
+    if not header:
+        return None
+    tags = parse_etags(header)
+    if tags == ['*']:
+        return None
+    if len(tags) != 1 or not tags[0].strip('"').isdigit():
+        raise ValueError('Envie uma única versão do dispositivo, ex.: If-Match: "3".')
+    return int(tags[0].strip('"'))
+
 
 # Create your views here.
-class HouseViewSet(viewsets.ModelViewSet):
+class HouseViewSet(ShardRoutingMixin, ConditionalGetMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
     queryset = House.objects.all()
     serializer_class = HouseSerializer
     filterset_fields = ['owner']
 
-class RoomViewSet(viewsets.ModelViewSet):
+    etag_house_path = 'pk'
+
+    @extend_schema(
+        parameters=[SnapshotQuerySerializer],
+        responses={200: None},
+    )
+    @action(detail=True, methods=['get'])
+    def snapshot(self, request, pk=None):
+        """
+        Estado de todos os dispositivos da casa em formato colunar (ver automacao.snapshots).
+        Com ?since=<versão> igual à versão atual da casa, responde só {"changed": false}.
+        """
+        if not pk.isdigit():
+            raise Http404
+
+        query = SnapshotQuerySerializer(data=request.query_params)
+        if not query.is_valid():
+            return Response(query.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        since = query.validated_data.get('since')
+        if since is not None:
+            version = House.objects.filter(pk=pk).values_list('version', flat=True).first()
+            if version is None:
+                raise Http404
+            if version == since:
+                return Response({'house': int(pk), 'version': version, 'changed': False})
+
+        snapshot = house_snapshot(pk)
+        if snapshot is None:
+            raise Http404
+        return Response(snapshot)
+
+    @extend_schema(request=None, responses={(200, NDJSON): OpenApiTypes.STR})
+    @action(detail=True, methods=['get'])
+    def export(self, request, pk=None):
+        """
+        Casa inteira (cômodos, dispositivos, cenas, ações e gatilhos) em NDJSON, no
+        formato aceito por import (ver automacao.transfer). As linhas são geradas aos poucos.
+        """
+        if not pk.isdigit():
+            raise Http404
+        # O gerador roda depois da view, fora do contexto de shard e réplica da requisição
+        using = router.db_for_read(House)
+        if not House.objects.using(using).filter(pk=pk).exists():
+            raise Http404
+        response = StreamingHttpResponse(export_house(int(pk), using=using), content_type=NDJSON)
+        response['Content-Disposition'] = f'attachment; filename="house-{pk}.ndjson"'
+        return response
+
+    @extend_schema(request={NDJSON: OpenApiTypes.STR}, responses={201: None, 400: None})
+    @action(detail=False, methods=['post'], url_path='import', url_name='import', parser_classes=[NDJSONParser])
+    def import_new(self, request):
+        """
+        Cria uma casa com cômodos, dispositivos, cenas, ações e gatilhos a partir de
+        um arquivo NDJSON (o formato de export). Nada é gravado se alguma linha for inválida.
+        """
+        return self._import(request, None, status.HTTP_201_CREATED)
+
+    @extend_schema(operation_id='houses_import_into', request={NDJSON: OpenApiTypes.STR}, responses={200: None, 400: None})
+    @action(detail=True, methods=['post'], url_path='import', url_name='import-into', parser_classes=[NDJSONParser])
+    def import_into(self, request, pk=None):
+        """Acrescenta à casa os objetos de um arquivo NDJSON; a linha "house" é ignorada."""
+        return self._import(request, self.get_object(), status.HTTP_200_OK)
+
+    def _import(self, request, house, success_status):
+        try:
+            summary = import_house(request.data, house=house)
+        except InvalidImport as e:
+            return Response({'errors': e.errors}, status=status.HTTP_400_BAD_REQUEST)
+        return Response(summary, status=success_status)
+
+class RoomViewSet(ShardRoutingMixin, ResponseCacheMixin, ConditionalGetMixin, SparseFieldsetMixin, QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Room.objects.all()
     serializer_class = RoomSerializer
     filterset_fields = ['house']
+    shard_parent_fields = {'house': House}
+
+    etag_house_path = 'rooms'
+    etag_list_filters = {'house': 'pk'}
+    response_cache_kind = ROOM
 
+    # O prefetch dos dispositivos preenche device.room com o próprio cômodo,
+    # então o house_name aninhado sai do select_related abaixo
+    select_related_fields = ['house']
+    prefetch_fields = {'devices': Prefetch('devices', queryset=Device.objects.order_by('id'))}
+    annotate_fields = {'devices_count': Count('devices')}
 
-class DeviceViewSet(viewsets.ModelViewSet):
+
+class DeviceViewSet(ShardRoutingMixin, ConditionalGetMixin, SparseFieldsetMixin, QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Device.objects.all()
     serializer_class = DeviceSerializer # Serializer refinado
     filterset_fields = ['room']
-    
+    shard_parent_fields = {'room': Room, 'house': House}
+
+    etag_house_path = 'rooms__devices'
+    etag_list_filters = {'room': 'rooms'}
+
+    select_related_fields = ['room__house']
+
+    def get_expected_version(self):
+        '''
+        Versão esperada do dispositivo, enviada como If-Match: "<version>" (o campo
+        'version' das respostas). Retorna None sem o cabeçalho ou com If-Match: *.
+        '''
+        try:
+            return parse_if_match(self.request.headers.get('If-Match'))
+        except ValueError as e:
+            raise ValidationError({'If-Match': str(e)})
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        if self.request is not None and self.request.method in ('PUT', 'PATCH'):
+            context['expected_version'] = self.get_expected_version()
+        return context
+
+    def update(self, request, *args, **kwargs):
+        try:
+            return super().update(request, *args, **kwargs)
+        except VersionConflict as e:
+            return self.version_conflict(e)
+
+    def version_conflict(self, conflict):
+        if conflict.current is None:
+            raise Http404
+        return Response(
+            {'error': 'O dispositivo foi alterado por outra requisição.', 'version': conflict.current},
+            status=status.HTTP_412_PRECONDITION_FAILED
+        )
+
     @extend_schema(
         request=DeviceStateSerializer,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
         responses={200: DeviceSerializer},
     )
     @action(detail=True, methods=['post'])
+    @idempotent
     def set_state(self, request, pk=None):
         """
         Endpoint para definir o estado de um dispositivo (ligar/desligar).
         Espera um JSON no corpo da requisicao com o campo 'activated' (booleano).
+        Com If-Match: "<version>" a escrita só acontece se o dispositivo não mudou (senão 412).
+        Com Idempotency-Key as repetições recebem a primeira resposta (ver automacao.idempotency).
         """
         device = self.get_object()
         
@@ -44,52 +211,201 @@ class DeviceViewSet(viewsets.ModelViewSet):
         if new_state is None or not isinstance(new_state, bool):
             return Response({'error': 'O campo "activated" é obrigatório. Ele deve ser um boolean.'}, status=status.HTTP_400_BAD_REQUEST)
 
-        device.activated = new_state
-        device.save()
+        expected = self.get_expected_version()
+
+        # Grava apenas a coluna 'activated' (e a versão), sem reescrever nome e descrição;
+        # no modo write-behind, só no buffer em memória (automacao.writebehind)
+        def write():
+            buffer = get_state_buffer()
+            if buffer is not None:
+                return buffer.set(device.pk, new_state, device.version, expected, device.room_id, device.room.house_id)
+            set_device_state(device, new_state, expected)
+            return device.version
+
+        # Comandos idênticos simultâneos (retentativas dos gateways) viram uma escrita só
+        try:
+            version, _ = get_singleflight().do(('set_state', current_db(), device.pk, new_state, expected), write)
+        except VersionConflict as e:
+            return self.version_conflict(e)
+
+        return Response({'status': 'device toggled', 'new_state': new_state, 'version': version}, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        request=DeviceBulkStateSerializer,
+        responses={200: None},
+    )
+    @action(detail=False, methods=['post'])
+    def bulk_set_state(self, request):
+        """
+        Endpoint para definir o estado de vários dispositivos em uma única transação.
+        Aceita {"devices": [{"id": 1, "activated": true}, ...]} ou
+        {"room": 1, "activated": false} / {"house": 1, "activated": true}.
+        Retorna o resultado de cada dispositivo.
+        """
+        serializer = DeviceBulkStateSerializer(data=request.data)
+
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+
+        if 'devices' in data:
+            states = {item['id']: item['activated'] for item in data['devices']}
+            # Uma transação por shard; sem shards extras é uma só
+            updated = set()
+            for shard, device_ids in group_by_shard(Device, states).items():
+                with use_shard(shard):
+                    updated |= apply_device_states({device_id: states[device_id] for device_id in device_ids})
+            results = [
+                {'id': device_id, 'status': 'updated', 'new_state': new_state}
+                if device_id in updated else
+                {'id': device_id, 'status': 'not found'}
+                for device_id, new_state in states.items()
+            ]
+        else:
+            if 'room' in data:
+                devices = Device.objects.filter(room=data['room'])
+            else:
+                devices = Device.objects.filter(room__house=data['house'])
+            updated = apply_state_to_devices(devices, data['activated'])
+            results = [
+                {'id': device_id, 'status': 'updated', 'new_state': data['activated']}
+                for device_id in updated
+            ]
+
+        return Response({'updated': len(updated), 'results': results}, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        parameters=[TimeRangeSerializer],
+        responses={200: None},
+    )
+    @action(detail=True, methods=['get'])
+    def on_time(self, request, pk=None):
+        """
+        Tempo (em segundos) que o dispositivo ficou ligado no intervalo ?start=&end=
+        (ISO 8601; padrão: últimas 24 horas), calculado a partir do histórico de estado.
+        """
+        device = self.get_object()
+
+        serializer = TimeRangeSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        start, end = serializer.validated_data['start'], serializer.validated_data['end']
+
+        totals = device_on_time(start, end, DeviceStateEvent.objects.filter(device=device))
+
+        return Response(
+            {'device': device.id, 'start': start, 'end': end, 'on_seconds': totals.get(device.id, 0)},
+            status=status.HTTP_200_OK
+        )
+
+    @extend_schema(
+        parameters=[TimeRangeSerializer],
+        responses={200: None},
+    )
+    @action(detail=False, methods=['get'], url_path='on_time', url_name='on-time-list')
+    def on_time_list(self, request):
+        """
+        Tempo ligado de cada dispositivo no intervalo ?start=&end=, agregado no banco.
+        Aceita os mesmos filtros da listagem (?room=) e também ?house=.
+        """
+        serializer = TimeRangeSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        start, end = serializer.validated_data['start'], serializer.validated_data['end']
+
+        devices = self.filter_queryset(Device.objects.all())
+        house = request.query_params.get('house')
+        if house:
+            devices = devices.filter(room__house=house)
 
-        return Response({'status': 'device toggled', 'new_state': device.activated}, status=status.HTTP_200_OK)
+        # Sem ?room= ou ?house= (shard desconhecido) soma os totais de todos os shards
+        totals = {}
+        for shard_totals in fan_out(
+            lambda alias: device_on_time(start, end, DeviceStateEvent.objects.filter(device__in=devices.values('id'))),
+            query_shards(),
+        ):
+            totals.update(shard_totals)
 
+        return Response(
+            {
+                'start': start,
+                'end': end,
+                'results': [{'device': device_id, 'on_seconds': seconds} for device_id, seconds in sorted(totals.items())],
+            },
+            status=status.HTTP_200_OK
+        )
 
-class SceneViewSet(viewsets.ModelViewSet):
+
+class SceneViewSet(ShardRoutingMixin, ResponseCacheMixin, ConditionalGetMixin, SparseFieldsetMixin, QueryPlanMixin, viewsets.ModelViewSet):
     queryset = Scene.objects.all()
     serializer_class = SceneSerializer
     filterset_fields = ['house']
+    shard_parent_fields = {'house': House}
+
+    etag_house_path = 'scenes'
+    etag_list_filters = {'house': 'pk'}
+    response_cache_kind = SCENE
+
+    prefetch_fields = {'actions': Prefetch('actions', queryset=SceneAction.objects.select_related('device__room'))}
+    annotate_fields = {'actions_count': Count('actions')}
 
     # A antiga ação 'activate' agora é 'execute' e tem nova lógica
+    @extend_schema(
+        request=None,
+        parameters=[IDEMPOTENCY_KEY_PARAMETER],
+        responses={200: None, 202: None},
+    )
     @action(detail=True, methods=['post'])
+    @idempotent
     def execute(self, request, pk=None):
         """
         Executa uma cena, alterando o estado dos dispositivos associados.
         A cena só pode ser executada se seu campo 'activated' for true.
+        Cenas sem intervalos são aplicadas na hora (200); as demais são enviadas ao
+        motor de execução, que respeita a ordem e o intervalo de cada ação (202).
+        Nos dois casos a resposta traz o id da execução (SceneRun).
+        Com Idempotency-Key uma repetição devolve a mesma execução em vez de criar outra.
         """
-        scene = self.get_object()
+        # O plano compilado vem do cache: com o cache quente não há leituras no banco
+        plan = get_scene_plan(int(pk)) if str(pk).isdigit() else None
+        if plan is None:
+            raise Http404
 
         # CONDIÇÃO: Verifica se a cena está habilitada para ser executada
-        if not scene.activated:
+        if not plan.activated:
             return Response(
-                {'status': f'A cena "{scene.name}" está desativada e não pode ser executada.'},
+                {'status': f'A cena "{plan.name}" está desativada e não pode ser executada.'},
                 status=status.HTTP_403_FORBIDDEN # Forbidden é um bom status code aqui
             )
 
-        actions = scene.actions.all()
+        steps = plan.steps
         
-        if not actions:
+        if not steps:
             return Response(
                 {'status': 'A cena não possui ações para executar.'},
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-        # Lógica de execução (a mesma de antes)
-        for action_item in actions:
-            device = action_item.device
-            device.activated = action_item.newState
-            device.save()
-            # Lembrete: A lógica de 'interval' requer uma solução mais avançada (background tasks)
-            # e está sendo ignorada por enquanto.
+        # Sem intervalos a cena é aplicada na hora, com um único UPDATE
+        if not any(interval for _, _, interval in steps):
+            run = run_scene_now(plan.scene_id, steps)
+            return Response(
+                {
+                    'status': f'Cena "{plan.name}" executada com sucesso.',
+                    'run_id': run.id,
+                },
+                status=status.HTTP_200_OK
+            )
+
+        run = queue_scene_run(plan)
 
         return Response(
-            {'status': f'Cena "{scene.name}" executada com sucesso.'},
-            status=status.HTTP_200_OK
+            {
+                'status': f'Cena "{plan.name}" enviada para execução.',
+                'run_id': run.id,
+            },
+            status=status.HTTP_202_ACCEPTED
         )
 
     @extend_schema(
@@ -126,47 +442,186 @@ class SceneViewSet(viewsets.ModelViewSet):
         """
         scene = self.get_object()
 
-        # Validando o corpo da requisição
-        serializer = SceneActionBulkUpdateSerializer(data=request.data, many=True)
+        # Validando o corpo da requisição (dispositivos e ordens conferidos em uma consulta)
+        serializer = SceneActionBulkUpdateSerializer(
+            scene.actions.all(), data=request.data, many=True, context={'scene': scene}
+        )
 
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
-        
-        validated_data = serializer.validated_data
 
         try:
             # A transação garante que todas as operações sejam executadas ou nenhuma delas
-            with transaction.atomic():
-                # Deleta todas as ações existentes da cena
-                scene.actions.all().delete()
-
-                # Cria as novas ações
-                new_actions = []
-                for new_action in validated_data:
-                    new_actions.append(SceneAction(
-                        scene=scene, 
-                        device_id=new_action['device_id'],
-                        order=new_action['order'],
-                        newState=new_action['newState'],
-                        interval=new_action['interval']
-                        )
-                    )
-
-                # Persiste as novas ações
-                SceneAction.objects.bulk_create(new_actions)
+            with transaction.atomic(using=current_db()):
+                # Grava só a diferença para as ações atuais
+                serializer.save()
 
+                # bulk_create e bulk_update não disparam sinais, então o plano compilado, as
+                # respostas em cache e a versão da casa são tratados aqui
+                if serializer.changes['created'] or serializer.changes['updated']:
+                    invalidate_scene_plans(scene.pk)
+                    invalidate_responses(SCENE, {scene.pk: scene.house_id})
+                    touch(scenes=[scene.pk])
 
         except Exception as e:
             # Se qualquer erro ocorrer, a transação é desfeita (rollback)
             return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
         # Retorna a cena atualizada com a nova lista de ações
+        # (recarrega pelo plano de consulta, pois o prefetch de get_object() ficou desatualizado)
+        scene = self.get_queryset().get(pk=scene.pk)
         updated_scene_serializer = self.get_serializer(scene)
         return Response(updated_scene_serializer.data, status=status.HTTP_201_CREATED)
 
 
-class SceneActionViewSet(viewsets.ModelViewSet):
+class SceneActionViewSet(ShardRoutingMixin, ConditionalGetMixin, SparseFieldsetMixin, QueryPlanMixin, viewsets.ModelViewSet):
     queryset = SceneAction.objects.all()
     serializer_class = SceneActionSerializer
     filterset_fields = ['scene']
+    shard_parent_fields = {'scene': Scene, 'device': Device}
+
+    etag_house_path = 'scenes__actions'
+    etag_list_filters = {'scene': 'scenes'}
+
+    select_related_fields = ['device__room']
+
+
+class SceneRunViewSet(ShardRoutingMixin, SparseFieldsetMixin, viewsets.ReadOnlyModelViewSet):
+    queryset = SceneRun.objects.select_related('scene').order_by('-id')
+    serializer_class = SceneRunSerializer
+    filterset_fields = ['scene', 'status']
+    shard_parent_fields = {'scene': Scene}
+    pagination_class = RecentFirstCursorPagination
+
+    @extend_schema(
+        request=None,
+        responses={200: SceneRunSerializer},
+    )
+    @action(detail=True, methods=['post'])
+    def cancel(self, request, pk=None):
+        """
+        Cancela uma execução de cena que ainda está na fila ou executando.
+        """
+        run = self.get_object()
+
+        cancelled = SceneRun.objects.filter(pk=run.pk, status__in=SceneRun.PENDING_STATUSES).update(
+            status=SceneRun.CANCELLED, finished_at=timezone.now()
+        )
+        if not cancelled:
+            return Response(
+                {'error': f'A execução {run.id} já terminou com o status "{run.status}".'},
+                status=status.HTTP_409_CONFLICT
+            )
+
+        get_engine().cancel(run.pk)
+
+        run.refresh_from_db()
+        return Response(self.get_serializer(run).data, status=status.HTTP_200_OK)
+
+
+@extend_schema(request=None, responses={200: None})
+@api_view(['GET'])
+def metrics(request):
+    """
+    Métricas da app: acertos e falhas do cache de respostas e do cache de planos de cena,
+    saúde e leituras de cada réplica, uso do pool de conexões de cada banco e histogramas
+    por endpoint das requisições medidas pelo ProfilingMiddleware (deste processo) e
+    repetições atendidas pelas chaves de idempotência ou coalescidas, e o buffer de
+    escrita adiada do estado dos dispositivos, quando ligado.
+    """
+    return Response({
+        'response_cache': get_response_cache().stats(),
+        'scene_plan_cache': get_plan_cache().stats(),
+        'replicas': get_replica_pool().stats(),
+        'database_pools': database_pool_stats(),
+        'profiling': get_profiler().stats(),
+        'idempotency': {**get_idempotency_store().stats(), 'singleflight': get_singleflight().stats()},
+        'write_behind': buffer.stats() if (buffer := get_state_buffer()) is not None else None,
+    })
+
+
+class SceneTriggerViewSet(ShardRoutingMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
+    queryset = SceneTrigger.objects.select_related('scene', 'device__room').order_by('id')
+    serializer_class = SceneTriggerSerializer
+    filterset_fields = ['scene', 'kind', 'device', 'enabled']
+    shard_parent_fields = {'scene': Scene, 'device': Device}
+
+
+class DeviceGroupViewSet(ShardRoutingMixin, SparseFieldsetMixin, viewsets.ModelViewSet):
+    queryset = DeviceGroup.objects.prefetch_related(Prefetch('devices', queryset=Device.objects.only('id'))).order_by('id')
+    serializer_class = DeviceGroupSerializer
+    filterset_fields = ['house', 'kind', 'room']
+    shard_parent_fields = {'house': House, 'room': Room}
+
+    @extend_schema(
+        request=DeviceStateSerializer,
+        responses={200: None},
+    )
+    @action(detail=True, methods=['post'])
+    def command(self, request, pk=None):
+        """
+        Liga ou desliga todos os dispositivos do grupo com um único UPDATE.
+        Espera {"activated": true|false}; os membros (também os dos grupos dinâmicos) são resolvidos no banco.
+        """
+        group = self.get_object()
+
+        serializer = DeviceStateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        activated = serializer.validated_data['activated']
+
+        updated = apply_state_to_devices(group.members(), activated)
+        return Response({'group': group.pk, 'new_state': activated, 'updated': len(updated)}, status=status.HTTP_200_OK)
+
+    @extend_schema(responses={200: DeviceSerializer(many=True)})
+    @action(detail=True, methods=['get'])
+    def members(self, request, pk=None):
+        """
+        Dispositivos que estão no grupo agora (paginado).
+        """
+        group = self.get_object()
+        devices = group.members().select_related('room__house').order_by('id')
+        page = self.paginate_queryset(devices)
+        return self.get_paginated_response(DeviceSerializer(page, many=True).data)
+
+
+# Intervalo (s) entre os comentários enviados para manter a conexão SSE aberta
+EVENTS_HEARTBEAT = 15
+
+
+async def device_events(request):
+    """
+    Stream (Server-Sent Events) das mudanças de estado dos dispositivos.
+    Espera ?house=<id> ou ?room=<id> e envia um evento a cada mudança de 'activated'.
+    Deve ser servido pelo ASGI (config/asgi.py).
+    """
+    house_id = request.GET.get('house')
+    room_id = request.GET.get('room')
+
+    if (house_id is None) == (room_id is None) or not (house_id or room_id).isdigit():
+        return JsonResponse({'error': 'Informe apenas um dos parâmetros "house" ou "room" (id numérico).'}, status=400)
+
+    broker = get_broker()
+    subscription = broker.subscribe(
+        house_id=int(house_id) if house_id else None,
+        room_id=int(room_id) if room_id else None,
+    )
+
+    async def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                yield f"data: {json.dumps(event, separators=(',', ':'))}\n\n"
+        finally:
+            broker.unsubscribe(subscription)
+
+    response = StreamingHttpResponse(stream(), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
 
@@ -0,0 +1,297 @@
+'''
+Escrita adiada (write-behind) do estado dos dispositivos, ligada por DEVICE_STATE_WRITE_BEHIND.
+
+Para dispositivos que mudam de estado muitas vezes por segundo (dimmers, sensores):
+- set_state (DRF e /api/async/) grava o estado na memória do processo
+  (DeviceStateBuffer), que passa a valer para o dispositivo: o próprio set_state
+  (inclusive If-Match) e tudo o que usa DeviceSerializer leem de lá.
+- Uma thread grava os estados pendentes a cada DEVICE_STATE_FLUSH_MS, com um
+  bulk_update por shard. Várias mudanças do mesmo dispositivo no intervalo viram
+  uma só (vale a última). Os efeitos (versão das casas, eventos, histórico e
+  gatilhos) rodam depois do flush, uma vez por lote, com o estado final; o retrato
+  da casa enxerga a mudança a partir daí. Já o ETag das leituras (generation()) e
+  o cache de respostas dos cômodos mudam na hora, a cada set().
+- O flush trava as linhas e só grava onde a versão no banco ainda é aquela sobre
+  a qual o estado do buffer foi escrito (portanto menor que a do buffer). Escritas
+  que vão direto ao banco (cenas, escritas em lote, PATCH) descartam o estado
+  pendente dos dispositivos que alteraram, inclusive o do lote em gravação
+  (receptor em automacao.signals); se chegarem antes da trava do flush, a versão
+  que elas incrementaram já impede que o buffer as sobrescreva.
+- Com DEVICE_STATE_WAL cada mudança é acrescentada a um arquivo local antes da
+  resposta, e o que não chegou ao banco é regravado quando o processo volta. Sem
+  DEVICE_STATE_WAL_FSYNC o arquivo sobrevive à queda do processo, mas não à do
+  sistema operacional; com ele cada mudança espera o fsync.
+
+O buffer é de um processo: use o modo com um único processo atendendo set_state.
+'''
+import atexit
+import json
+import logging
+import os
+import threading
+import uuid
+from collections import Counter
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from .models import Device
+from .responses import ROOM, get_response_cache
+from .services import VersionConflict, device_states_written
+from .sharding import current_db, use_shard
+
+logger = logging.getLogger(__name__)
+
+# Marca a thread que está aplicando os efeitos de um flush (os descartes não valem para ela)
+_local = threading.local()
+
+
+class DeviceStateBuffer:
+    def __init__(self, flush_interval_ms=100, batch_size=1000, wal_path=None, wal_fsync=False):
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.wal_path = wal_path
+        self.wal_fsync = wal_fsync
+        self.writes = 0
+        self.flushed = 0
+        # device_id -> (alias, activated, version, base); 'base' é a versão do banco sobre a qual o estado foi escrito
+        self._pending = {}
+        self._flushing = {}  # o lote que está sendo gravado, ainda visível para leituras
+        self._generations = Counter()  # house_id -> quantidade de set()
+        # Distingue as gerações deste buffer das de um processo anterior (estados recuperados do WAL)
+        self._epoch = uuid.uuid4().hex[:8]
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._wal = None
+        self._thread = None
+        if wal_path:
+            self._recover()
+
+    def get(self, device_id):
+        '''(activated, version) ainda não gravado no banco, ou None.'''
+        entry = self._pending.get(device_id) or self._flushing.get(device_id)
+        return entry and entry[1:3]
+
+    def generation(self, house_id):
+        '''Marca das escritas ainda só em memória na casa, somada ao ETag (ConditionalGetMixin).'''
+        return f'{self._epoch}.{self._generations[house_id]}'
+
+    def set(self, device_id, activated, current_version, expected_version=None, room_id=None, house_id=None):
+        '''
+        Registra o novo estado e retorna a nova versão. 'current_version' é a do banco,
+        usada quando não há estado pendente. Lança VersionConflict se 'expected_version'
+        não for a versão atual. Com o cômodo e a casa do dispositivo, troca na hora o
+        ETag da casa e as respostas do cômodo em cache.
+        '''
+        with self._lock:
+            pending = self._pending.get(device_id)
+            if pending is not None:
+                version, base = pending[2:]
+            elif device_id in self._flushing:
+                # Continua do lote em gravação, que terá deixado essa versão no banco
+                version = base = self._flushing[device_id][2]
+            else:
+                version = base = current_version
+            if expected_version is not None and expected_version != version:
+                raise VersionConflict(version)
+            entry = (current_db(), activated, version + 1, base)
+            self._pending[device_id] = entry
+            self._log({device_id: entry})
+            self.writes += 1
+            if house_id is not None:
+                self._generations[house_id] += 1
+            if self._thread is None:
+                self._start()
+        if room_id is not None:
+            # O estado já vale na hora, fora de qualquer transação: invalida sem esperar um commit
+            get_response_cache().invalidate_objects(ROOM, {room_id: house_id})
+        return version + 1
+
+    def discard(self, device_ids):
+        '''Esquece o estado pendente dos dispositivos escritos direto no banco, inclusive o do lote em gravação.'''
+        if getattr(_local, 'flushing', False):
+            return
+        with self._lock:
+            for device_id in device_ids:
+                self._pending.pop(device_id, None)
+                # Fora de _flushing o estado deixa de ser lido e não volta ao buffer se o lote falhar
+                self._flushing.pop(device_id, None)
+
+    def flush(self):
+        '''Grava os estados pendentes. Retorna a quantidade de dispositivos gravados.'''
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._flushing = batch
+                segment = self._rotate()
+            done = set()
+            written = 0
+            try:
+                written = self._write(batch, done)
+            finally:
+                with self._lock:
+                    # O que falhou volta para o buffer, a não ser que já tenha sido substituído
+                    # (por um set() novo) ou descartado (por uma escrita direta)
+                    failed = {
+                        device_id: entry for device_id, entry in batch.items()
+                        if device_id not in done and device_id in self._flushing
+                    }
+                    for device_id, entry in failed.items():
+                        newer = self._pending.get(device_id)
+                        # Um estado mais novo continua do que falhou: passa a partir da mesma base
+                        self._pending[device_id] = entry if newer is None else newer[:3] + entry[3:]
+                    self._log({device_id: self._pending[device_id] for device_id in failed})
+                    self._flushing = {}
+                if segment:
+                    os.remove(segment)
+            self.flushed += written
+            return written
+
+    def _write(self, batch, done):
+        '''
+        Um bulk_update por shard, só dos dispositivos que ninguém alterou no banco
+        desde que o estado entrou no buffer (versão no banco igual à base, menor que
+        a do buffer). 'done' recebe os ids resolvidos (gravados ou já superados);
+        retorna a quantidade gravada.
+        '''
+        by_alias = {}
+        for device_id, (alias, activated, version, base) in batch.items():
+            by_alias.setdefault(alias, {})[device_id] = (activated, version, base)
+
+        written = 0
+        for alias, states in by_alias.items():
+            with transaction.atomic(using=alias):
+                # Trava em ordem de id, como services._lock_devices
+                current = {
+                    device_id: (activated, version)
+                    for device_id, activated, version in Device.objects.using(alias).select_for_update()
+                    .filter(id__in=states).order_by('id').values_list('id', 'activated', 'version')
+                }
+                newer = {
+                    device_id: (activated, version) for device_id, (activated, version, base) in states.items()
+                    if device_id in current and current[device_id][1] == base
+                }
+                devices = [Device(pk=device_id, activated=activated, version=version) for device_id, (activated, version) in newer.items()]
+                Device.objects.using(alias).bulk_update(devices, ['activated', 'version'], batch_size=self.batch_size)
+            done.update(states)
+            written += len(newer)
+            if not newer:
+                continue
+
+            changed = {device_id for device_id, (activated, _) in newer.items() if current[device_id][0] != activated}
+            _local.flushing = True
+            try:
+                with use_shard(alias):
+                    device_states_written({device_id: activated for device_id, (activated, _) in newer.items()}, changed)
+            except Exception:
+                logger.exception('Falha nos efeitos da gravação adiada de estados')
+            finally:
+                _local.flushing = False
+        return written
+
+    def stats(self):
+        return {
+            'pending': len(self._pending),
+            'writes': self.writes,
+            'flushed': self.flushed,
+            'flush_interval_ms': self.flush_interval * 1000,
+            'wal': self.wal_path or None,
+        }
+
+    # WAL: uma linha JSON por mudança. A cada flush o arquivo vira um segmento
+    # ("<wal>.flushing") removido quando o lote chega ao banco.
+
+    def _log(self, entries):
+        if self._wal is None or not entries:
+            return
+        self._wal.write(''.join(
+            json.dumps({'id': device_id, 'db': alias, 'activated': activated, 'version': version, 'base': base}) + '\n'
+            for device_id, (alias, activated, version, base) in entries.items()
+        ))
+        self._wal.flush()
+        if self.wal_fsync:
+            os.fsync(self._wal.fileno())
+
+    def _rotate(self):
+        if self._wal is None:
+            return None
+        self._wal.close()
+        segment = f'{self.wal_path}.flushing'
+        os.replace(self.wal_path, segment)
+        self._wal = open(self.wal_path, 'a', encoding='utf-8')
+        return segment
+
+    def _recover(self):
+        '''Recarrega o que ficou nos arquivos (segmento em gravação e WAL atual, nessa ordem).'''
+        segment = f'{self.wal_path}.flushing'
+        for path in (segment, self.wal_path):
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding='utf-8') as wal:
+                for line in wal:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # Última linha cortada pela queda do processo
+                        continue
+                    self._pending[record['id']] = (record['db'], record['activated'], record['version'], record['base'])
+        if self._pending:
+            logger.warning('Recuperados %s estados de dispositivos do WAL %s', len(self._pending), self.wal_path)
+
+        # Reescreve o WAL só com o estado final de cada dispositivo
+        with open(f'{self.wal_path}.tmp', 'w', encoding='utf-8') as wal:
+            self._wal = wal
+            self._log(self._pending)
+            os.fsync(wal.fileno())
+        os.replace(f'{self.wal_path}.tmp', self.wal_path)
+        if os.path.exists(segment):
+            os.remove(segment)
+        self._wal = open(self.wal_path, 'a', encoding='utf-8')
+        if self._pending:
+            self._start()
+
+    def stop(self):
+        '''Encerra a thread e grava o que estiver pendente (na saída do processo e nos testes).'''
+        self._stopping.set()
+        atexit.unregister(self.stop)
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+
+    def _start(self):
+        self._thread = threading.Thread(target=self._loop, name='device-state-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _loop(self):
+        while not self._stopping.wait(self.flush_interval):
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Falha na gravação adiada do estado dos dispositivos')
+            finally:
+                close_old_connections()
+
+
+_buffer = None
+_buffer_lock = threading.Lock()
+
+
+def get_state_buffer():
+    '''O buffer do processo, ou None com DEVICE_STATE_WRITE_BEHIND desligado.'''
+    global _buffer
+    if not getattr(settings, 'DEVICE_STATE_WRITE_BEHIND', False):
+        return None
+    with _buffer_lock:
+        if _buffer is None:
+            _buffer = DeviceStateBuffer(
+                flush_interval_ms=getattr(settings, 'DEVICE_STATE_FLUSH_MS', 100),
+                batch_size=getattr(settings, 'DEVICE_STATE_BATCH_SIZE', 1000),
+                wal_path=getattr(settings, 'DEVICE_STATE_WAL', '') or None,
+                wal_fsync=getattr(settings, 'DEVICE_STATE_WAL_FSYNC', False),
+            )
+        return _buffer
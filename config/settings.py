@@ -53,6 +53,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Perfil das requisições (automacao.profiling); fica inativo com PROFILING_SAMPLE_RATE=0
+    'automacao.profiling.ProfilingMiddleware',
     'corsheaders.middleware.CorsMiddleware', #pip install django-cors-headers
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -86,18 +88,76 @@ WSGI_APPLICATION = 'config.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': os.getenv('DB_NAME'),
-        'USER': os.getenv('DB_USER'),
-        'PASSWORD': os.getenv('DB_PASSWORD'),
-        'HOST': os.getenv('DB_HOST', 'localhost'),
-        'PORT': os.getenv('DB_PORT', '5432'),
+def database_from_env(prefix='DB'):
+    '''Lê um banco das variáveis <prefix>_NAME, <prefix>_HOST...; as ausentes herdam as DB_* do banco principal.'''
+    def env(name, default=None):
+        return os.getenv(f'{prefix}_{name}', os.getenv(f'DB_{name}', default))
+
+    database = {
+        # Postgres por padrão; 'django.db.backends.sqlite3' (com DB_NAME apontando para um arquivo) serve para benchmarks locais
+        'ENGINE': env('ENGINE', 'django.db.backends.postgresql'),
+        'NAME': env('NAME'),
+        'USER': env('USER'),
+        'PASSWORD': env('PASSWORD'),
+        'HOST': env('HOST', 'localhost'),
+        'PORT': env('PORT', '5432'),
+        # Conexões reaproveitadas são testadas antes do uso, e descartadas se o servidor as derrubou
+        'CONN_HEALTH_CHECKS': True,
     }
+
+    if database['ENGINE'] == 'django.db.backends.postgresql' and env('POOL', 'true').lower() in ('1', 'true', 'yes'):
+        # Pool do psycopg 3 por processo: a requisição pega uma conexão aberta e a devolve ao terminar.
+        # Vale para WSGI e ASGI (threads e event loop compartilham o pool); exige CONN_MAX_AGE = 0.
+        database['OPTIONS'] = {
+            'pool': {
+                'min_size': int(env('POOL_MIN_SIZE', '2')),
+                'max_size': int(env('POOL_MAX_SIZE', '10')),
+                # Tempo máximo (s) esperando uma conexão livre antes de falhar a requisição
+                'timeout': float(env('POOL_TIMEOUT', '10')),
+            },
+        }
+    else:
+        # Sem pool, cada thread mantém sua conexão por CONN_MAX_AGE segundos (no ASGI, prefira o pool ou 0)
+        database['CONN_MAX_AGE'] = int(env('CONN_MAX_AGE', '60'))
+    return database
+
+
+DATABASES = {
+    'default': database_from_env('DB'),
 }
 
+# Shards da app automacao (automacao.sharding): cada casa e tudo abaixo dela ficam em um shard.
+# DB_SHARDS=shard1,shard2 cria os aliases lidos de DB_SHARD1_NAME, DB_SHARD1_HOST...
+# O 'default' é sempre o primeiro shard e guarda o diretório de casas (HouseShard).
+DB_SHARDS = [alias.strip() for alias in os.getenv('DB_SHARDS', '').split(',') if alias.strip()]
+for _alias in DB_SHARDS:
+    DATABASES[_alias] = database_from_env(f'DB_{_alias.upper()}')
+AUTOMACAO_SHARDS = ['default'] + DB_SHARDS
+
+# Réplicas de leitura de cada shard: DB_REPLICAS=replica1 para o 'default', DB_SHARD1_REPLICAS=... para os demais.
+# Cada alias é lido de DB_REPLICA1_NAME, DB_REPLICA1_HOST...; nos testes a réplica espelha o seu shard.
+AUTOMACAO_REPLICAS = {}
+for _shard in AUTOMACAO_SHARDS:
+    _prefix = 'DB' if _shard == 'default' else f'DB_{_shard.upper()}'
+    _replicas = [alias.strip() for alias in os.getenv(f'{_prefix}_REPLICAS', '').split(',') if alias.strip()]
+    for _alias in _replicas:
+        DATABASES[_alias] = {**database_from_env(f'DB_{_alias.upper()}'), 'TEST': {'MIRROR': _shard}}
+    if _replicas:
+        AUTOMACAO_REPLICAS[_shard] = _replicas
+
+DATABASE_ROUTERS = ['automacao.routers.ShardRouter']
+
+# Tempo (s) que cada processo guarda a localização de uma casa; move_house espera esse tempo entre as etapas
+SHARD_DIRECTORY_TTL = float(os.getenv('SHARD_DIRECTORY_TTL', '5'))
+
+# Depois de uma escrita, as leituras do mesmo cliente vão ao primário por este tempo (s), via cookie
+REPLICA_PIN_SECONDS = float(os.getenv('REPLICA_PIN_SECONDS', '5'))
+
+# Intervalo (s) entre as verificações de saúde de cada réplica
+REPLICA_CHECK_SECONDS = float(os.getenv('REPLICA_CHECK_SECONDS', '5'))
 
+# Atraso de replicação (s) acima do qual a réplica deixa de receber leituras
+REPLICA_MAX_LAG = float(os.getenv('REPLICA_MAX_LAG', '2'))
 
 
 # Password validation
@@ -144,6 +204,66 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     'DEFAULT_SCHEMA_CLASS': 'drf_spectacular.openapi.AutoSchema',
     'DEFAULT_FILTER_BACKENDS': ['django_filters.rest_framework.DjangoFilterBackend'],
+    # Paginação por cursor (keyset) no id, em todas as listagens
+    'DEFAULT_PAGINATION_CLASS': 'automacao.pagination.IdCursorPagination',
+    'PAGE_SIZE': int(os.getenv('API_PAGE_SIZE', '100')),
 }
 
-CORS_ALLOW_ALL_ORIGINS = True
\ No newline at end of file
+CORS_ALLOW_ALL_ORIGINS = True
+
+# Perfil das requisições (automacao.profiling): fração das requisições medidas (0 desliga, 1 mede todas)
+# Cada requisição medida fica alguns % mais lenta; com até 0.05 o custo médio fica abaixo de 1%
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', '0'))
+
+# Motor de execução de cenas (automacao.engine)
+# Quantidade de threads usadas para acessar o banco durante as execuções
+SCENE_ENGINE_WORKERS = int(os.getenv('SCENE_ENGINE_WORKERS', '4'))
+# Intervalo (s) em que o motor confirma as execuções vivas; execuções pendentes sem
+# confirmação há SCENE_RUN_STALE_SECONDS (processo reiniciado ou morto) viram 'failed'
+SCENE_RUN_HEARTBEAT_SECONDS = int(os.getenv('SCENE_RUN_HEARTBEAT_SECONDS', '30'))
+SCENE_RUN_STALE_SECONDS = int(os.getenv('SCENE_RUN_STALE_SECONDS', '120'))
+
+# Cache dos planos compilados das cenas (automacao.plans)
+# 'local' usa um LRU na memória do processo; o nome de um alias de CACHES usa um backend compartilhado
+SCENE_PLAN_CACHE = os.getenv('SCENE_PLAN_CACHE', 'local')
+SCENE_PLAN_CACHE_SIZE = int(os.getenv('SCENE_PLAN_CACHE_SIZE', '1024'))
+# Validade (s) de um plano guardado: a invalidação só chega ao cache do processo que
+# alterou a cena, então com 'local' e vários processos os outros podem executar o
+# plano antigo por até esse tempo (0 = sem expiração, só com um alias compartilhado)
+SCENE_PLAN_CACHE_TTL = int(os.getenv('SCENE_PLAN_CACHE_TTL', '30'))
+
+# Cache das respostas de cômodos e cenas (automacao.responses): 'local' ou um alias de CACHES
+# Com 'local' cada leitura em cache consulta House.version, para valer entre processos;
+# um alias compartilhado dispensa essa consulta
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', 'local')
+RESPONSE_CACHE_SIZE = int(os.getenv('RESPONSE_CACHE_SIZE', '10000'))
+
+# Respostas guardadas por Idempotency-Key (automacao.idempotency): 'local' ou um alias de CACHES
+# Com mais de um processo, use um alias compartilhado para as repetições valerem entre eles
+IDEMPOTENCY_CACHE = os.getenv('IDEMPOTENCY_CACHE', 'local')
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv('IDEMPOTENCY_CACHE_SIZE', '10000'))
+# Por quanto tempo (s) uma chave de idempotência vale
+IDEMPOTENCY_TTL = int(os.getenv('IDEMPOTENCY_TTL', '86400'))
+
+# Gatilhos de cena (automacao.triggers): intervalo (s) para perceber gatilhos alterados
+SCENE_TRIGGER_RELOAD_SECONDS = int(os.getenv('SCENE_TRIGGER_RELOAD_SECONDS', '30'))
+
+# Pub/sub das mudanças de estado dos dispositivos (automacao.events)
+DEVICE_EVENTS_BACKEND = os.getenv('DEVICE_EVENTS_BACKEND', 'automacao.events.InMemoryBroker')
+
+# Histórico de estado dos dispositivos (automacao.history)
+# Os eventos são gravados em lote a cada N eventos ou T milissegundos (T=0: na hora, sem thread)
+DEVICE_HISTORY_BATCH_SIZE = int(os.getenv('DEVICE_HISTORY_BATCH_SIZE', '500'))
+DEVICE_HISTORY_FLUSH_MS = int(os.getenv('DEVICE_HISTORY_FLUSH_MS', '1000'))
+# Idade máxima dos eventos mantidos pelo comando prune_device_history
+DEVICE_HISTORY_RETENTION_DAYS = int(os.getenv('DEVICE_HISTORY_RETENTION_DAYS', '90'))
+
+# Escrita adiada do estado dos dispositivos (automacao.writebehind): set_state grava em memória
+# e uma thread leva os estados ao banco a cada N milissegundos. Só com um processo atendendo set_state
+DEVICE_STATE_WRITE_BEHIND = os.getenv('DEVICE_STATE_WRITE_BEHIND', 'false').lower() in ('1', 'true', 'yes')
+DEVICE_STATE_FLUSH_MS = int(os.getenv('DEVICE_STATE_FLUSH_MS', '100'))
+DEVICE_STATE_BATCH_SIZE = int(os.getenv('DEVICE_STATE_BATCH_SIZE', '1000'))
+# Arquivo local (WAL) com as mudanças ainda não gravadas, recuperadas ao reiniciar; vazio desliga
+DEVICE_STATE_WAL = os.getenv('DEVICE_STATE_WAL', '')
+# fsync a cada mudança: também sobrevive à queda do sistema operacional, com escritas mais lentas
+DEVICE_STATE_WAL_FSYNC = os.getenv('DEVICE_STATE_WAL_FSYNC', 'false').lower() in ('1', 'true', 'yes')
\ No newline at end of file